@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import dataclasses
+import itertools
+import json
+import logging
+import platform
+import sys
+from datetime import UTC, datetime, timedelta
+from importlib import metadata
+from pathlib import Path
+from typing import Any
+
+from .runner import POLICIES, PostgresConfig, run_benchmark
+from .workload import WorkloadConfig
+
+_LOG = logging.getLogger(__name__)
+
+_REPOS = ["in_memory", "sqlite", "postgres"]
+_RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run the benchmark matrix")
+    run.add_argument("--repo", action="append", choices=_REPOS)
+    run.add_argument("--policy", action="append", choices=sorted(POLICIES))
+    run.add_argument("--concurrency", action="append", type=int)
+    run.add_argument("--operations", type=int, default=10_000)
+    run.add_argument("--keys", type=int, default=1_000)
+    run.add_argument("--skew", type=float, default=1.1)
+    run.add_argument("--write-ratio", type=float, default=0.2)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--postgres-host", default="localhost")
+    run.add_argument("--postgres-port", type=int, default=5432)
+    run.add_argument("--output", type=Path)
+
+    compare = commands.add_parser("compare", help="Compare two result files")
+    compare.add_argument("baseline", type=Path)
+    compare.add_argument("candidate", type=Path)
+    compare.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="Regression in percent that makes the comparison fail",
+    )
+
+    return parser.parse_args()
+
+
+def _package_version() -> str:
+    try:
+        return metadata.version("prep-rate-limiter")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _run(args: argparse.Namespace) -> int:
+    workload = WorkloadConfig(
+        operations=args.operations,
+        keys=args.keys,
+        skew=args.skew,
+        write_ratio=args.write_ratio,
+        seed=args.seed,
+    )
+    postgres = PostgresConfig(host=args.postgres_host, port=args.postgres_port)
+    repos = args.repo or ["in_memory", "sqlite"]
+    policies = args.policy or sorted(POLICIES)
+    concurrency_levels = args.concurrency or [1, 16]
+
+    results = [
+        asyncio.run(
+            run_benchmark(
+                repo=repo,
+                policy=policy,
+                concurrency=concurrency,
+                workload=workload,
+                postgres=postgres,
+            )
+        )
+        for repo, policy, concurrency in itertools.product(
+            repos,
+            policies,
+            concurrency_levels,
+        )
+    ]
+
+    started_at = datetime.now(UTC)
+    version = _package_version()
+    report = {
+        "version": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created_at": started_at.isoformat(),
+        "workload": {
+            **dataclasses.asdict(workload),
+            "step": workload.step / timedelta(seconds=1),
+        },
+        "results": [dataclasses.asdict(result) for result in results],
+    }
+
+    output = args.output
+    if output is None:
+        output = _RESULTS_DIR / f"{version}-{started_at:%Y%m%dT%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    _LOG.info("Wrote results to %s", output)
+    return 0
+
+
+def _index(report: dict[str, Any]) -> dict[tuple[str, str, int], dict[str, Any]]:
+    return {
+        (result["repo"], result["policy"], result["concurrency"]): result
+        for result in report["results"]
+    }
+
+
+def _change(baseline: float, candidate: float) -> float:
+    return (candidate - baseline) / baseline * 100
+
+
+def _compare(args: argparse.Namespace) -> int:
+    baseline = json.loads(args.baseline.read_text())
+    candidate = json.loads(args.candidate.read_text())
+    if baseline["workload"] != candidate["workload"]:
+        _LOG.warning("The workloads differ, the results may not be comparable")
+
+    baseline_results = _index(baseline)
+    regressions = 0
+    print(f"{baseline['version']} -> {candidate['version']}")
+    for key, result in _index(candidate).items():
+        old = baseline_results.get(key)
+        if old is None:
+            continue
+
+        repo, policy, concurrency = key
+        throughput = _change(old["throughput_per_s"], result["throughput_per_s"])
+        line = (
+            f"{repo:>10} {policy:>15} x{concurrency:<4} throughput {throughput:+7.1f}%"
+        )
+        # Lower throughput is the regression here
+        regressed = -throughput > args.threshold
+        for operation, latencies in sorted(result["latencies"].items()):
+            old_latencies = old["latencies"].get(operation)
+            if old_latencies is None:
+                continue
+            p99 = _change(old_latencies["p99_ms"], latencies["p99_ms"])
+            line += f"  {operation} p99 {p99:+7.1f}%"
+            regressed = regressed or p99 > args.threshold
+
+        if regressed:
+            regressions += 1
+            line += "  REGRESSION"
+        print(line)
+
+    return 1 if regressions else 0
+
+
+def main() -> int:
+    # The library's own logging would dominate the measurements
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    logging.getLogger("benchmarks").setLevel(logging.INFO)
+    args = _parse_args()
+    if args.command == "run":
+        return _run(args)
+    return _compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import math
+import sqlite3
+import tempfile
+import time
+from collections.abc import AsyncGenerator, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+from rate_limiter import RateLimiter, RateLimitingPolicy, RateLimitingRepo
+from rate_limiter.policy import (
+    CompositeRateLimitingPolicy,
+    DailyLimitRateLimitingPolicy,
+    GcraRateLimitingPolicy,
+    SlidingWindowRateLimitingPolicy,
+)
+from rate_limiter.repo import (
+    InMemoryRateLimitingRepo,
+    PostgresRateLimitingRepo,
+    SqliteRateLimitingRepo,
+)
+
+from .workload import Operation, OperationKind, WorkloadConfig, generate_workload
+
+_LOG = logging.getLogger(__name__)
+
+_MIGRATIONS_DIR = Path(__file__).parents[1] / "migrations"
+# Fixed, so the daily limit always sees the same day boundaries
+_START = datetime(2025, 1, 6, 8, tzinfo=UTC)
+
+POLICIES: dict[str, Callable[[], RateLimitingPolicy]] = {
+    "daily_limit": lambda: DailyLimitRateLimitingPolicy(limit=10),
+    "gcra": lambda: GcraRateLimitingPolicy(limit=10, period=timedelta(hours=1)),
+    "sliding_window": lambda: SlidingWindowRateLimitingPolicy(
+        limit=10,
+        window=timedelta(hours=1),
+    ),
+    "composite": lambda: CompositeRateLimitingPolicy(
+        policies=[
+            SlidingWindowRateLimitingPolicy(limit=2, window=timedelta(minutes=1)),
+            SlidingWindowRateLimitingPolicy(limit=10, window=timedelta(hours=1)),
+        ]
+    ),
+}
+
+
+@dataclass(frozen=True, kw_only=True)
+class PostgresConfig:
+    # Defaults match the docker-compose setup
+    host: str = "localhost"
+    port: int = 5432
+    database: str = "postgres"
+    username: str = "postgres"
+    password: str = "notsecret"
+
+
+@dataclass(frozen=True, kw_only=True)
+class LatencySummary:
+    count: int
+    mean_ms: float
+    p50_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+@dataclass(frozen=True, kw_only=True)
+class BenchmarkResult:
+    repo: str
+    policy: str
+    concurrency: int
+    operations: int
+    duration_s: float
+    throughput_per_s: float
+    latencies: dict[str, LatencySummary]
+
+
+def _percentile(sorted_values: list[float], percentile: float) -> float:
+    # Nearest rank, good enough for thousands of samples
+    index = max(0, math.ceil(len(sorted_values) * percentile / 100) - 1)
+    return sorted_values[index]
+
+
+def _summarize(latencies_ns: list[int]) -> LatencySummary:
+    values = sorted(latency / 1_000_000 for latency in latencies_ns)
+    return LatencySummary(
+        count=len(values),
+        mean_ms=sum(values) / len(values),
+        p50_ms=_percentile(values, 50),
+        p99_ms=_percentile(values, 99),
+        max_ms=values[-1],
+    )
+
+
+def _create_sqlite_db(db_file: Path) -> None:
+    migrations = sorted(
+        (_MIGRATIONS_DIR / "sqlite" / "sql").glob("*.sql"),
+        key=lambda path: int(path.name[1:].split("__", maxsplit=1)[0]),
+    )
+    connection = sqlite3.connect(db_file)
+    try:
+        for migration in migrations:
+            connection.executescript(migration.read_text())
+    finally:
+        connection.close()
+
+
+@asynccontextmanager
+async def _open_repo(
+    name: str,
+    postgres: PostgresConfig,
+) -> AsyncGenerator[RateLimitingRepo, None]:
+    if name == "in_memory":
+        repo: RateLimitingRepo = InMemoryRateLimitingRepo()
+        try:
+            yield repo
+        finally:
+            await repo.close()
+    elif name == "sqlite":
+        with tempfile.TemporaryDirectory() as directory:
+            db_file = Path(directory) / "usages.db"
+            await asyncio.to_thread(_create_sqlite_db, db_file)
+            repo = await SqliteRateLimitingRepo.connect(db_file)
+            try:
+                yield repo
+            finally:
+                await repo.close()
+    elif name == "postgres":
+        if PostgresRateLimitingRepo is None:
+            raise ValueError("The postgres repo needs the postgres extra")
+
+        postgres_repo = await PostgresRateLimitingRepo.connect(
+            host=postgres.host,
+            port=postgres.port,
+            database=postgres.database,
+            username=postgres.username,
+            password=postgres.password,
+        )
+        # The schema is expected to be migrated already, but has to start empty
+        async with postgres_repo._cursor() as cursor:
+            await cursor.execute(
+                "TRUNCATE TABLE usages, daily_usage_counters, limiter_states"
+            )
+        try:
+            yield postgres_repo
+        finally:
+            await postgres_repo.close()
+    else:
+        raise ValueError(f"Unknown repo: {name}")
+
+
+async def _run_operation(rate_limiter: RateLimiter, operation: Operation) -> None:
+    if operation.kind is OperationKind.READ:
+        await rate_limiter.get_offending_usage(
+            context_id="benchmark",
+            user_id=operation.user_id,
+            at_time=operation.time,
+        )
+    else:
+        await rate_limiter.add_usage(
+            context_id="benchmark",
+            user_id=operation.user_id,
+            time=operation.time,
+        )
+
+
+async def run_benchmark(
+    *,
+    repo: str,
+    policy: str,
+    concurrency: int,
+    workload: WorkloadConfig,
+    postgres: PostgresConfig,
+) -> BenchmarkResult:
+    if concurrency < 1:
+        raise ValueError(f"Concurrency must be positive, but was {concurrency}")
+
+    operations = generate_workload(workload, start=_START)
+    latencies: dict[OperationKind, list[int]] = {kind: [] for kind in OperationKind}
+
+    async with _open_repo(repo, postgres) as rate_limiting_repo:
+        rate_limiter = RateLimiter(
+            policy=POLICIES[policy](),
+            repo=rate_limiting_repo,
+            timezone=UTC,
+        )
+        pending = iter(operations)
+
+        # Each worker takes the next operation as soon as it's done with its last
+        async def _worker() -> None:
+            for operation in pending:
+                started = time.perf_counter_ns()
+                await _run_operation(rate_limiter, operation)
+                latencies[operation.kind].append(time.perf_counter_ns() - started)
+
+        started = time.perf_counter()
+        async with asyncio.TaskGroup() as task_group:
+            for _ in range(concurrency):
+                task_group.create_task(_worker())
+        duration = time.perf_counter() - started
+
+    _LOG.info(
+        "%s/%s with concurrency %d: %.0f operations per second",
+        repo,
+        policy,
+        concurrency,
+        len(operations) / duration,
+    )
+
+    return BenchmarkResult(
+        repo=repo,
+        policy=policy,
+        concurrency=concurrency,
+        operations=len(operations),
+        duration_s=duration,
+        throughput_per_s=len(operations) / duration,
+        latencies={
+            kind.value: _summarize(values)
+            for kind, values in latencies.items()
+            if values
+        },
+    )
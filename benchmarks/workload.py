@@ -0,0 +1,74 @@
+import itertools
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from enum import StrEnum
+
+
+class OperationKind(StrEnum):
+    READ = "get_offending_usage"
+    WRITE = "add_usage"
+
+
+@dataclass(frozen=True, kw_only=True)
+class WorkloadConfig:
+    operations: int = 10_000
+    # Number of distinct users, all in the same context
+    keys: int = 1_000
+    # Exponent of the Zipf distribution users are drawn from, 0 is uniform
+    skew: float = 1.1
+    # Share of operations that add a usage instead of checking one
+    write_ratio: float = 0.2
+    # Simulated time between two consecutive operations. SQLite only stores
+    # whole seconds and usages of a user must have distinct times.
+    step: timedelta = timedelta(seconds=1)
+    seed: int = 0
+
+    def __post_init__(self) -> None:
+        if self.operations < 1:
+            raise ValueError(f"Operations must be positive, but was {self.operations}")
+        if self.keys < 1:
+            raise ValueError(f"Keys must be positive, but was {self.keys}")
+        if self.skew < 0:
+            raise ValueError(f"Skew may not be negative, but was {self.skew}")
+        if not 0 <= self.write_ratio <= 1:
+            raise ValueError(
+                f"Write ratio must be between 0 and 1, but was {self.write_ratio}"
+            )
+        if self.step < timedelta(seconds=1):
+            raise ValueError(f"Step must be at least a second, but was {self.step}")
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class Operation:
+    kind: OperationKind
+    user_id: str
+    time: datetime
+
+
+def generate_workload(config: WorkloadConfig, *, start: datetime) -> list[Operation]:
+    # The same config always yields the same operations, so runs are comparable
+    rng = random.Random(config.seed)
+    # User i (starting at 1) is picked with a weight of 1 / i^skew
+    cumulative_weights = list(
+        itertools.accumulate(
+            1 / rank**config.skew for rank in range(1, config.keys + 1)
+        )
+    )
+    user_ids = rng.choices(
+        [f"user{rank}" for rank in range(1, config.keys + 1)],
+        cum_weights=cumulative_weights,
+        k=config.operations,
+    )
+    return [
+        Operation(
+            kind=(
+                OperationKind.WRITE
+                if rng.random() < config.write_ratio
+                else OperationKind.READ
+            ),
+            user_id=user_id,
+            time=start + index * config.step,
+        )
+        for index, user_id in enumerate(user_ids)
+    ]
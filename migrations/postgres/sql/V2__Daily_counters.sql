@@ -0,0 +1,11 @@
+create table daily_usage_counters
+(
+    context_id        TEXT        not null,
+    user_id           TEXT        not null,
+    local_day         date        not null,
+    usage_count       integer     not null,
+    last_time         timestamptz not null,
+    last_reference_id TEXT,
+    last_response_id  TEXT,
+    primary key (context_id, user_id, local_day)
+);
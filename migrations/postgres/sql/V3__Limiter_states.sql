@@ -0,0 +1,11 @@
+create table limiter_states
+(
+    context_id        TEXT             not null,
+    user_id           TEXT             not null,
+    value             double precision not null,
+    version           bigint           not null,
+    last_time         timestamptz      not null,
+    last_reference_id TEXT,
+    last_response_id  TEXT,
+    primary key (context_id, user_id)
+);
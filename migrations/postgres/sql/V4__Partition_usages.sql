@@ -0,0 +1,89 @@
+alter table usages rename to usages_unpartitioned;
+alter index usages_by_ids rename to usages_unpartitioned_by_ids;
+
+create table usages
+(
+    context_id   TEXT        not null,
+    user_id      TEXT        not null,
+    time         timestamptz not null,
+    reference_id TEXT,
+    response_id  TEXT,
+    primary key (context_id, user_id, time)
+) partition by range (time);
+
+create index usages_by_ids on usages (context_id asc, user_id asc, time desc);
+
+-- Catches usages for days without a partition. Partitions for days that
+-- already have usages in here can't be created, those are only removed by
+-- deleting rows.
+create table usages_default partition of usages default;
+
+-- Creates the missing daily partitions (in UTC) from first_day to last_day,
+-- both inclusive. Returns the number of created partitions.
+create function create_usage_partitions(first_day date, last_day date) returns integer
+    language plpgsql as
+$$
+declare
+    day     date    := first_day;
+    created integer := 0;
+begin
+    while day <= last_day
+        loop
+            begin
+                execute format(
+                        'create table %I partition of usages for values from (%L) to (%L)',
+                        'usages_' || to_char(day, 'YYYYMMDD'),
+                        day::timestamp at time zone 'UTC',
+                        (day + 1)::timestamp at time zone 'UTC'
+                        );
+                created := created + 1;
+            exception
+                -- Someone else was faster, or the default partition has usages
+                -- for that day
+                when duplicate_table or check_violation then null;
+            end;
+            day := day + 1;
+        end loop;
+    return created;
+end;
+$$;
+
+-- Detaches and drops all daily partitions that only contain usages older than
+-- `until`. Returns the number of dropped partitions.
+create function drop_usage_partitions(until timestamptz) returns integer
+    language plpgsql as
+$$
+declare
+    partition_name text;
+    dropped        integer := 0;
+begin
+    for partition_name in
+        select child.relname
+        from pg_inherits
+                 join pg_class child on child.oid = pg_inherits.inhrelid
+        where pg_inherits.inhparent = 'usages'::regclass
+          and child.relname ~ '^usages_[0-9]{8}$'
+          and (to_date(substring(child.relname from 8), 'YYYYMMDD') + 1)::timestamp
+                  at time zone 'UTC' <= until
+        loop
+            execute format('alter table usages detach partition %I', partition_name);
+            execute format('drop table %I', partition_name);
+            dropped := dropped + 1;
+        end loop;
+    return dropped;
+end;
+$$;
+
+select create_usage_partitions(
+               coalesce(
+                       (select min(time) from usages_unpartitioned) at time zone 'UTC',
+                       now() at time zone 'UTC'
+               )::date,
+               (now() at time zone 'UTC')::date + 7
+       );
+
+insert into usages
+select *
+from usages_unpartitioned;
+
+drop table usages_unpartitioned;
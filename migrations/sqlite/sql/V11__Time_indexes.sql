@@ -0,0 +1,5 @@
+create index usages_by_time on usages (time);
+
+create index daily_usage_counters_by_last_time on daily_usage_counters (last_time);
+
+create index limiter_states_by_last_time on limiter_states (last_time);
@@ -1,17 +1,47 @@
 import abc
+import asyncio
 import logging
+from collections.abc import Callable, Coroutine, Generator, Iterable, Sequence
+from contextlib import contextmanager, suppress
 from dataclasses import dataclass
-from datetime import UTC, datetime, timedelta, tzinfo
-from typing import Self, cast
+from datetime import UTC, date, datetime, timedelta, tzinfo
+from time import perf_counter
+from typing import Any, Self, cast
 from zoneinfo import ZoneInfo
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
 
 _logger = logging.getLogger(__name__)
 _tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
 
+_phase_duration = _meter.create_histogram(
+    "rate_limiter.phase.duration",
+    unit="s",
+    description="Time spent fetching, evaluating or inserting usages",
+)
+_decisions = _meter.create_counter(
+    "rate_limiter.decisions",
+    unit="{decision}",
+    description="Allowed and denied usages",
+)
+_housekeeping_removed = _meter.create_counter(
+    "rate_limiter.housekeeping.removed",
+    unit="{entry}",
+    description="Expired usages, daily counts and states removed by housekeeping",
+)
 
-@dataclass(frozen=True, kw_only=True)
+
+@contextmanager
+def _measure(attributes: dict[str, str]) -> Generator[None]:
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        _phase_duration.record(perf_counter() - started, attributes)
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
 class Usage:
     context_id: str
     user_id: str
@@ -30,6 +60,14 @@ class Usage:
         return cast(Self, usage)
 
 
+@dataclass(frozen=True, kw_only=True, slots=True)
+class DailyUsageCount:
+    day: date
+    count: int
+    # The usage with the latest time on that day
+    last_usage: Usage | None
+
+
 class RateLimitingPolicy(abc.ABC):
     @property
     @abc.abstractmethod
@@ -45,6 +83,131 @@ class RateLimitingPolicy(abc.ABC):
     ) -> Usage | None:
         pass
 
+    def get_offending_usage_sync(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
+    ) -> Usage | None:
+        # Like get_offending_usage, needed for SyncRateLimiter
+        raise NotImplementedError(
+            f"{type(self).__name__} can't be evaluated synchronously"
+        )
+
+    @property
+    def supports_sync(self) -> bool:
+        # Whether get_offending_usage_sync is implemented, which SyncRateLimiter
+        # needs
+        return (
+            type(self).get_offending_usage_sync
+            is not RateLimitingPolicy.get_offending_usage_sync
+        )
+
+    @property
+    def requested_window(self) -> timedelta | None:
+        # If set, only usages within this window before at_time are requested
+        # (but still at most requested_history of them)
+        return None
+
+    def get_next_allowed_time(
+        self,
+        *,
+        at_time: datetime,
+        offending_usage: Usage,
+    ) -> datetime | None:
+        # The earliest time at which a usage denied at `at_time` could be allowed,
+        # as long as no usages are removed in the meantime. None if unknown.
+        return None
+
+    @property
+    def accepts_daily_count(self) -> bool:
+        # Whether get_offending_daily_usage can be used instead of
+        # get_offending_usage
+        return False
+
+    async def get_offending_daily_usage(
+        self,
+        *,
+        at_time: datetime,
+        daily_count: DailyUsageCount,
+    ) -> Usage | None:
+        raise NotImplementedError()
+
+    def get_offending_daily_usage_sync(
+        self,
+        *,
+        at_time: datetime,
+        daily_count: DailyUsageCount,
+    ) -> Usage | None:
+        raise NotImplementedError()
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class RateLimitingState:
+    # The meaning of value is up to the policy
+    value: float
+    last_usage: Usage
+    # Maintained by the repo for compare_and_set_state
+    version: int = 0
+
+
+class StatefulRateLimitingPolicy(RateLimitingPolicy):
+    # Works on a single state per key instead of the usage history
+
+    @property
+    def requested_history(self) -> int:
+        return 0
+
+    @property
+    def supports_sync(self) -> bool:
+        # States are always evaluated synchronously
+        return True
+
+    async def get_offending_usage(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
+    ) -> Usage | None:
+        raise NotImplementedError("This policy needs a state instead of a history")
+
+    def get_offending_usage_sync(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
+    ) -> Usage | None:
+        raise NotImplementedError("This policy needs a state instead of a history")
+
+    @abc.abstractmethod
+    def get_offending_state_usage(
+        self,
+        *,
+        at_time: datetime,
+        state: RateLimitingState | None,
+    ) -> Usage | None:
+        pass
+
+    @abc.abstractmethod
+    def record_usage(
+        self,
+        *,
+        state: RateLimitingState | None,
+        usage: Usage,
+    ) -> RateLimitingState:
+        pass
+
+
+@dataclass(frozen=True, kw_only=True)
+class _Denial:
+    valid_from: datetime
+    valid_until: datetime
+    offending_usage: Usage
+
+
+type UsageCheck = Callable[[list[Usage]], Coroutine[Any, Any, Usage | None]]
+type SyncUsageCheck = Callable[[list[Usage]], Usage | None]
+
 
 class RateLimitingRepo(abc.ABC):
     @abc.abstractmethod
@@ -59,6 +222,31 @@ class RateLimitingRepo(abc.ABC):
     ):
         pass
 
+    @abc.abstractmethod
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        # Bulk insert, the usage times must be in UTC
+        pass
+
+    @abc.abstractmethod
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        # Atomically fetch the last `limit` usages (not older than `since`), pass
+        # them to `check` and only record the new usage if `check` did not return
+        # an offending usage.
+        # No other writer may modify the history of the same context and user in
+        # the meantime.
+        pass
+
     @abc.abstractmethod
     async def get_usages(
         self,
@@ -66,11 +254,76 @@ class RateLimitingRepo(abc.ABC):
         context_id: str,
         user_id: str,
         limit: int = 1,
+        since: datetime | None = None,
     ) -> list[Usage]:
+        # The newest `limit` usages, newest first. If `since` is given, older
+        # usages are left out.
         pass
 
     @abc.abstractmethod
-    async def drop_old_usages(self, *, until: datetime) -> None:
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        # Like get_usages, but for many (context_id, user_id) keys at once.
+        # The result contains an entry for every requested key.
+        pass
+
+    @property
+    def daily_count_timezone(self) -> tzinfo | None:
+        # If set, the repo keeps count of the usages per local day in this timezone
+        return None
+
+    async def get_daily_count(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        day: date,
+    ) -> DailyUsageCount:
+        raise NotImplementedError()
+
+    @property
+    def supports_states(self) -> bool:
+        # Whether the repo implements get_state and compare_and_set_state, which
+        # stateful policies need
+        return False
+
+    async def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        raise NotImplementedError()
+
+    async def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        # Stores the state only if the stored state still has the expected version
+        # (or there is none if expected is None).
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        # Drops usages older than `until` and returns the number of removed
+        # entries. Daily counts and states whose last usage is older than `until`
+        # are dropped (and counted) as well. If `limit` is given, at most that
+        # many entries of each kind are dropped, so the caller has to repeat
+        # until nothing is left.
         pass
 
     @abc.abstractmethod
@@ -78,18 +331,340 @@ class RateLimitingRepo(abc.ABC):
         pass
 
 
-class RateLimiter:
+class SyncRateLimitingRepo(abc.ABC):
+    # The blocking counterpart of RateLimitingRepo, see there for the semantics.
+    # Implementations must be safe to use from several threads.
+
+    @abc.abstractmethod
+    def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ) -> None:
+        pass
+
+    @abc.abstractmethod
+    def add_usages(self, usages: Iterable[Usage]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: SyncUsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        pass
+
+    @abc.abstractmethod
+    def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        pass
+
+    @abc.abstractmethod
+    def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        pass
+
+    @property
+    def daily_count_timezone(self) -> tzinfo | None:
+        return None
+
+    def get_daily_count(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        day: date,
+    ) -> DailyUsageCount:
+        raise NotImplementedError()
+
+    @property
+    def supports_states(self) -> bool:
+        return False
+
+    def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        raise NotImplementedError()
+
+    def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        pass
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        pass
+
+
+class _RateLimiterBase:
+    # Everything RateLimiter and SyncRateLimiter share that doesn't touch the repo
+
+    def __init__(
+        self,
+        *,
+        policy: RateLimitingPolicy,
+        daily_count_timezone: tzinfo | None,
+        supports_states: bool,
+        timezone: tzinfo | None,
+        retention_time: timedelta | None,
+        denial_cache_size: int,
+    ):
+        if isinstance(policy, StatefulRateLimitingPolicy) and not supports_states:
+            raise ValueError(
+                f"Policy {policy!r} keeps a state, but the repo can't store states"
+            )
+
+        self._policy = policy
+        self._retention_time = retention_time
+        self._timezone = timezone or ZoneInfo("Europe/Berlin")
+        # Denied users can be rejected without asking the repo until the policy's
+        # next allowed time.
+        self._denial_cache_size = denial_cache_size
+        self._denials: dict[tuple[str, str], _Denial] = {}
+        self._stateful_policy = (
+            policy if isinstance(policy, StatefulRateLimitingPolicy) else None
+        )
+        self._uses_daily_counts = (
+            policy.accepts_daily_count
+            and daily_count_timezone is not None
+            and daily_count_timezone == self._timezone
+        )
+        # Metric attributes are built once, they're needed for every decision
+        policy_name = type(policy).__name__
+        self._fetch_attributes = {"policy": policy_name, "phase": "fetch"}
+        self._evaluate_attributes = {"policy": policy_name, "phase": "evaluate"}
+        self._insert_attributes = {"policy": policy_name, "phase": "insert"}
+        # try_acquire fetches, evaluates and inserts in one atomic repo call
+        self._acquire_attributes = {"policy": policy_name, "phase": "acquire"}
+        self._allow_attributes = {"policy": policy_name, "decision": "allow"}
+        self._deny_attributes = {"policy": policy_name, "decision": "deny"}
+        self._cached_deny_attributes = {
+            "policy": policy_name,
+            "decision": "deny",
+            "cached": "true",
+        }
+        self._housekeeping_attributes = {"policy": policy_name}
+
+    def _get_cached_denial(
+        self,
+        key: tuple[str, str],
+        at_time: datetime,
+    ) -> Usage | None:
+        denial = self._denials.get(key)
+        if denial is None:
+            return None
+
+        if denial.valid_until <= at_time:
+            self._denials.pop(key, None)
+            return None
+
+        if at_time < denial.valid_from:
+            return None
+
+        return denial.offending_usage
+
+    def _remember_denial(
+        self,
+        key: tuple[str, str],
+        at_time: datetime,
+        offending_usage: Usage,
+    ) -> None:
+        if not self._denial_cache_size:
+            return
+
+        valid_until = self._policy.get_next_allowed_time(
+            at_time=at_time,
+            offending_usage=offending_usage,
+        )
+        if valid_until is None:
+            return
+
+        if key not in self._denials and len(self._denials) >= self._denial_cache_size:
+            # Make room by forgetting the oldest denial. This tolerates other
+            # threads changing the cache in the meantime (see SyncRateLimiter).
+            self._denials.pop(next(iter(self._denials), key), None)
+
+        self._denials[key] = _Denial(
+            valid_from=at_time,
+            valid_until=valid_until,
+            offending_usage=offending_usage,
+        )
+
+    def _count_decision(
+        self,
+        offending_usage: Usage | None,
+        *,
+        cached: bool = False,
+    ) -> Usage | None:
+        if offending_usage is None:
+            _decisions.add(1, self._allow_attributes)
+        elif cached:
+            _decisions.add(1, self._cached_deny_attributes)
+        else:
+            _decisions.add(1, self._deny_attributes)
+        return offending_usage
+
+    def _get_window_start(self, at_time: datetime) -> datetime | None:
+        window = self._policy.requested_window
+        if window is None:
+            return None
+        return (at_time - window).astimezone(UTC)
+
+    def _handle_offending_usage(
+        self,
+        key: tuple[str, str],
+        local_time: datetime,
+        offending_usage: Usage | None,
+    ) -> Usage | None:
+        if offending_usage is None:
+            return None
+
+        offending_usage = offending_usage.in_timezone(self._timezone)
+        self._remember_denial(key, local_time, offending_usage)
+        return offending_usage
+
+    @staticmethod
+    def _to_key(context_id: str | int, user_id: str | int) -> tuple[str, str]:
+        return str(context_id), str(user_id)
+
+    @staticmethod
+    def _to_utc(usage: Usage) -> Usage:
+        return Usage(
+            context_id=usage.context_id,
+            user_id=usage.user_id,
+            time=usage.time.astimezone(UTC),
+            reference_id=usage.reference_id,
+            response_id=usage.response_id,
+        )
+
+    def _split_cached_denials(
+        self,
+        keys: Iterable[tuple[str | int, str | int]],
+        at_time: datetime,
+    ) -> tuple[dict[tuple[str, str], Usage | None], list[tuple[str, str]]]:
+        # Answers the keys with a cached denial, the others still have to be
+        # evaluated. Duplicate keys are only answered once.
+        result = {
+            key: self._get_cached_denial(key, at_time)
+            for key in dict.fromkeys(
+                self._to_key(context_id, user_id) for context_id, user_id in keys
+            )
+        }
+        uncached_keys = []
+        for key, denial in result.items():
+            if denial is None:
+                uncached_keys.append(key)
+            else:
+                self._count_decision(denial, cached=True)
+        return result, uncached_keys
+
+    def _get_history_query(self, at_time: datetime) -> tuple[int, datetime | None]:
+        # The limit and start of the history the policy needs at `at_time`
+        return self._policy.requested_history, self._get_window_start(at_time)
+
+    def _evaluate_state(
+        self,
+        *,
+        key: tuple[str, str],
+        at_time: datetime,
+        state: RateLimitingState | None,
+    ) -> Usage | None:
+        policy = cast(StatefulRateLimitingPolicy, self._stateful_policy)
+        local_time = at_time.astimezone(self._timezone)
+        with _measure(self._evaluate_attributes):
+            offending_usage = policy.get_offending_state_usage(
+                at_time=local_time,
+                state=state,
+            )
+        return self._handle_offending_usage(key, local_time, offending_usage)
+
+    def _get_next_state(
+        self,
+        state: RateLimitingState | None,
+        usage: Usage,
+    ) -> RateLimitingState:
+        policy = cast(StatefulRateLimitingPolicy, self._stateful_policy)
+        return policy.record_usage(state=state, usage=usage)
+
+    def _get_housekeeping_cutoff(self, chunk_size: int | None) -> datetime | None:
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError(f"Chunk size must be positive, but was {chunk_size}")
+
+        retention_time = self._retention_time
+        if retention_time is None:
+            _logger.warning(
+                "Housekeeping was requested, but no retention time was set",
+            )
+            return None
+
+        return datetime.now(tz=UTC) - retention_time
+
+    def _finish_housekeeping(self, removed: int, cutoff: datetime) -> None:
+        # Cached denials might be based on usages that are gone now
+        self._denials.clear()
+        _housekeeping_removed.add(removed, self._housekeeping_attributes)
+        _logger.debug("Housekeeping removed %d entries older than %s", removed, cutoff)
+
+
+class RateLimiter(_RateLimiterBase):
     def __init__(
         self,
         policy: RateLimitingPolicy,
         repo: RateLimitingRepo,
         timezone: tzinfo | None = None,
         retention_time: timedelta | None = None,
+        denial_cache_size: int = 10_000,
     ):
-        self._policy = policy
+        super().__init__(
+            policy=policy,
+            daily_count_timezone=repo.daily_count_timezone,
+            supports_states=repo.supports_states,
+            timezone=timezone,
+            retention_time=retention_time,
+            denial_cache_size=denial_cache_size,
+        )
         self._repo = repo
-        self._retention_time = retention_time
-        self._timezone = timezone or ZoneInfo("Europe/Berlin")
+        self._housekeeping: asyncio.Task[None] | None = None
 
     @_tracer.start_as_current_span("get_offending_usage")
     async def get_offending_usage(
@@ -99,18 +674,200 @@ class RateLimiter:
         user_id: str | int,
         at_time: datetime,
     ) -> Usage | None:
-        context_id = str(context_id)
-        user_id = str(user_id)
-        requested_history = self._policy.requested_history
-        history = await self._repo.get_usages(
-            context_id=context_id,
-            user_id=user_id,
-            limit=requested_history,
-        )
-        return await self._policy.get_offending_usage(
-            at_time=at_time.astimezone(self._timezone),
-            last_usages=[usage.in_timezone(self._timezone) for usage in history],
+        key = self._to_key(context_id, user_id)
+        cached_denial = self._get_cached_denial(key, at_time)
+        if cached_denial is not None:
+            return self._count_decision(cached_denial, cached=True)
+
+        if self._stateful_policy is not None:
+            offending_usage = await self._fetch_and_evaluate_state(
+                key=key,
+                at_time=at_time,
+            )
+        elif self._uses_daily_counts:
+            offending_usage = await self._evaluate_daily_count(
+                key=key,
+                at_time=at_time,
+            )
+        else:
+            limit, since = self._get_history_query(at_time)
+            with _measure(self._fetch_attributes):
+                history = await self._repo.get_usages(
+                    context_id=key[0],
+                    user_id=key[1],
+                    limit=limit,
+                    since=since,
+                )
+            offending_usage = await self._evaluate(
+                key=key,
+                at_time=at_time,
+                history=history,
+            )
+
+        return self._count_decision(offending_usage)
+
+    @_tracer.start_as_current_span("get_offending_usages_many")
+    async def get_offending_usages_many(
+        self,
+        *,
+        keys: Iterable[tuple[str | int, str | int]],
+        at_time: datetime,
+    ) -> dict[tuple[str, str], Usage | None]:
+        result, uncached_keys = self._split_cached_denials(keys, at_time)
+        if not uncached_keys:
+            return result
+
+        if self._stateful_policy is not None:
+            for key in uncached_keys:
+                result[key] = self._count_decision(
+                    await self._fetch_and_evaluate_state(key=key, at_time=at_time)
+                )
+            return result
+
+        limit, since = self._get_history_query(at_time)
+        with _measure(self._fetch_attributes):
+            histories = await self._repo.get_usages_many(
+                keys=uncached_keys,
+                limit=limit,
+                since=since,
+            )
+        for key in uncached_keys:
+            result[key] = self._count_decision(
+                await self._evaluate(
+                    key=key,
+                    at_time=at_time,
+                    history=histories[key],
+                )
+            )
+        return result
+
+    async def _evaluate(
+        self,
+        *,
+        key: tuple[str, str],
+        at_time: datetime,
+        history: list[Usage],
+    ) -> Usage | None:
+        local_time = at_time.astimezone(self._timezone)
+        # The history is passed on in UTC, only the result is converted
+        with _measure(self._evaluate_attributes):
+            offending_usage = await self._policy.get_offending_usage(
+                at_time=local_time,
+                last_usages=history,
+            )
+        return self._handle_offending_usage(key, local_time, offending_usage)
+
+    async def _evaluate_daily_count(
+        self,
+        *,
+        key: tuple[str, str],
+        at_time: datetime,
+    ) -> Usage | None:
+        local_time = at_time.astimezone(self._timezone)
+        with _measure(self._fetch_attributes):
+            daily_count = await self._repo.get_daily_count(
+                context_id=key[0],
+                user_id=key[1],
+                day=local_time.date(),
+            )
+        with _measure(self._evaluate_attributes):
+            offending_usage = await self._policy.get_offending_daily_usage(
+                at_time=local_time,
+                daily_count=daily_count,
+            )
+        return self._handle_offending_usage(key, local_time, offending_usage)
+
+    async def _fetch_and_evaluate_state(
+        self,
+        *,
+        key: tuple[str, str],
+        at_time: datetime,
+    ) -> Usage | None:
+        with _measure(self._fetch_attributes):
+            state = await self._repo.get_state(context_id=key[0], user_id=key[1])
+        return self._evaluate_state(key=key, at_time=at_time, state=state)
+
+    async def _record_state(
+        self,
+        *,
+        usage: Usage,
+        check: bool,
+    ) -> Usage | None:
+        key = (usage.context_id, usage.user_id)
+        while True:
+            with _measure(self._fetch_attributes):
+                state = await self._repo.get_state(
+                    context_id=usage.context_id,
+                    user_id=usage.user_id,
+                )
+            if check:
+                offending_usage = self._evaluate_state(
+                    key=key,
+                    at_time=usage.time,
+                    state=state,
+                )
+                if offending_usage is not None:
+                    return offending_usage
+
+            with _measure(self._insert_attributes):
+                is_set = await self._repo.compare_and_set_state(
+                    context_id=usage.context_id,
+                    user_id=usage.user_id,
+                    expected=state,
+                    state=self._get_next_state(state, usage),
+                )
+            if is_set:
+                return None
+
+            _logger.debug("State of %s was changed concurrently, retrying", key)
+
+    @_tracer.start_as_current_span("try_acquire")
+    async def try_acquire(
+        self,
+        *,
+        context_id: str | int,
+        user_id: str | int,
+        at_time: datetime,
+        reference_id: str | None = None,
+        response_id: str | None = None,
+    ) -> Usage | None:
+        # Like get_offending_usage followed by add_usage, but atomic. Returns the
+        # offending usage if the usage was denied, otherwise it has been recorded.
+        key = self._to_key(context_id, user_id)
+        cached_denial = self._get_cached_denial(key, at_time)
+        if cached_denial is not None:
+            return self._count_decision(cached_denial, cached=True)
+
+        usage = self._to_utc(
+            Usage(
+                context_id=key[0],
+                user_id=key[1],
+                time=at_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
         )
+        if self._stateful_policy is not None:
+            return self._count_decision(
+                await self._record_state(usage=usage, check=True)
+            )
+
+        async def _check(history: list[Usage]) -> Usage | None:
+            return await self._evaluate(key=key, at_time=at_time, history=history)
+
+        limit, since = self._get_history_query(at_time)
+        with _measure(self._acquire_attributes):
+            offending_usage = await self._repo.add_usage_if_allowed(
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                utc_time=usage.time,
+                reference_id=usage.reference_id,
+                response_id=usage.response_id,
+                limit=limit,
+                check=_check,
+                since=since,
+            )
+        return self._count_decision(offending_usage)
 
     @_tracer.start_as_current_span("add_usage")
     async def add_usage(
@@ -122,29 +879,374 @@ class RateLimiter:
         reference_id: str | None = None,
         response_id: str | None = None,
     ) -> None:
-        context_id = str(context_id)
-        user_id = str(user_id)
-        utc_time = time.astimezone(UTC)
-        await self._repo.add_usage(
-            context_id=context_id,
-            user_id=user_id,
-            utc_time=utc_time,
-            reference_id=reference_id,
-            response_id=response_id,
+        context_id, user_id = self._to_key(context_id, user_id)
+        usage = self._to_utc(
+            Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
         )
+        if self._stateful_policy is not None:
+            await self._record_state(usage=usage, check=False)
+            return
 
-    @_tracer.start_as_current_span("do_housekeeping")
-    async def do_housekeeping(self) -> None:
-        retention_time = self._retention_time
-        if retention_time is None:
-            _logger.warning(
-                "Housekeeping was requested, but no retention time was set",
+        with _measure(self._insert_attributes):
+            await self._repo.add_usage(
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                utc_time=usage.time,
+                reference_id=usage.reference_id,
+                response_id=usage.response_id,
             )
+
+    @_tracer.start_as_current_span("add_usages")
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        utc_usages = (self._to_utc(usage) for usage in usages)
+        if self._stateful_policy is not None:
+            for usage in utc_usages:
+                await self._record_state(usage=usage, check=False)
+            return
+
+        with _measure(self._insert_attributes):
+            await self._repo.add_usages(utc_usages)
+
+    @_tracer.start_as_current_span("do_housekeeping")
+    async def do_housekeeping(self, *, chunk_size: int | None = None) -> int:
+        # With a chunk size, old usages are dropped in several small batches so
+        # the repo isn't blocked by one huge delete. Returns the removed entries.
+        cutoff = self._get_housekeeping_cutoff(chunk_size)
+        if cutoff is None:
+            return 0
+
+        removed = 0
+        while True:
+            dropped = await self._repo.drop_old_usages(until=cutoff, limit=chunk_size)
+            removed += dropped
+            if chunk_size is None or dropped == 0:
+                break
+            # Let requests through between chunks
+            await asyncio.sleep(0)
+
+        self._finish_housekeeping(removed, cutoff)
+        return removed
+
+    def start_housekeeping(
+        self,
+        *,
+        interval: timedelta = timedelta(minutes=5),
+        chunk_size: int | None = 1000,
+    ) -> None:
+        # Runs do_housekeeping every `interval` until stop_housekeeping or close
+        if self._retention_time is None:
+            raise ValueError("Housekeeping needs a retention time")
+        if interval <= timedelta(0):
+            raise ValueError(f"Interval must be positive, but was {interval}")
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError(f"Chunk size must be positive, but was {chunk_size}")
+        if self._housekeeping is not None:
+            raise ValueError("Housekeeping is already running")
+
+        self._housekeeping = asyncio.create_task(
+            self._run_housekeeping(interval.total_seconds(), chunk_size)
+        )
+
+    async def _run_housekeeping(self, interval: float, chunk_size: int | None) -> None:
+        while True:
+            try:
+                await self.do_housekeeping(chunk_size=chunk_size)
+            except Exception:
+                # Try again next time instead of stopping for good
+                _logger.exception("Housekeeping failed")
+            await asyncio.sleep(interval)
+
+    async def stop_housekeeping(self) -> None:
+        housekeeping = self._housekeeping
+        if housekeeping is None:
             return
 
-        now = datetime.now(tz=UTC)
-        cutoff = now - retention_time
-        await self._repo.drop_old_usages(until=cutoff)
+        self._housekeeping = None
+        housekeeping.cancel()
+        with suppress(asyncio.CancelledError):
+            await housekeeping
 
     async def close(self) -> None:
+        await self.stop_housekeeping()
         await self._repo.close()
+
+
+class SyncRateLimiter(_RateLimiterBase):
+    # The blocking counterpart of RateLimiter for threaded code. Everything runs
+    # on the calling thread, without an event loop. The policy must implement
+    # the synchronous evaluation methods, the built-in ones all do. There's no
+    # background housekeeping, call do_housekeeping periodically instead.
+
+    def __init__(
+        self,
+        policy: RateLimitingPolicy,
+        repo: SyncRateLimitingRepo,
+        timezone: tzinfo | None = None,
+        retention_time: timedelta | None = None,
+        denial_cache_size: int = 10_000,
+    ):
+        if not policy.supports_sync:
+            raise ValueError(f"Policy {policy!r} can't be evaluated synchronously")
+
+        super().__init__(
+            policy=policy,
+            daily_count_timezone=repo.daily_count_timezone,
+            supports_states=repo.supports_states,
+            timezone=timezone,
+            retention_time=retention_time,
+            denial_cache_size=denial_cache_size,
+        )
+        self._repo = repo
+
+    @_tracer.start_as_current_span("get_offending_usage")
+    def get_offending_usage(
+        self,
+        *,
+        context_id: str | int,
+        user_id: str | int,
+        at_time: datetime,
+    ) -> Usage | None:
+        key = self._to_key(context_id, user_id)
+        cached_denial = self._get_cached_denial(key, at_time)
+        if cached_denial is not None:
+            return self._count_decision(cached_denial, cached=True)
+
+        if self._stateful_policy is not None:
+            offending_usage = self._fetch_and_evaluate_state(key=key, at_time=at_time)
+        elif self._uses_daily_counts:
+            offending_usage = self._evaluate_daily_count(key=key, at_time=at_time)
+        else:
+            limit, since = self._get_history_query(at_time)
+            with _measure(self._fetch_attributes):
+                history = self._repo.get_usages(
+                    context_id=key[0],
+                    user_id=key[1],
+                    limit=limit,
+                    since=since,
+                )
+            offending_usage = self._evaluate(key=key, at_time=at_time, history=history)
+
+        return self._count_decision(offending_usage)
+
+    @_tracer.start_as_current_span("get_offending_usages_many")
+    def get_offending_usages_many(
+        self,
+        *,
+        keys: Iterable[tuple[str | int, str | int]],
+        at_time: datetime,
+    ) -> dict[tuple[str, str], Usage | None]:
+        result, uncached_keys = self._split_cached_denials(keys, at_time)
+        if not uncached_keys:
+            return result
+
+        if self._stateful_policy is not None:
+            for key in uncached_keys:
+                result[key] = self._count_decision(
+                    self._fetch_and_evaluate_state(key=key, at_time=at_time)
+                )
+            return result
+
+        limit, since = self._get_history_query(at_time)
+        with _measure(self._fetch_attributes):
+            histories = self._repo.get_usages_many(
+                keys=uncached_keys,
+                limit=limit,
+                since=since,
+            )
+        for key in uncached_keys:
+            result[key] = self._count_decision(
+                self._evaluate(key=key, at_time=at_time, history=histories[key])
+            )
+        return result
+
+    def _evaluate(
+        self,
+        *,
+        key: tuple[str, str],
+        at_time: datetime,
+        history: list[Usage],
+    ) -> Usage | None:
+        local_time = at_time.astimezone(self._timezone)
+        with _measure(self._evaluate_attributes):
+            offending_usage = self._policy.get_offending_usage_sync(
+                at_time=local_time,
+                last_usages=history,
+            )
+        return self._handle_offending_usage(key, local_time, offending_usage)
+
+    def _evaluate_daily_count(
+        self,
+        *,
+        key: tuple[str, str],
+        at_time: datetime,
+    ) -> Usage | None:
+        local_time = at_time.astimezone(self._timezone)
+        with _measure(self._fetch_attributes):
+            daily_count = self._repo.get_daily_count(
+                context_id=key[0],
+                user_id=key[1],
+                day=local_time.date(),
+            )
+        with _measure(self._evaluate_attributes):
+            offending_usage = self._policy.get_offending_daily_usage_sync(
+                at_time=local_time,
+                daily_count=daily_count,
+            )
+        return self._handle_offending_usage(key, local_time, offending_usage)
+
+    def _fetch_and_evaluate_state(
+        self,
+        *,
+        key: tuple[str, str],
+        at_time: datetime,
+    ) -> Usage | None:
+        with _measure(self._fetch_attributes):
+            state = self._repo.get_state(context_id=key[0], user_id=key[1])
+        return self._evaluate_state(key=key, at_time=at_time, state=state)
+
+    def _record_state(
+        self,
+        *,
+        usage: Usage,
+        check: bool,
+    ) -> Usage | None:
+        key = (usage.context_id, usage.user_id)
+        while True:
+            with _measure(self._fetch_attributes):
+                state = self._repo.get_state(
+                    context_id=usage.context_id,
+                    user_id=usage.user_id,
+                )
+            if check:
+                offending_usage = self._evaluate_state(
+                    key=key,
+                    at_time=usage.time,
+                    state=state,
+                )
+                if offending_usage is not None:
+                    return offending_usage
+
+            with _measure(self._insert_attributes):
+                is_set = self._repo.compare_and_set_state(
+                    context_id=usage.context_id,
+                    user_id=usage.user_id,
+                    expected=state,
+                    state=self._get_next_state(state, usage),
+                )
+            if is_set:
+                return None
+
+            _logger.debug("State of %s was changed concurrently, retrying", key)
+
+    @_tracer.start_as_current_span("try_acquire")
+    def try_acquire(
+        self,
+        *,
+        context_id: str | int,
+        user_id: str | int,
+        at_time: datetime,
+        reference_id: str | None = None,
+        response_id: str | None = None,
+    ) -> Usage | None:
+        key = self._to_key(context_id, user_id)
+        cached_denial = self._get_cached_denial(key, at_time)
+        if cached_denial is not None:
+            return self._count_decision(cached_denial, cached=True)
+
+        usage = self._to_utc(
+            Usage(
+                context_id=key[0],
+                user_id=key[1],
+                time=at_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
+        )
+        if self._stateful_policy is not None:
+            return self._count_decision(self._record_state(usage=usage, check=True))
+
+        def _check(history: list[Usage]) -> Usage | None:
+            return self._evaluate(key=key, at_time=at_time, history=history)
+
+        limit, since = self._get_history_query(at_time)
+        with _measure(self._acquire_attributes):
+            offending_usage = self._repo.add_usage_if_allowed(
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                utc_time=usage.time,
+                reference_id=usage.reference_id,
+                response_id=usage.response_id,
+                limit=limit,
+                check=_check,
+                since=since,
+            )
+        return self._count_decision(offending_usage)
+
+    @_tracer.start_as_current_span("add_usage")
+    def add_usage(
+        self,
+        *,
+        context_id: str | int,
+        user_id: str | int,
+        time: datetime,
+        reference_id: str | None = None,
+        response_id: str | None = None,
+    ) -> None:
+        context_id, user_id = self._to_key(context_id, user_id)
+        usage = self._to_utc(
+            Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
+        )
+        if self._stateful_policy is not None:
+            self._record_state(usage=usage, check=False)
+            return
+
+        with _measure(self._insert_attributes):
+            self._repo.add_usage(
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                utc_time=usage.time,
+                reference_id=usage.reference_id,
+                response_id=usage.response_id,
+            )
+
+    @_tracer.start_as_current_span("add_usages")
+    def add_usages(self, usages: Iterable[Usage]) -> None:
+        utc_usages = (self._to_utc(usage) for usage in usages)
+        if self._stateful_policy is not None:
+            for usage in utc_usages:
+                self._record_state(usage=usage, check=False)
+            return
+
+        with _measure(self._insert_attributes):
+            self._repo.add_usages(utc_usages)
+
+    @_tracer.start_as_current_span("do_housekeeping")
+    def do_housekeeping(self, *, chunk_size: int | None = None) -> int:
+        cutoff = self._get_housekeeping_cutoff(chunk_size)
+        if cutoff is None:
+            return 0
+
+        removed = 0
+        while True:
+            dropped = self._repo.drop_old_usages(until=cutoff, limit=chunk_size)
+            removed += dropped
+            if chunk_size is None or dropped == 0:
+                break
+
+        self._finish_housekeeping(removed, cutoff)
+        return removed
+
+    def close(self) -> None:
+        self._repo.close()
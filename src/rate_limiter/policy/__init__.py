@@ -1,5 +1,11 @@
+from .composite import CompositeRateLimitingPolicy
 from .daily_limit import DailyLimitRateLimitingPolicy
+from .gcra import GcraRateLimitingPolicy
+from .sliding_window import SlidingWindowRateLimitingPolicy
 
 __all__ = [
+    "CompositeRateLimitingPolicy",
     "DailyLimitRateLimitingPolicy",
+    "GcraRateLimitingPolicy",
+    "SlidingWindowRateLimitingPolicy",
 ]
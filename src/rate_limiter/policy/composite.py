@@ -0,0 +1,140 @@
+import logging
+from collections.abc import Iterable, Sequence
+from datetime import datetime, timedelta
+
+from .. import RateLimitingPolicy, StatefulRateLimitingPolicy, Usage
+
+_LOG = logging.getLogger(__name__)
+
+
+class CompositeRateLimitingPolicy(RateLimitingPolicy):
+    # Denies a usage if any of the child policies denies it. All children are
+    # evaluated against the same history, which is fetched once with the
+    # largest history and window any child requested.
+
+    def __init__(self, *, policies: Sequence[RateLimitingPolicy]):
+        if not policies:
+            raise ValueError("At least one policy is required")
+        for policy in policies:
+            if isinstance(policy, StatefulRateLimitingPolicy):
+                raise ValueError(
+                    f"Stateful policies can't be combined, but got {policy!r}"
+                )
+
+        self._policies = list(policies)
+        self._requested_history = max(
+            policy.requested_history for policy in self._policies
+        )
+        windows = [policy.requested_window for policy in self._policies]
+        # A single child without a window needs its history regardless of age
+        self._requested_window = (
+            None if None in windows else max(w for w in windows if w is not None)
+        )
+
+    @property
+    def requested_history(self) -> int:
+        return self._requested_history
+
+    @property
+    def requested_window(self) -> timedelta | None:
+        return self._requested_window
+
+    @property
+    def supports_sync(self) -> bool:
+        return all(policy.supports_sync for policy in self._policies)
+
+    async def get_offending_usage(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
+    ) -> Usage | None:
+        return self._combine(
+            at_time,
+            [
+                (
+                    policy,
+                    await policy.get_offending_usage(
+                        at_time=at_time,
+                        last_usages=last_usages[: policy.requested_history],
+                    ),
+                )
+                for policy in self._policies
+            ],
+        )
+
+    def get_offending_usage_sync(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
+    ) -> Usage | None:
+        # Lazily, so children after a final denial aren't evaluated
+        return self._combine(
+            at_time,
+            (
+                (
+                    policy,
+                    policy.get_offending_usage_sync(
+                        at_time=at_time,
+                        last_usages=last_usages[: policy.requested_history],
+                    ),
+                )
+                for policy in self._policies
+            ),
+        )
+
+    def _combine(
+        self,
+        at_time: datetime,
+        results: Iterable[tuple[RateLimitingPolicy, Usage | None]],
+    ) -> Usage | None:
+        denial: tuple[Usage, datetime | None] | None = None
+        for policy, offending_usage in results:
+            if offending_usage is None:
+                continue
+
+            next_allowed_time = policy.get_next_allowed_time(
+                at_time=at_time,
+                offending_usage=offending_usage,
+            )
+            if next_allowed_time is None:
+                # We can't tell when this one allows usages again, so it's the
+                # most restrictive one.
+                denial = (offending_usage, None)
+                break
+
+            if denial is None or (
+                denial[1] is not None and denial[1] < next_allowed_time
+            ):
+                denial = (offending_usage, next_allowed_time)
+
+        if denial is None:
+            _LOG.debug("ALLOW: No policy denied the usage")
+            return None
+
+        _LOG.debug("DENY: At least one policy denied the usage")
+        return denial[0]
+
+    def get_next_allowed_time(
+        self,
+        *,
+        at_time: datetime,
+        offending_usage: Usage,
+    ) -> datetime | None:
+        # The offending usage alone doesn't tell which child denied it. Whichever
+        # it was, its next allowed time lies after at_time, so the earliest of
+        # those is a safe lower bound. Later times would risk denying usages
+        # that are already allowed again.
+        next_allowed_times = []
+        for policy in self._policies:
+            next_allowed_time = policy.get_next_allowed_time(
+                at_time=at_time,
+                offending_usage=offending_usage,
+            )
+            if next_allowed_time is None:
+                return None
+            if next_allowed_time > at_time:
+                next_allowed_times.append(next_allowed_time)
+
+        return min(next_allowed_times, default=None)
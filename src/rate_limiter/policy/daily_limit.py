@@ -1,7 +1,7 @@
 import logging
-from datetime import datetime
+from datetime import date, datetime, time, timedelta, tzinfo
 
-from .. import RateLimitingPolicy, Usage
+from .. import DailyUsageCount, RateLimitingPolicy, Usage
 
 _LOG = logging.getLogger(__name__)
 
@@ -13,6 +13,32 @@ class DailyLimitRateLimitingPolicy(RateLimitingPolicy):
                 f"Limit may not be less than or equal to zero, but was {limit}"
             )
         self._limit = limit
+        # The bounds of the most recently used day as epoch timestamps
+        self._day_bounds: tuple[date, tzinfo | None, float, float] | None = None
+
+    def _get_day_bounds(self, at_time: datetime) -> tuple[float, float]:
+        day = at_time.date()
+        timezone = at_time.tzinfo
+        day_bounds = self._day_bounds
+        if (
+            day_bounds is not None
+            and day_bounds[0] == day
+            and day_bounds[1] is timezone
+        ):
+            return day_bounds[2], day_bounds[3]
+
+        start = datetime.combine(day, time(), tzinfo=timezone).timestamp()
+        end = self._get_next_day(at_time).timestamp()
+        self._day_bounds = (day, timezone, start, end)
+        return start, end
+
+    @staticmethod
+    def _get_next_day(at_time: datetime) -> datetime:
+        return datetime.combine(
+            at_time.date() + timedelta(days=1),
+            time(),
+            tzinfo=at_time.tzinfo,
+        )
 
     @property
     def requested_history(self) -> int:
@@ -23,6 +49,14 @@ class DailyLimitRateLimitingPolicy(RateLimitingPolicy):
         *,
         at_time: datetime,
         last_usages: list[Usage],
+    ) -> Usage | None:
+        return self.get_offending_usage_sync(at_time=at_time, last_usages=last_usages)
+
+    def get_offending_usage_sync(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
     ) -> Usage | None:
         if len(last_usages) > self._limit:
             raise ValueError(
@@ -31,16 +65,55 @@ class DailyLimitRateLimitingPolicy(RateLimitingPolicy):
             )
 
         if len(last_usages) < self._limit:
-            _LOG.info("ALLOW: Got fewer usages than the limit")
+            _LOG.debug("ALLOW: Got fewer usages than the limit")
             # We haven't reached the limit yet
             return None
 
+        # Usages may be in any timezone, but what counts is at_time's local day
+        start, end = self._get_day_bounds(at_time)
         for usage in last_usages:
-            if usage.time.day != at_time.day:
-                _LOG.info("ALLOW: Usage was from another day")
+            if not start <= usage.time.timestamp() < end:
+                _LOG.debug("ALLOW: Usage was from another day")
                 # One of the usages was from another day
                 return None
 
-        _LOG.info("DENY: Usage limit reached")
+        _LOG.debug("DENY: Usage limit reached")
         # All usages were at the same day as at_time, so we're at the limit
         return last_usages[-1]
+
+    @property
+    def accepts_daily_count(self) -> bool:
+        return True
+
+    async def get_offending_daily_usage(
+        self,
+        *,
+        at_time: datetime,
+        daily_count: DailyUsageCount,
+    ) -> Usage | None:
+        return self.get_offending_daily_usage_sync(
+            at_time=at_time,
+            daily_count=daily_count,
+        )
+
+    def get_offending_daily_usage_sync(
+        self,
+        *,
+        at_time: datetime,
+        daily_count: DailyUsageCount,
+    ) -> Usage | None:
+        if daily_count.count < self._limit:
+            _LOG.debug("ALLOW: Got fewer usages than the limit")
+            return None
+
+        _LOG.debug("DENY: Usage limit reached")
+        return daily_count.last_usage
+
+    def get_next_allowed_time(
+        self,
+        *,
+        at_time: datetime,
+        offending_usage: Usage,
+    ) -> datetime | None:
+        # Only usages from at_time's day count, so the next day is a fresh start
+        return self._get_next_day(at_time)
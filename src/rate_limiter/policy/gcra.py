@@ -0,0 +1,71 @@
+import logging
+from datetime import datetime, timedelta
+
+from .. import RateLimitingState, StatefulRateLimitingPolicy, Usage
+
+_LOG = logging.getLogger(__name__)
+
+
+class GcraRateLimitingPolicy(StatefulRateLimitingPolicy):
+    # The generic cell rate algorithm, which is equivalent to a token bucket with
+    # a capacity of `burst` that refills at `limit` tokens per `period`.
+    #
+    # The state value is the theoretical arrival time (TAT) as an epoch timestamp:
+    # the time at which the bucket would be full again.
+
+    def __init__(self, *, limit: int, period: timedelta, burst: int = 1):
+        if limit < 1:
+            raise ValueError(
+                f"Limit may not be less than or equal to zero, but was {limit}"
+            )
+        if period <= timedelta(0):
+            raise ValueError(f"Period must be positive, but was {period}")
+        if burst < 1:
+            raise ValueError(
+                f"Burst may not be less than or equal to zero, but was {burst}"
+            )
+
+        self._emission_interval = period.total_seconds() / limit
+        self._tolerance = self._emission_interval * (burst - 1)
+
+    def get_offending_state_usage(
+        self,
+        *,
+        at_time: datetime,
+        state: RateLimitingState | None,
+    ) -> Usage | None:
+        if state is None:
+            _LOG.debug("ALLOW: No previous usage")
+            return None
+
+        if state.value - at_time.timestamp() <= self._tolerance:
+            _LOG.debug("ALLOW: Enough capacity left")
+            return None
+
+        _LOG.debug("DENY: No capacity left")
+        return state.last_usage
+
+    def record_usage(
+        self,
+        *,
+        state: RateLimitingState | None,
+        usage: Usage,
+    ) -> RateLimitingState:
+        time = usage.time.timestamp()
+        arrival_time = time if state is None else max(state.value, time)
+        return RateLimitingState(
+            value=arrival_time + self._emission_interval,
+            last_usage=usage,
+        )
+
+    def get_next_allowed_time(
+        self,
+        *,
+        at_time: datetime,
+        offending_usage: Usage,
+    ) -> datetime | None:
+        # The TAT is at least one emission interval after the last usage, so this
+        # is a lower bound for the time at which there's capacity again.
+        return offending_usage.time + timedelta(
+            seconds=self._emission_interval - self._tolerance,
+        )
@@ -0,0 +1,73 @@
+import bisect
+import logging
+from datetime import datetime, timedelta
+
+from .. import RateLimitingPolicy, Usage
+
+_LOG = logging.getLogger(__name__)
+
+
+class SlidingWindowRateLimitingPolicy(RateLimitingPolicy):
+    # Allows at most `limit` usages in any rolling window of length `window`.
+    # A usage counts if it's within (at_time - window, at_time].
+
+    def __init__(self, *, limit: int, window: timedelta):
+        if limit < 1:
+            raise ValueError(
+                f"Limit may not be less than or equal to zero, but was {limit}"
+            )
+        if window <= timedelta(0):
+            raise ValueError(f"Window must be positive, but was {window}")
+
+        self._limit = limit
+        self._window = window
+
+    @property
+    def requested_history(self) -> int:
+        return self._limit
+
+    @property
+    def requested_window(self) -> timedelta:
+        return self._window
+
+    async def get_offending_usage(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
+    ) -> Usage | None:
+        return self.get_offending_usage_sync(at_time=at_time, last_usages=last_usages)
+
+    def get_offending_usage_sync(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
+    ) -> Usage | None:
+        if len(last_usages) < self._limit:
+            _LOG.debug("ALLOW: Got fewer usages than the limit")
+            return None
+
+        # The usages are sorted newest first, so negated timestamps are ascending
+        def _key(usage: Usage) -> float:
+            return -usage.time.timestamp()
+
+        end = at_time.timestamp()
+        start = end - self._window.total_seconds()
+        first = bisect.bisect_left(last_usages, -end, key=_key)
+        stop = bisect.bisect_left(last_usages, -start, key=_key)
+        if stop - first < self._limit:
+            _LOG.debug("ALLOW: Fewer usages than the limit within the window")
+            return None
+
+        _LOG.debug("DENY: Usage limit reached within the window")
+        # Once this usage leaves the window, there's room for another one
+        return last_usages[first + self._limit - 1]
+
+    def get_next_allowed_time(
+        self,
+        *,
+        at_time: datetime,
+        offending_usage: Usage,
+    ) -> datetime | None:
+        return offending_usage.time + self._window
@@ -1,13 +1,37 @@
-from .in_memory import InMemoryRateLimitingRepo
+from .caching import CacheStatistics, CachingRateLimitingRepo
+from .compact import CompactInMemoryRateLimitingRepo
+from .in_memory import InMemoryRateLimitingRepo, SyncInMemoryRateLimitingRepo
 
 try:
     from .postgres import PostgresRateLimitingRepo
 except ImportError:
     PostgresRateLimitingRepo = None  # type: ignore
-from .sqlite import SqliteRateLimitingRepo
+
+try:
+    from .redis import RedisRateLimitingRepo
+except ImportError:
+    RedisRateLimitingRepo = None  # type: ignore
+
+try:
+    from .shared_memory import SharedMemoryRateLimitingRepo
+except ImportError:
+    # Needs fcntl, which isn't available on Windows
+    SharedMemoryRateLimitingRepo = None  # type: ignore
+from .segment_log import SegmentLogRateLimitingRepo
+from .sqlite import SqliteRateLimitingRepo, SyncSqliteRateLimitingRepo
+from .write_behind import WriteBehindRateLimitingRepo
 
 __all__ = [
+    "CacheStatistics",
+    "CachingRateLimitingRepo",
+    "CompactInMemoryRateLimitingRepo",
     "InMemoryRateLimitingRepo",
     "PostgresRateLimitingRepo",
+    "RedisRateLimitingRepo",
+    "SegmentLogRateLimitingRepo",
+    "SharedMemoryRateLimitingRepo",
     "SqliteRateLimitingRepo",
+    "SyncInMemoryRateLimitingRepo",
+    "SyncSqliteRateLimitingRepo",
+    "WriteBehindRateLimitingRepo",
 ]
@@ -0,0 +1,39 @@
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import date, tzinfo
+
+from .. import Usage
+
+
+@dataclass(kw_only=True, slots=True)
+class DailyCountIncrement:
+    context_id: str
+    user_id: str
+    day: date
+    count: int
+    last_usage: Usage
+
+
+def aggregate_daily_counts(
+    usages: Iterable[Usage],
+    timezone: tzinfo,
+) -> list[DailyCountIncrement]:
+    increments: dict[tuple[str, str, date], DailyCountIncrement] = {}
+    for usage in usages:
+        day = usage.time.astimezone(timezone).date()
+        key = (usage.context_id, usage.user_id, day)
+        increment = increments.get(key)
+        if increment is None:
+            increments[key] = DailyCountIncrement(
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                day=day,
+                count=1,
+                last_usage=usage,
+            )
+        else:
+            increment.count += 1
+            if usage.time >= increment.last_usage.time:
+                increment.last_usage = usage
+
+    return list(increments.values())
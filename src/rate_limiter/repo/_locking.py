@@ -0,0 +1,28 @@
+import asyncio
+from collections.abc import AsyncGenerator, Hashable
+from contextlib import asynccontextmanager
+
+
+class KeyedLock[K: Hashable]:
+    def __init__(self) -> None:
+        self._locks: dict[K, asyncio.Lock] = {}
+        self._users: dict[K, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: K) -> AsyncGenerator[None, None]:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+            self._users[key] = 0
+
+        self._users[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                # Nobody else is waiting for this key, so we can forget the lock
+                del self._users[key]
+                del self._locks[key]
@@ -0,0 +1,296 @@
+import abc
+import asyncio
+import itertools
+import logging
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+from collections.abc import Generator, Sequence
+from contextlib import suppress
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+_LOG = logging.getLogger(__name__)
+
+# Snapshots of the in-memory repos consist of these columns, so they can be
+# restored into any of them:
+#   per key: context ID, user ID, number of usages (I)
+#   per usage, oldest first per key: time in microseconds (q), reference ID,
+#     response ID
+#   per state: context ID, user ID, value (d), version (q), time of the last
+#     usage in microseconds (q), its reference ID, its response ID
+SCHEMA = "usages/1"
+
+_MAGIC = b"RLSNAP01"
+# magic, schema length
+_HEADER = struct.Struct("<8sH")
+# column type, payload length
+_COLUMN = struct.Struct("<cQ")
+# number of strings, number of them that aren't None, mask length, lengths
+# length
+_STRINGS_HEADER = struct.Struct("<QQQQ")
+# CRC32 of everything before it
+_CHECKSUM = struct.Struct("<I")
+# The column type of strings, all others are array typecodes
+_STRINGS = b"s"
+
+_EPOCH = datetime.fromtimestamp(0, tz=UTC)
+
+# Building the columns of a snapshot pauses after this many keys, so async
+# repos can let other tasks run in between
+SNAPSHOT_STEP = 1_000
+
+type Column = array | list[str | None]
+# Yields whenever it pauses and returns the columns
+type ColumnBuilder = Generator[None, None, list[Column]]
+
+
+def to_micros(time: datetime) -> int:
+    return (time - _EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=micros)
+
+
+def _to_little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data: bytes | memoryview) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _encode_strings(values: list[str | None]) -> bytes:
+    # The strings are joined by NUL, so a single split decodes them. If any of
+    # them contains NUL, their lengths in characters are stored instead. If any
+    # of them is None, a mask of the present ones comes first.
+    present = [value for value in values if value is not None]
+    mask = (
+        b""
+        if len(present) == len(values)
+        else bytes([value is not None for value in values])
+    )
+    text = "\0".join(present)
+    if text.count("\0") == max(len(present) - 1, 0):
+        lengths = b""
+    else:
+        lengths = _to_little_endian(array("q", map(len, present)))
+        text = "".join(present)
+
+    return (
+        _STRINGS_HEADER.pack(len(values), len(present), len(mask), len(lengths))
+        + mask
+        + lengths
+        + text.encode("utf-8", "surrogatepass")
+    )
+
+
+def _decode_strings(data: memoryview) -> list[str | None]:
+    count, present_count, mask_length, lengths_length = _STRINGS_HEADER.unpack_from(
+        data
+    )
+    mask_end = _STRINGS_HEADER.size + mask_length
+    lengths_end = mask_end + lengths_length
+    text = bytes(data[lengths_end:]).decode("utf-8", "surrogatepass")
+
+    present: list[str]
+    if not present_count:
+        present = []
+    elif not lengths_length:
+        present = text.split("\0")
+    else:
+        lengths = _from_little_endian("q", data[mask_end:lengths_end])
+        ends = list(itertools.accumulate(lengths))
+        present = [text[end - length : end] for end, length in zip(ends, lengths)]
+
+    if not mask_length:
+        return list(present)
+    if not present_count:
+        return [None] * count
+
+    remaining = iter(present)
+    return [
+        next(remaining) if is_present else None
+        for is_present in data[_STRINGS_HEADER.size : mask_end]
+    ]
+
+
+def build_columns(builder: ColumnBuilder) -> list[Column]:
+    while True:
+        try:
+            next(builder)
+        except StopIteration as stop:
+            return stop.value
+
+
+async def build_columns_async(builder: ColumnBuilder) -> list[Column]:
+    # Keys that change in between steps may or may not be in the snapshot, but
+    # each key is copied within one step
+    while True:
+        try:
+            next(builder)
+        except StopIteration as stop:
+            return stop.value
+        await asyncio.sleep(0)
+
+
+def write_snapshot(path: Path, columns: Sequence[Column]) -> None:
+    # Blocks. The snapshot replaces `path` atomically once it is on disk.
+    schema = SCHEMA.encode()
+    parts = [_HEADER.pack(_MAGIC, len(schema)), schema]
+    for column in columns:
+        if isinstance(column, array):
+            column_type = column.typecode.encode()
+            payload = _to_little_endian(column)
+        else:
+            column_type = _STRINGS
+            payload = _encode_strings(column)
+        parts.append(_COLUMN.pack(column_type, len(payload)))
+        parts.append(payload)
+
+    data = b"".join(parts)
+    fd, name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    temporary = Path(name)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.write(_CHECKSUM.pack(zlib.crc32(data)))
+            file.flush()
+            os.fsync(file.fileno())
+        temporary.replace(path)
+    except BaseException:
+        temporary.unlink(missing_ok=True)
+        raise
+
+
+class SnapshotReader:
+    # Reads the columns of a snapshot in the order they were written
+
+    def __init__(self, path: Path) -> None:
+        data = path.read_bytes()
+        if len(data) < _HEADER.size + _CHECKSUM.size:
+            raise ValueError(f"{path} is not a rate limiting snapshot")
+
+        body = memoryview(data)[: -_CHECKSUM.size]
+        (checksum,) = _CHECKSUM.unpack_from(data, len(body))
+        magic, schema_length = _HEADER.unpack_from(body)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a rate limiting snapshot")
+        if zlib.crc32(body) != checksum:
+            raise ValueError(f"Snapshot {path} is corrupted")
+
+        schema_end = _HEADER.size + schema_length
+        schema = bytes(body[_HEADER.size : schema_end]).decode()
+        if schema != SCHEMA:
+            raise ValueError(
+                f"Snapshot {path} has schema {schema}, but only {SCHEMA} is supported"
+            )
+
+        self._path = path
+        self._body = body
+        self._offset = schema_end
+
+    def _next(self, column_type: bytes) -> memoryview:
+        if self._offset >= len(self._body):
+            raise ValueError(f"Snapshot {self._path} has too few columns")
+
+        found_type, length = _COLUMN.unpack_from(self._body, self._offset)
+        if found_type != column_type:
+            raise ValueError(
+                f"Expected a column of type {column_type!r} in snapshot"
+                f" {self._path}, but found {found_type!r}"
+            )
+
+        start = self._offset + _COLUMN.size
+        self._offset = start + length
+        return self._body[start : self._offset]
+
+    def read_array(self, typecode: str) -> array:
+        return _from_little_endian(typecode, self._next(typecode.encode()))
+
+    def read_strings(self) -> list[str | None]:
+        return _decode_strings(self._next(_STRINGS))
+
+
+class PeriodicSnapshots(abc.ABC):
+    # Lets an async in-memory repo write snapshots of itself in the background
+
+    _snapshot_path: Path | None = None
+    _snapshot_stopping: asyncio.Event | None = None
+    _snapshot_task: asyncio.Task[None] | None = None
+
+    @abc.abstractmethod
+    async def snapshot(self, path: Path) -> None:
+        pass
+
+    def start_snapshots(
+        self,
+        path: Path,
+        *,
+        interval: timedelta | None = timedelta(minutes=1),
+    ) -> None:
+        # Writes a snapshot to `path` every `interval` and once more on close. If
+        # interval is None, only on close.
+        if interval is not None and interval <= timedelta(0):
+            raise ValueError(f"Interval must be positive, but was {interval}")
+        if self._snapshot_path is not None:
+            raise ValueError("Snapshots are already running")
+
+        self._snapshot_path = path
+        if interval is not None:
+            self._snapshot_stopping = asyncio.Event()
+            self._snapshot_task = asyncio.create_task(
+                self._run_snapshots(
+                    path,
+                    interval.total_seconds(),
+                    self._snapshot_stopping,
+                )
+            )
+
+    async def _run_snapshots(
+        self,
+        path: Path,
+        interval: float,
+        stopping: asyncio.Event,
+    ) -> None:
+        while True:
+            # Stopping cuts the wait short, but never a snapshot that's being
+            # written, so it can't race with the one written on close
+            with suppress(TimeoutError):
+                await asyncio.wait_for(stopping.wait(), interval)
+            if stopping.is_set():
+                return
+
+            try:
+                await self.snapshot(path)
+            except Exception:
+                # Try again next time instead of stopping for good
+                _LOG.exception("Could not write snapshot to %s", path)
+
+    async def stop_snapshots(self) -> None:
+        # Stops without writing another snapshot
+        stopping = self._snapshot_stopping
+        task = self._snapshot_task
+        self._snapshot_path = None
+        self._snapshot_stopping = None
+        self._snapshot_task = None
+        if stopping is not None and task is not None:
+            stopping.set()
+            await task
+
+    async def _close_snapshots(self) -> None:
+        path = self._snapshot_path
+        await self.stop_snapshots()
+        if path is not None:
+            await self.snapshot(path)
@@ -0,0 +1,361 @@
+import bisect
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, tzinfo
+
+from .. import (
+    DailyUsageCount,
+    RateLimitingRepo,
+    RateLimitingState,
+    Usage,
+    UsageCheck,
+)
+
+_LOG = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, kw_only=True)
+class CacheStatistics:
+    hits: int
+    misses: int
+    evictions: int
+
+
+@dataclass(kw_only=True)
+class _CacheEntry:
+    # The newest `depth` usages of the key, newest first. If there are fewer than
+    # `depth` usages, this is the entire history.
+    usages: list[Usage]
+    depth: int
+    expires_at: float
+
+
+class CachingRateLimitingRepo(RateLimitingRepo):
+    def __init__(
+        self,
+        repo: RateLimitingRepo,
+        *,
+        max_entries: int = 10_000,
+        ttl: timedelta = timedelta(seconds=30),
+    ):
+        if max_entries < 1:
+            raise ValueError(f"Max entries must be positive, but was {max_entries}")
+
+        self._repo = repo
+        self._max_entries = max_entries
+        # Bounds how long usages added by other processes may go unnoticed
+        self._ttl = ttl.total_seconds()
+        self._entries: OrderedDict[tuple[str, str], _CacheEntry] = OrderedDict()
+        # Fetches that were started before a write must not fill the cache
+        self._fetch_tokens: dict[tuple[str, str], object] = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def statistics(self) -> CacheStatistics:
+        return CacheStatistics(
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+        )
+
+    def _lookup(self, key: tuple[str, str], limit: int) -> list[Usage] | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+
+        if entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            self._misses += 1
+            return None
+
+        if entry.depth < limit and len(entry.usages) >= entry.depth:
+            # We don't know enough of the history
+            self._misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry.usages[:limit]
+
+    @staticmethod
+    def _filter(usages: list[Usage], since: datetime | None) -> list[Usage]:
+        if since is None:
+            return usages
+        return [usage for usage in usages if usage.time >= since]
+
+    def _store(self, key: tuple[str, str], usages: list[Usage], depth: int) -> None:
+        self._entries[key] = _CacheEntry(
+            usages=usages,
+            depth=depth,
+            expires_at=time.monotonic() + self._ttl,
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def _record(self, usage: Usage) -> None:
+        key = (usage.context_id, usage.user_id)
+        self._fetch_tokens.pop(key, None)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+
+        # Keep the usages sorted newest first
+        position = bisect.bisect_left(
+            entry.usages,
+            -usage.time.timestamp(),
+            key=lambda cached: -cached.time.timestamp(),
+        )
+        entry.usages.insert(position, usage)
+        del entry.usages[entry.depth :]
+
+    async def _fetch(
+        self,
+        keys: Sequence[tuple[str, str]],
+        limit: int,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        tokens = {key: object() for key in keys}
+        self._fetch_tokens.update(tokens)
+        fetched: dict[tuple[str, str], list[Usage]] | None = None
+
+        try:
+            if len(keys) == 1:
+                context_id, user_id = keys[0]
+                fetched = {
+                    keys[0]: await self._repo.get_usages(
+                        context_id=context_id,
+                        user_id=user_id,
+                        limit=limit,
+                    )
+                }
+            else:
+                fetched = await self._repo.get_usages_many(keys=keys, limit=limit)
+        finally:
+            for key, token in tokens.items():
+                if self._fetch_tokens.get(key) is token:
+                    del self._fetch_tokens[key]
+                    if fetched is not None:
+                        self._store(key, list(fetched[key]), limit)
+
+        return fetched
+
+    async def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ):
+        await self._repo.add_usage(
+            context_id=context_id,
+            user_id=user_id,
+            utc_time=utc_time,
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+        self._record(
+            Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=utc_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
+        )
+
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        usages = list(usages)
+        await self._repo.add_usages(usages)
+        for usage in usages:
+            self._record(usage)
+
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        key = (context_id, user_id)
+        token = object()
+        self._fetch_tokens[key] = token
+        seen_history: list[Usage] = []
+
+        # The repo is asked for the newest `limit` usages regardless of `since`,
+        # so what it returns can be cached for any window.
+        async def _check(history: list[Usage]) -> Usage | None:
+            # Repos may check again after losing a race, and only the last
+            # history is current
+            seen_history[:] = history
+            return await check(self._filter(history, since))
+
+        # The check has to happen against the actual repo to stay atomic, but
+        # we can remember what it saw.
+        completed = False
+        try:
+            offending_usage = await self._repo.add_usage_if_allowed(
+                context_id=context_id,
+                user_id=user_id,
+                utc_time=utc_time,
+                reference_id=reference_id,
+                response_id=response_id,
+                limit=limit,
+                check=_check,
+            )
+            completed = True
+        finally:
+            if self._fetch_tokens.get(key) is token:
+                del self._fetch_tokens[key]
+                if completed:
+                    self._store(key, seen_history, limit)
+
+        if offending_usage is None:
+            self._record(
+                Usage(
+                    context_id=context_id,
+                    user_id=user_id,
+                    time=utc_time,
+                    reference_id=reference_id,
+                    response_id=response_id,
+                )
+            )
+
+        return offending_usage
+
+    async def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        key = (context_id, user_id)
+        cached = self._lookup(key, limit)
+        if cached is None:
+            fetched = await self._fetch([key], limit)
+            cached = fetched[key]
+
+        return self._filter(cached, since)
+
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        result: dict[tuple[str, str], list[Usage]] = {}
+        missing = []
+        for key in keys:
+            cached = self._lookup(key, limit)
+            if cached is None:
+                missing.append(key)
+            else:
+                result[key] = cached
+
+        if missing:
+            result.update(await self._fetch(missing, limit))
+
+        return {key: self._filter(usages, since) for key, usages in result.items()}
+
+    @property
+    def daily_count_timezone(self) -> tzinfo | None:
+        return self._repo.daily_count_timezone
+
+    async def get_daily_count(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        day: date,
+    ) -> DailyUsageCount:
+        # The repo maintains the counters on every write, so there's nothing to
+        # cache that would save a query
+        return await self._repo.get_daily_count(
+            context_id=context_id,
+            user_id=user_id,
+            day=day,
+        )
+
+    @property
+    def supports_states(self) -> bool:
+        return self._repo.supports_states
+
+    async def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        return await self._repo.get_state(context_id=context_id, user_id=user_id)
+
+    async def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        return await self._repo.compare_and_set_state(
+            context_id=context_id,
+            user_id=user_id,
+            expected=expected,
+            state=state,
+        )
+
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        dropped = await self._repo.drop_old_usages(until=until, limit=limit)
+
+        # Any fetch that is still running might return dropped usages
+        self._fetch_tokens.clear()
+        if limit is None or dropped < limit:
+            for entry in self._entries.values():
+                entry.usages = [usage for usage in entry.usages if usage.time >= until]
+
+            _LOG.debug(
+                "Purged usages older than %s from %d cache entries",
+                until,
+                len(self._entries),
+            )
+        else:
+            # The limit was hit, so we can't tell which of the old usages are
+            # still stored. Entries that contain any have to be fetched again.
+            stale = [
+                key
+                for key, entry in self._entries.items()
+                if entry.usages and entry.usages[-1].time < until
+            ]
+            for key in stale:
+                del self._entries[key]
+
+            _LOG.debug(
+                "Invalidated %d cache entries with usages older than %s",
+                len(stale),
+                until,
+            )
+        return dropped
+
+    async def close(self) -> None:
+        self._entries.clear()
+        await self._repo.close()
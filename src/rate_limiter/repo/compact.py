@@ -0,0 +1,515 @@
+import asyncio
+import bisect
+import itertools
+import logging
+from array import array
+from collections.abc import Iterable, Sequence
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import cast
+
+from .. import RateLimitingRepo, Usage, UsageCheck
+from ._locking import KeyedLock
+from ._snapshot import (
+    SNAPSHOT_STEP,
+    ColumnBuilder,
+    PeriodicSnapshots,
+    SnapshotReader,
+    build_columns_async,
+    to_micros,
+    write_snapshot,
+)
+
+_LOG = logging.getLogger(__name__)
+
+# Keys are indexed for expiry by the hour of their newest usage
+_BUCKET_SECONDS = 3600
+_MICROS_PER_SECOND = 1_000_000
+
+
+class CompactInMemoryRateLimitingRepo(PeriodicSnapshots, RateLimitingRepo):
+    # Stores usage times as int64 epoch seconds in flat arrays, with a ring of
+    # `max_history` slots per (context_id, user_id) key. Usage objects are only
+    # created when they are requested.
+    #
+    # On CPython, a key costs about 80 bytes plus 8 bytes per history slot, not
+    # counting the ID strings themselves. Reference and response IDs only cost
+    # memory if they are set. With a history of 1, that's about 80 bytes per
+    # usage compared to about 1 KB in InMemoryRateLimitingRepo. The default of
+    # 100 matches the other in-memory repos, so any built-in policy works out of
+    # the box; lower it if the policies need less.
+    #
+    # Like the SQLite repo, usage times are truncated to whole seconds.
+
+    def __init__(self, *, max_history: int = 100) -> None:
+        if not 0 < max_history < 2**16:
+            raise ValueError(
+                f"Max history must be in [1, 65535], but was {max_history}"
+            )
+
+        self._max_history = max_history
+        self._clear()
+        self._locks: KeyedLock[tuple[str, str]] = KeyedLock()
+
+    def _clear(self) -> None:
+        self._contexts: list[str] = []
+        self._context_ids: dict[str, int] = {}
+        self._slots: dict[str, dict[str, int]] = {}
+        self._free_slots: list[int] = []
+
+        # Per slot columns
+        self._slot_contexts = array("i")
+        self._slot_users: list[str | None] = []
+        self._counts = array("H")
+        self._heads = array("H")
+        self._slot_buckets = array("i")
+
+        # Per usage columns, max_history entries per slot
+        self._times = array("q")
+        self._reference_ids: dict[int, str] = {}
+        self._response_ids: dict[int, str] = {}
+
+        self._expiry_buckets: dict[int, array] = {}
+        # Usages older than this have been dropped, even if they are still stored
+        self._dropped_until = float("-inf")
+
+    def _find_slot(self, context_id: str, user_id: str) -> int | None:
+        users = self._slots.get(context_id)
+        if users is None:
+            return None
+        return users.get(user_id)
+
+    def _allocate_slot(self, context_id: str, user_id: str) -> int:
+        context_index = self._context_ids.get(context_id)
+        if context_index is None:
+            context_index = len(self._contexts)
+            self._contexts.append(context_id)
+            self._context_ids[context_id] = context_index
+
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._slot_contexts[slot] = context_index
+            self._slot_users[slot] = user_id
+        else:
+            slot = len(self._slot_users)
+            self._slot_contexts.append(context_index)
+            self._slot_users.append(user_id)
+            self._counts.append(0)
+            self._heads.append(0)
+            self._slot_buckets.append(-1)
+            self._times.frombytes(bytes(self._times.itemsize * self._max_history))
+
+        self._slots.setdefault(context_id, {})[user_id] = slot
+        return slot
+
+    def _release_slot(self, slot: int) -> None:
+        user_id = self._slot_users[slot]
+        if user_id is None:
+            return
+
+        context_id = self._contexts[self._slot_contexts[slot]]
+        users = self._slots[context_id]
+        del users[user_id]
+        if not users:
+            del self._slots[context_id]
+
+        self._clear_ids(slot, 0, self._counts[slot])
+        self._slot_users[slot] = None
+        self._counts[slot] = 0
+        self._heads[slot] = 0
+        self._slot_buckets[slot] = -1
+        self._free_slots.append(slot)
+
+    def _clear_ids(self, slot: int, start: int, stop: int) -> None:
+        # Removes the IDs of the usages start (inclusive) to stop (exclusive),
+        # counted from the newest usage.
+        history = self._max_history
+        base = slot * history
+        head = self._heads[slot]
+        for age in range(start, stop):
+            position = base + (head - 1 - age) % history
+            self._reference_ids.pop(position, None)
+            self._response_ids.pop(position, None)
+
+    def _write(
+        self,
+        position: int,
+        time: int,
+        reference_id: str | None,
+        response_id: str | None,
+    ) -> None:
+        self._times[position] = time
+        if reference_id is None:
+            self._reference_ids.pop(position, None)
+        else:
+            self._reference_ids[position] = reference_id
+        if response_id is None:
+            self._response_ids.pop(position, None)
+        else:
+            self._response_ids[position] = response_id
+
+    def _index(self, slot: int) -> None:
+        history = self._max_history
+        newest = self._times[slot * history + (self._heads[slot] - 1) % history]
+        bucket = newest // _BUCKET_SECONDS
+        if self._slot_buckets[slot] != bucket:
+            # The entry in the previous bucket is stale now and will be skipped
+            self._slot_buckets[slot] = bucket
+            self._expiry_buckets.setdefault(bucket, array("i")).append(slot)
+
+    def _insert(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ) -> None:
+        slot = self._find_slot(context_id, user_id)
+        if slot is None:
+            slot = self._allocate_slot(context_id, user_id)
+
+        time = int(utc_time.timestamp())
+        history = self._max_history
+        base = slot * history
+        count = self._counts[slot]
+        head = self._heads[slot]
+
+        if not count or self._times[base + (head - 1) % history] <= time:
+            self._write(base + head, time, reference_id, response_id)
+            self._heads[slot] = (head + 1) % history
+            self._counts[slot] = min(count + 1, history)
+        else:
+            # Out of order, so we rewrite the whole ring in order
+            entries = [
+                (
+                    self._times[position],
+                    self._reference_ids.get(position),
+                    self._response_ids.get(position),
+                )
+                for position in (
+                    base + (head - count + age) % history for age in range(count)
+                )
+            ]
+            bisect.insort_right(
+                entries,
+                (time, reference_id, response_id),
+                key=lambda entry: entry[0],
+            )
+            entries = entries[-history:]
+            self._clear_ids(slot, 0, count)
+            for offset, entry in enumerate(entries):
+                self._write(base + offset, *entry)
+            self._heads[slot] = len(entries) % history
+            self._counts[slot] = len(entries)
+
+        self._index(slot)
+
+    async def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        history = self._max_history
+        if limit > history:
+            raise ValueError(
+                f"Requested {limit} usages, but only the last {history} are kept"
+            )
+
+        slot = self._find_slot(context_id, user_id)
+        if slot is None:
+            return []
+
+        base = slot * history
+        head = self._heads[slot]
+        count = self._counts[slot]
+        min_time = self._dropped_until
+        if since is not None:
+            min_time = max(min_time, int(since.timestamp()))
+
+        usages = []
+        for age in range(min(limit, count)):
+            position = base + (head - 1 - age) % history
+            time = self._times[position]
+            if time < min_time:
+                if time < self._dropped_until:
+                    self._clear_ids(slot, age, count)
+                    self._counts[slot] = age
+                break
+
+            usages.append(
+                Usage(
+                    context_id=context_id,
+                    user_id=user_id,
+                    time=datetime.fromtimestamp(time, tz=UTC),
+                    reference_id=self._reference_ids.get(position),
+                    response_id=self._response_ids.get(position),
+                )
+            )
+
+        return usages
+
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        return {
+            (context_id, user_id): await self.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            for context_id, user_id in keys
+        }
+
+    async def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ):
+        self._insert(
+            context_id=context_id,
+            user_id=user_id,
+            utc_time=utc_time,
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        for usage in usages:
+            self._insert(
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                utc_time=usage.time,
+                reference_id=usage.reference_id,
+                response_id=usage.response_id,
+            )
+
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        async with self._locks.hold((context_id, user_id)):
+            history = await self.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            offending_usage = await check(history)
+            if offending_usage is None:
+                self._insert(
+                    context_id=context_id,
+                    user_id=user_id,
+                    utc_time=utc_time,
+                    reference_id=reference_id,
+                    response_id=response_id,
+                )
+
+        return offending_usage
+
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        # Releasing a bucket is cheap, so the limit is ignored. Only the usages
+        # of released keys are counted, older usages of other keys are hidden.
+        until_timestamp = until.timestamp()
+        self._dropped_until = max(self._dropped_until, until_timestamp)
+
+        # Keys whose newest usage is in a bucket that ended before `until` are
+        # gone entirely. Older usages of other keys are hidden by _dropped_until.
+        expired_buckets = [
+            bucket
+            for bucket in self._expiry_buckets
+            if (bucket + 1) * _BUCKET_SECONDS <= until_timestamp
+        ]
+        released = 0
+        dropped = 0
+        for bucket in expired_buckets:
+            for slot in self._expiry_buckets.pop(bucket):
+                if self._slot_buckets[slot] == bucket:
+                    dropped += self._counts[slot]
+                    self._release_slot(slot)
+                    released += 1
+
+        _LOG.debug("Released %d keys", released)
+        return dropped
+
+    def _snapshot_columns(self) -> ColumnBuilder:
+        history = self._max_history
+        contexts: list[str | None] = []
+        users: list[str | None] = []
+        counts = array("I")
+        times = array("q")
+        reference_ids: list[str | None] = []
+        response_ids: list[str | None] = []
+        for slot in itertools.count():
+            if not slot % SNAPSHOT_STEP:
+                yield
+            # The columns may have been replaced by a restore while paused
+            if slot >= len(self._slot_users):
+                break
+            user_id = self._slot_users[slot]
+            if user_id is None:
+                continue
+
+            base = slot * history
+            head = self._heads[slot]
+            count = self._counts[slot]
+            positions = [
+                position
+                for position in (
+                    base + (head - count + age) % history for age in range(count)
+                )
+                # Dropped usages may still be stored
+                if self._times[position] >= self._dropped_until
+            ]
+            if not positions:
+                continue
+
+            contexts.append(self._contexts[self._slot_contexts[slot]])
+            users.append(user_id)
+            counts.append(len(positions))
+            for position in positions:
+                times.append(self._times[position] * _MICROS_PER_SECOND)
+                reference_ids.append(self._reference_ids.get(position))
+                response_ids.append(self._response_ids.get(position))
+
+        # States aren't supported
+        return [
+            contexts,
+            users,
+            counts,
+            times,
+            reference_ids,
+            response_ids,
+            [],
+            [],
+            array("d"),
+            array("q"),
+            array("q"),
+            [],
+            [],
+        ]
+
+    def _restore(self, path: Path, until: datetime | None) -> int:
+        # Fills the columns of an empty repo with a snapshot in bulk, leaving out
+        # usages older than `until`. States are ignored. Doesn't touch anything
+        # else, so it can run in another thread.
+        reader = SnapshotReader(path)
+        # Keys are never None
+        contexts = cast(list[str], reader.read_strings())
+        users = cast(list[str], reader.read_strings())
+        counts = reader.read_array("I")
+        micros = reader.read_array("q")
+        reference_ids = reader.read_strings()
+        response_ids = reader.read_strings()
+        seconds = array("q", [time // _MICROS_PER_SECOND for time in micros])
+        has_ids = reference_ids.count(None) + response_ids.count(None) < 2 * len(micros)
+        history = self._max_history
+
+        # The usages to keep of each key, oldest first
+        stops = list(itertools.accumulate(counts))
+        starts = [
+            max(stop - count, stop - history)
+            for stop, count in zip(stops, counts, strict=True)
+        ]
+        if until is not None:
+            min_micros = to_micros(until)
+            starts = [
+                bisect.bisect_left(micros, min_micros, start, stop)
+                for start, stop in zip(starts, stops, strict=True)
+            ]
+        kept = [index for index, stop in enumerate(stops) if starts[index] < stop]
+
+        slot_contexts = [contexts[index] for index in kept]
+        self._contexts = list(dict.fromkeys(slot_contexts))
+        self._context_ids = {
+            context_id: context_index
+            for context_index, context_id in enumerate(self._contexts)
+        }
+        self._slots = {context_id: {} for context_id in self._contexts}
+        self._slot_users = [users[index] for index in kept]
+        for slot, index in enumerate(kept):
+            self._slots[contexts[index]][users[index]] = slot
+        self._slot_contexts = array(
+            "i", map(self._context_ids.__getitem__, slot_contexts)
+        )
+        self._counts = array("H", [stops[index] - starts[index] for index in kept])
+        self._heads = array("H", [count % history for count in self._counts])
+        self._slot_buckets = array(
+            "i", [seconds[stops[index] - 1] // _BUCKET_SECONDS for index in kept]
+        )
+        for slot, bucket in enumerate(self._slot_buckets):
+            self._expiry_buckets.setdefault(bucket, array("i")).append(slot)
+
+        restored = sum(self._counts)
+        if restored == len(seconds) == history * len(kept):
+            # Every key has a full history, which is all of the snapshot
+            self._times = seconds
+        else:
+            # One key at a time, since a single allocation of all slots would
+            # hold the GIL throughout
+            padding = array("q", bytes(8 * history))
+            for index, count in zip(kept, self._counts, strict=True):
+                self._times.extend(seconds[starts[index] : stops[index]])
+                self._times.extend(padding[: history - count])
+        if has_ids:
+            for slot, index in enumerate(kept):
+                base = slot * history - starts[index]
+                for position in range(starts[index], stops[index]):
+                    reference_id = reference_ids[position]
+                    if reference_id is not None:
+                        self._reference_ids[base + position] = reference_id
+                    response_id = response_ids[position]
+                    if response_id is not None:
+                        self._response_ids[base + position] = response_id
+
+        _LOG.info("Restored %d usages of %d keys", restored, len(kept))
+        return restored
+
+    def _take_usages(self, restored: "CompactInMemoryRateLimitingRepo") -> None:
+        # Takes over all columns and indexes of a repo that was only restored into
+        locks = self._locks
+        vars(self).update(vars(restored))
+        self._locks = locks
+
+    async def snapshot(self, path: Path) -> None:
+        # The columns are a copy, so they can be written while usages come in
+        columns = await build_columns_async(self._snapshot_columns())
+        await asyncio.to_thread(write_snapshot, path, columns)
+        _LOG.debug("Wrote snapshot to %s", path)
+
+    async def restore(self, path: Path, *, until: datetime | None = None) -> int:
+        # Replaces all usages with those of a snapshot and returns their number.
+        # Usages older than `until` are left out, states are ignored.
+        restored = CompactInMemoryRateLimitingRepo(max_history=self._max_history)
+        count = await asyncio.to_thread(restored._restore, path, until)
+        self._take_usages(restored)
+        return count
+
+    async def close(self) -> None:
+        await self._close_snapshots()
@@ -1,12 +1,368 @@
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import threading
+from array import array
+from collections import deque
+from collections.abc import Iterable, Iterator, Sequence
 from datetime import datetime
+from pathlib import Path
+from typing import cast
 
-from .. import RateLimitingRepo, Usage
+from .. import (
+    RateLimitingRepo,
+    RateLimitingState,
+    SyncRateLimitingRepo,
+    SyncUsageCheck,
+    Usage,
+    UsageCheck,
+)
+from ._locking import KeyedLock
+from ._snapshot import (
+    SNAPSHOT_STEP,
+    ColumnBuilder,
+    PeriodicSnapshots,
+    SnapshotReader,
+    build_columns,
+    build_columns_async,
+    from_micros,
+    to_micros,
+    write_snapshot,
+)
 
+_LOG = logging.getLogger(__name__)
 
-class InMemoryRateLimitingRepo(RateLimitingRepo):
-    def __init__(self) -> None:
-        # TODO: this implementation should store more than one usage
-        self._usage_time_by_user: dict[str, dict[str, Usage]] = {}
+
+def _restore_usage(
+    context_id: str,
+    user_id: str,
+    time: int,
+    reference_id: str | None,
+    response_id: str | None,
+) -> Usage:
+    return Usage(
+        context_id=context_id,
+        user_id=user_id,
+        time=from_micros(time),
+        reference_id=reference_id,
+        response_id=response_id,
+    )
+
+
+class _InMemoryStore:
+    # The data structures shared by the async and the sync repo. Nothing in here
+    # is synchronized.
+
+    def __init__(self, *, max_history: int) -> None:
+        if max_history < 1:
+            raise ValueError(f"Max history must be positive, but was {max_history}")
+
+        self._max_history = max_history
+        # The newest usages per key, oldest first
+        self._usages: dict[tuple[str, str], deque[Usage]] = {}
+        # A heap with one entry per key pointing at the key's oldest usage, so
+        # housekeeping only has to look at keys that actually have old usages.
+        self._expiry_index: list[tuple[datetime, tuple[str, str]]] = []
+        self._indexed_times: dict[tuple[str, str], datetime] = {}
+        self._states: dict[tuple[str, str], RateLimitingState] = {}
+        # A heap with one entry per state. An entry may be older than the state's
+        # last usage, in which case it's moved up once it's popped.
+        self._state_expiry_index: list[tuple[datetime, tuple[str, str]]] = []
+
+    def _index(self, key: tuple[str, str], time: datetime) -> None:
+        indexed_time = self._indexed_times.get(key)
+        if indexed_time is not None and indexed_time <= time:
+            return
+
+        # An older entry for this key becomes stale and is skipped when popped
+        self._indexed_times[key] = time
+        heapq.heappush(self._expiry_index, (time, key))
+
+    def _insert(self, usage: Usage) -> None:
+        key = (usage.context_id, usage.user_id)
+        usages = self._usages.get(key)
+        if usages is None:
+            usages = deque(maxlen=self._max_history)
+            self._usages[key] = usages
+
+        if not usages or usages[-1].time <= usage.time:
+            usages.append(usage)
+        else:
+            # Usages are usually added in order, so this is the rare case
+            if len(usages) == usages.maxlen:
+                if usage.time < usages[0].time:
+                    # Too old to be part of the history anyway
+                    return
+                usages.popleft()
+            position = bisect.bisect_right(usages, usage.time, key=lambda u: u.time)
+            usages.insert(position, usage)
+
+        self._index(key, usages[0].time)
+
+    def _get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int,
+        since: datetime | None,
+    ) -> list[Usage]:
+        history = self._max_history
+        if limit > history:
+            raise ValueError(
+                f"Requested {limit} usages, but only the last {history} are kept"
+            )
+
+        usages = self._usages.get((context_id, user_id))
+        if not usages:
+            return []
+
+        newest = itertools.islice(reversed(usages), limit)
+        if since is None:
+            return list(newest)
+        return list(itertools.takewhile(lambda usage: usage.time >= since, newest))
+
+    @property
+    def supports_states(self) -> bool:
+        return True
+
+    def _get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        return self._states.get((context_id, user_id))
+
+    def _compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        key = (context_id, user_id)
+        current = self._states.get(key)
+        if current is not expected:
+            return False
+
+        self._states[key] = RateLimitingState(
+            value=state.value,
+            last_usage=state.last_usage,
+            version=0 if current is None else current.version + 1,
+        )
+        if current is None:
+            heapq.heappush(self._state_expiry_index, (state.last_usage.time, key))
+        return True
+
+    def _drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None,
+    ) -> int:
+        dropped = 0
+        while self._expiry_index and self._expiry_index[0][0] < until:
+            if limit is not None and dropped >= limit:
+                break
+
+            time, key = heapq.heappop(self._expiry_index)
+            if self._indexed_times.get(key) != time:
+                continue
+
+            usages = self._usages[key]
+            while usages and usages[0].time < until:
+                if limit is not None and dropped >= limit:
+                    break
+                usages.popleft()
+                dropped += 1
+
+            if usages:
+                self._indexed_times[key] = usages[0].time
+                heapq.heappush(self._expiry_index, (usages[0].time, key))
+            else:
+                del self._usages[key]
+                del self._indexed_times[key]
+
+        dropped_states = 0
+        while self._state_expiry_index and self._state_expiry_index[0][0] < until:
+            if limit is not None and dropped_states >= limit:
+                break
+
+            _, key = heapq.heappop(self._state_expiry_index)
+            time = self._states[key].last_usage.time
+            if time < until:
+                del self._states[key]
+                dropped_states += 1
+            else:
+                heapq.heappush(self._state_expiry_index, (time, key))
+
+        _LOG.debug("Dropped %d usages and %d states", dropped, dropped_states)
+        return dropped + dropped_states
+
+    def _snapshot_columns(self) -> ColumnBuilder:
+        contexts: list[str | None] = []
+        users: list[str | None] = []
+        counts = array("I")
+        times = array("q")
+        reference_ids: list[str | None] = []
+        response_ids: list[str | None] = []
+        # A copy, since keys may come and go while paused
+        for index, key in enumerate(list(self._usages)):
+            if not index % SNAPSHOT_STEP:
+                yield
+            usages = self._usages.get(key)
+            if usages is None:
+                continue
+
+            contexts.append(key[0])
+            users.append(key[1])
+            counts.append(len(usages))
+            for usage in usages:
+                times.append(to_micros(usage.time))
+                reference_ids.append(usage.reference_id)
+                response_ids.append(usage.response_id)
+
+        state_contexts: list[str | None] = []
+        state_users: list[str | None] = []
+        values = array("d")
+        versions = array("q")
+        last_times = array("q")
+        last_reference_ids: list[str | None] = []
+        last_response_ids: list[str | None] = []
+        # States are immutable, so copying the items is enough
+        for index, ((context_id, user_id), state) in enumerate(
+            list(self._states.items())
+        ):
+            if not index % SNAPSHOT_STEP:
+                yield
+            state_contexts.append(context_id)
+            state_users.append(user_id)
+            values.append(state.value)
+            versions.append(state.version)
+            last_times.append(to_micros(state.last_usage.time))
+            last_reference_ids.append(state.last_usage.reference_id)
+            last_response_ids.append(state.last_usage.response_id)
+
+        return [
+            contexts,
+            users,
+            counts,
+            times,
+            reference_ids,
+            response_ids,
+            state_contexts,
+            state_users,
+            values,
+            versions,
+            last_times,
+            last_reference_ids,
+            last_response_ids,
+        ]
+
+    def _restore(self, path: Path, until: datetime | None) -> int:
+        # Fills an empty store with a snapshot in bulk, leaving out usages and
+        # states older than `until`. Doesn't touch anything else, so it can run
+        # in another thread.
+        reader = SnapshotReader(path)
+        # Keys are never None
+        contexts = cast(list[str], reader.read_strings())
+        users = cast(list[str], reader.read_strings())
+        counts: Sequence[int] = reader.read_array("I")
+        times = reader.read_array("q")
+        reference_ids = reader.read_strings()
+        response_ids = reader.read_strings()
+        min_time = None if until is None else to_micros(until)
+
+        rows: Iterator[tuple[str, str, int, str | None, str | None]] = zip(
+            itertools.chain.from_iterable(map(itertools.repeat, contexts, counts)),
+            itertools.chain.from_iterable(map(itertools.repeat, users, counts)),
+            times,
+            reference_ids,
+            response_ids,
+            strict=True,
+        )
+        if min_time is not None:
+            # The old usages of each key come first
+            kept = [time >= min_time for time in times]
+            rows = itertools.compress(rows, kept)
+            kept_before = list(itertools.accumulate(kept, initial=0))
+            counts = [
+                kept_before[stop] - kept_before[stop - count]
+                for stop, count in zip(itertools.accumulate(counts), counts)
+            ]
+
+        usages = itertools.starmap(_restore_usage, rows)
+        restored = 0
+        # One key at a time, since building the dict or heap in a single call
+        # would hold the GIL throughout
+        for key, count in zip(zip(contexts, users), counts, strict=True):
+            if not count:
+                continue
+            # Drops usages beyond the max history
+            key_usages = deque(itertools.islice(usages, count), self._max_history)
+            self._usages[key] = key_usages
+            self._index(key, key_usages[0].time)
+            restored += len(key_usages)
+
+        for (
+            context_id,
+            user_id,
+            value,
+            version,
+            last_time,
+            last_reference_id,
+            last_response_id,
+        ) in zip(
+            cast(list[str], reader.read_strings()),
+            cast(list[str], reader.read_strings()),
+            reader.read_array("d"),
+            reader.read_array("q"),
+            reader.read_array("q"),
+            reader.read_strings(),
+            reader.read_strings(),
+            strict=True,
+        ):
+            if min_time is not None and last_time < min_time:
+                continue
+            key = (context_id, user_id)
+            last_usage = _restore_usage(
+                context_id,
+                user_id,
+                last_time,
+                last_reference_id,
+                last_response_id,
+            )
+            self._states[key] = RateLimitingState(
+                value=value,
+                version=version,
+                last_usage=last_usage,
+            )
+            heapq.heappush(self._state_expiry_index, (last_usage.time, key))
+
+        _LOG.info(
+            "Restored %d usages of %d keys and %d states",
+            restored,
+            len(self._usages),
+            len(self._states),
+        )
+        return restored + len(self._states)
+
+    def _replace_with(self, store: "_InMemoryStore") -> None:
+        self._usages = store._usages
+        self._expiry_index = store._expiry_index
+        self._indexed_times = store._indexed_times
+        self._states = store._states
+        self._state_expiry_index = store._state_expiry_index
+
+
+class InMemoryRateLimitingRepo(_InMemoryStore, PeriodicSnapshots, RateLimitingRepo):
+    def __init__(self, *, max_history: int = 100) -> None:
+        super().__init__(max_history=max_history)
+        self._locks: KeyedLock[tuple[str, str]] = KeyedLock()
 
     async def get_usages(
         self,
@@ -14,9 +370,31 @@ class InMemoryRateLimitingRepo(RateLimitingRepo):
         context_id: str,
         user_id: str,
         limit: int = 1,
+        since: datetime | None = None,
     ) -> list[Usage]:
-        usage = self._usage_time_by_user.get(context_id, {}).get(user_id)
-        return [usage] if usage else []
+        return self._get_usages(
+            context_id=context_id,
+            user_id=user_id,
+            limit=limit,
+            since=since,
+        )
+
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        return {
+            (context_id, user_id): await self.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            for context_id, user_id in keys
+        }
 
     async def add_usage(
         self,
@@ -27,26 +405,243 @@ class InMemoryRateLimitingRepo(RateLimitingRepo):
         reference_id: str | None,
         response_id: str | None,
     ):
-        if context_id not in self._usage_time_by_user:
-            self._usage_time_by_user[context_id] = {}
+        self._insert(
+            Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=utc_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
+        )
+
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        for usage in usages:
+            self._insert(usage)
 
-        self._usage_time_by_user[context_id][user_id] = Usage(
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        async with self._locks.hold((context_id, user_id)):
+            history = await self.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            offending_usage = await check(history)
+            if offending_usage is None:
+                await self.add_usage(
+                    context_id=context_id,
+                    user_id=user_id,
+                    utc_time=utc_time,
+                    reference_id=reference_id,
+                    response_id=response_id,
+                )
+
+        return offending_usage
+
+    async def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        return self._get_state(context_id=context_id, user_id=user_id)
+
+    async def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        return self._compare_and_set_state(
+            context_id=context_id,
+            user_id=user_id,
+            expected=expected,
+            state=state,
+        )
+
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        return self._drop_old_usages(until=until, limit=limit)
+
+    async def snapshot(self, path: Path) -> None:
+        # The columns are a copy, so they can be written while usages come in
+        columns = await build_columns_async(self._snapshot_columns())
+        await asyncio.to_thread(write_snapshot, path, columns)
+        _LOG.debug("Wrote snapshot of %d keys to %s", len(columns[0]), path)
+
+    async def restore(self, path: Path, *, until: datetime | None = None) -> int:
+        # Replaces all usages and states with those of a snapshot and returns
+        # their number. Usages and states older than `until` are left out.
+        store = _InMemoryStore(max_history=self._max_history)
+        restored = await asyncio.to_thread(store._restore, path, until)
+        self._replace_with(store)
+        return restored
+
+    async def close(self) -> None:
+        await self._close_snapshots()
+
+
+class SyncInMemoryRateLimitingRepo(_InMemoryStore, SyncRateLimitingRepo):
+    # A single lock guards everything. The policy check of add_usage_if_allowed
+    # runs while holding it, so it should be quick.
+
+    def __init__(self, *, max_history: int = 100) -> None:
+        super().__init__(max_history=max_history)
+        self._lock = threading.Lock()
+
+    def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        with self._lock:
+            return self._get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+
+    def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        with self._lock:
+            return {
+                (context_id, user_id): self._get_usages(
+                    context_id=context_id,
+                    user_id=user_id,
+                    limit=limit,
+                    since=since,
+                )
+                for context_id, user_id in keys
+            }
+
+    def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ) -> None:
+        usage = Usage(
             context_id=context_id,
             user_id=user_id,
             time=utc_time,
             reference_id=reference_id,
             response_id=response_id,
         )
+        with self._lock:
+            self._insert(usage)
+
+    def add_usages(self, usages: Iterable[Usage]) -> None:
+        with self._lock:
+            for usage in usages:
+                self._insert(usage)
+
+    def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: SyncUsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        with self._lock:
+            history = self._get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            offending_usage = check(history)
+            if offending_usage is None:
+                self._insert(
+                    Usage(
+                        context_id=context_id,
+                        user_id=user_id,
+                        time=utc_time,
+                        reference_id=reference_id,
+                        response_id=response_id,
+                    )
+                )
 
-    async def drop_old_usages(self, *, until: datetime) -> None:
-        for context in self._usage_time_by_user.values():
-            old = []
-            for user_id, usage in context.items():
-                if usage.time < until:
-                    old.append(user_id)
+        return offending_usage
 
-            for user_id in old:
-                del context[user_id]
+    def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        return self._get_state(context_id=context_id, user_id=user_id)
 
-    async def close(self) -> None:
+    def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        with self._lock:
+            return self._compare_and_set_state(
+                context_id=context_id,
+                user_id=user_id,
+                expected=expected,
+                state=state,
+            )
+
+    def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        with self._lock:
+            return self._drop_old_usages(until=until, limit=limit)
+
+    def snapshot(self, path: Path) -> None:
+        with self._lock:
+            columns = build_columns(self._snapshot_columns())
+        write_snapshot(path, columns)
+
+    def restore(self, path: Path, *, until: datetime | None = None) -> int:
+        store = _InMemoryStore(max_history=self._max_history)
+        restored = store._restore(path, until)
+        with self._lock:
+            self._replace_with(store)
+        return restored
+
+    def close(self) -> None:
         pass
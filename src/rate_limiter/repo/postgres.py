@@ -1,23 +1,67 @@
 import logging
-from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
-from datetime import datetime
+import time
+from collections.abc import AsyncGenerator, Iterable, Sequence
+from contextlib import asynccontextmanager, nullcontext
+from datetime import UTC, date, datetime, timedelta, tzinfo
 from typing import Self
 
 import psycopg
 import psycopg_pool
+from opentelemetry import metrics
+from psycopg import sql
 
-from .. import RateLimitingRepo, Usage
+from .. import (
+    DailyUsageCount,
+    RateLimitingRepo,
+    RateLimitingState,
+    Usage,
+    UsageCheck,
+)
+from ._daily_counts import aggregate_daily_counts
 
 _LOG = logging.getLogger(__name__)
+_meter = metrics.get_meter(__name__)
+
+_pool_wait = _meter.create_histogram(
+    "rate_limiter.postgres.pool.wait",
+    unit="s",
+    description="Time spent waiting for a connection from the pool",
+)
+
+# Passed instead of a missing `since`, so there's only one version of each query
+_MIN_TIME = datetime.min.replace(tzinfo=UTC)
+# How many days of usage partitions are created in advance
+_PARTITIONS_AHEAD = 7
+# Tables cleaned up by drop_old_usages, with their primary key and the column
+# that decides expiry
+_EXPIRING_TABLES = (
+    ("usages", ("context_id", "user_id", "time"), "time"),
+    ("daily_usage_counters", ("context_id", "user_id", "local_day"), "last_time"),
+    ("limiter_states", ("context_id", "user_id"), "last_time"),
+)
 
 
 class PostgresRateLimitingRepo(RateLimitingRepo):
+    # The queries on the hot path are executed with prepare=True, so each pooled
+    # connection parses and plans them only once.
+
     def __init__(
         self,
         connection_pool: psycopg_pool.AsyncConnectionPool[psycopg.AsyncConnection],
+        daily_count_timezone: tzinfo | None = None,
+        *,
+        drop_partitions: bool = False,
     ):
         self._pool = connection_pool
+        # Only usages added while this is set are counted
+        self._daily_count_timezone = daily_count_timezone
+        # If set, housekeeping drops whole daily partitions of expired usages
+        # before deleting the remaining expired rows. The rows in dropped
+        # partitions aren't counted by drop_old_usages, since that would take a
+        # scan of each partition.
+        self._drop_partitions = drop_partitions
+        # The `until` of the last housekeeping pass that maintained partitions
+        self._partitions_until: datetime | None = None
 
     @staticmethod
     def _instrument_psycopg() -> None:
@@ -40,13 +84,25 @@ class PostgresRateLimitingRepo(RateLimitingRepo):
         password: str,
         min_connections: int = 2,
         max_connections: int = 10,
+        daily_count_timezone: tzinfo | None = None,
+        prepare_threshold: int | None = 5,
+        prepared_max: int | None = 100,
+        drop_partitions: bool = False,
     ) -> Self:
+        # The hot queries are prepared on first use anyway. prepare_threshold
+        # only affects the other queries, and None disables prepared statements
+        # entirely (e.g. behind PgBouncer in transaction mode).
         cls._instrument_psycopg()
 
+        async def _configure(connection: psycopg.AsyncConnection) -> None:
+            connection.prepare_threshold = prepare_threshold
+            connection.prepared_max = prepared_max
+
         pool = psycopg_pool.AsyncConnectionPool(
             conninfo=f"postgresql://{username}:{password}@{host}:{port}/{database}",
             min_size=min_connections,
             max_size=max_connections,
+            configure=_configure,
             open=False,
         )
 
@@ -55,14 +111,115 @@ class PostgresRateLimitingRepo(RateLimitingRepo):
         async with pool.connection() as connection:
             await pool.check_connection(connection)
 
-        return cls(pool)
+        repo = cls(
+            pool,
+            daily_count_timezone=daily_count_timezone,
+            drop_partitions=drop_partitions,
+        )
+        await repo._create_partitions()
+        return repo
+
+    @property
+    def daily_count_timezone(self) -> tzinfo | None:
+        return self._daily_count_timezone
 
     @asynccontextmanager
-    async def _cursor(self) -> AsyncGenerator[psycopg.AsyncCursor, None]:
+    async def _cursor(
+        self,
+        *,
+        pipeline: bool = False,
+    ) -> AsyncGenerator[psycopg.AsyncCursor, None]:
+        # In pipeline mode, statements are only sent once a result is needed or
+        # the block ends, which saves round trips for consecutive writes.
+        requested = time.perf_counter()
         async with self._pool.connection() as conn:
-            async with conn.cursor() as cursor:
+            _pool_wait.record(time.perf_counter() - requested)
+            async with (
+                conn.pipeline() if pipeline else nullcontext(),
+                conn.cursor() as cursor,
+            ):
                 yield cursor
 
+    @staticmethod
+    async def _insert_usage(
+        cursor: psycopg.AsyncCursor,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ) -> None:
+        await cursor.execute(
+            """
+            INSERT INTO usages (
+                context_id,
+                user_id,
+                time,
+                reference_id,
+                response_id
+            )
+            VALUES (%s, %s, %s, %s, %s);
+            """,
+            [
+                context_id,
+                user_id,
+                utc_time,
+                reference_id,
+                response_id,
+            ],
+            prepare=True,
+        )
+
+    async def _count_usages(
+        self,
+        cursor: psycopg.AsyncCursor,
+        usages: Iterable[Usage],
+    ) -> None:
+        timezone = self._daily_count_timezone
+        if timezone is None:
+            return
+
+        await cursor.executemany(
+            """
+            INSERT INTO daily_usage_counters AS counters (
+                context_id,
+                user_id,
+                local_day,
+                usage_count,
+                last_time,
+                last_reference_id,
+                last_response_id
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (context_id, user_id, local_day) DO UPDATE SET
+                usage_count = counters.usage_count + excluded.usage_count,
+                last_time = greatest(counters.last_time, excluded.last_time),
+                last_reference_id = CASE
+                    WHEN excluded.last_time >= counters.last_time
+                    THEN excluded.last_reference_id
+                    ELSE counters.last_reference_id
+                END,
+                last_response_id = CASE
+                    WHEN excluded.last_time >= counters.last_time
+                    THEN excluded.last_response_id
+                    ELSE counters.last_response_id
+                END
+            """,
+            [
+                [
+                    increment.context_id,
+                    increment.user_id,
+                    increment.day,
+                    increment.count,
+                    increment.last_usage.time,
+                    increment.last_usage.reference_id,
+                    increment.last_usage.response_id,
+                ]
+                for increment in aggregate_daily_counts(usages, timezone)
+            ],
+        )
+
     async def add_usage(
         self,
         *,
@@ -72,27 +229,151 @@ class PostgresRateLimitingRepo(RateLimitingRepo):
         reference_id: str | None,
         response_id: str | None,
     ):
+        async with self._cursor(pipeline=True) as cursor:
+            await self._insert_usage(
+                cursor,
+                context_id=context_id,
+                user_id=user_id,
+                utc_time=utc_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
+            await self._count_usages(
+                cursor,
+                [
+                    Usage(
+                        context_id=context_id,
+                        user_id=user_id,
+                        time=utc_time,
+                        reference_id=reference_id,
+                        response_id=response_id,
+                    )
+                ],
+            )
+        _LOG.debug("Inserted usage for user %s in context %s", user_id, context_id)
+
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        usages = list(usages)
         async with self._cursor() as cursor:
-            await cursor.execute(
+            async with cursor.copy(
                 """
-                INSERT INTO usages (
+                COPY usages (
                     context_id,
                     user_id,
                     time,
                     reference_id,
                     response_id
                 )
-                VALUES (%s, %s, %s, %s, %s);
-                """,
-                [
-                    context_id,
-                    user_id,
-                    utc_time,
-                    reference_id,
-                    response_id,
-                ],
+                FROM STDIN
+                """
+            ) as copy:
+                for usage in usages:
+                    await copy.write_row(
+                        (
+                            usage.context_id,
+                            usage.user_id,
+                            usage.time,
+                            usage.reference_id,
+                            usage.response_id,
+                        )
+                    )
+
+            await self._count_usages(cursor, usages)
+
+        _LOG.debug("Inserted %d usages", len(usages))
+
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        async with self._pool.connection() as conn:
+            # The lock and the select are sent together, the insert is sent
+            # together with the commit.
+            async with conn.pipeline(), conn.transaction():
+                # Serializes concurrent acquisitions for the same key until the
+                # end of the transaction.
+                await conn.execute(
+                    "SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(%s))",
+                    [context_id, user_id],
+                    prepare=True,
+                )
+                async with conn.cursor() as cursor:
+                    history = await self._select_usages(
+                        cursor,
+                        context_id=context_id,
+                        user_id=user_id,
+                        limit=limit,
+                        since=since,
+                    )
+                    offending_usage = await check(history)
+                    if offending_usage is None:
+                        await self._insert_usage(
+                            cursor,
+                            context_id=context_id,
+                            user_id=user_id,
+                            utc_time=utc_time,
+                            reference_id=reference_id,
+                            response_id=response_id,
+                        )
+                        await self._count_usages(
+                            cursor,
+                            [
+                                Usage(
+                                    context_id=context_id,
+                                    user_id=user_id,
+                                    time=utc_time,
+                                    reference_id=reference_id,
+                                    response_id=response_id,
+                                )
+                            ],
+                        )
+
+        _LOG.debug(
+            "Usage for user %s in context %s was %s",
+            user_id,
+            context_id,
+            "denied" if offending_usage else "inserted",
+        )
+        return offending_usage
+
+    @staticmethod
+    async def _select_usages(
+        cursor: psycopg.AsyncCursor,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int,
+        since: datetime | None,
+    ) -> list[Usage]:
+        await cursor.execute(
+            """
+            SELECT time, reference_id, response_id FROM usages
+            WHERE context_id = %s AND user_id = %s AND time >= %s
+            ORDER BY time DESC
+            LIMIT %s
+            """,
+            [context_id, user_id, since or _MIN_TIME, limit],
+            prepare=True,
+        )
+
+        return [
+            Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=row[0],
+                reference_id=row[1],
+                response_id=row[2],
             )
-        _LOG.debug("Inserted usage for user %s in context %s", user_id, context_id)
+            for row in await cursor.fetchall()
+        ]
 
     async def get_usages(
         self,
@@ -100,29 +381,17 @@ class PostgresRateLimitingRepo(RateLimitingRepo):
         context_id: str,
         user_id: str,
         limit: int = 1,
+        since: datetime | None = None,
     ) -> list[Usage]:
         async with self._cursor() as cursor:
-            result = await cursor.execute(
-                """
-                SELECT time, reference_id, response_id FROM usages
-                WHERE context_id = %s AND user_id = %s
-                ORDER BY time DESC
-                LIMIT %s
-                """,
-                [context_id, user_id, limit],
+            usages = await self._select_usages(
+                cursor,
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
             )
 
-            usages = []
-            async for row in result:
-                usage = Usage(
-                    context_id=context_id,
-                    user_id=user_id,
-                    time=row[0],
-                    reference_id=row[1],
-                    response_id=row[2],
-                )
-                usages.append(usage)
-
         _LOG.debug(
             "Found %d usages for user %s in context %s (limit was %d)",
             len(usages),
@@ -133,15 +402,266 @@ class PostgresRateLimitingRepo(RateLimitingRepo):
 
         return usages
 
-    async def drop_old_usages(self, *, until: datetime) -> None:
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        usages: dict[tuple[str, str], list[Usage]] = {key: [] for key in keys}
+        if not usages:
+            return usages
+
+        async with self._cursor() as cursor:
+            await cursor.execute(
+                """
+                SELECT
+                    keys.context_id,
+                    keys.user_id,
+                    u.time,
+                    u.reference_id,
+                    u.response_id
+                FROM unnest(%s::text[], %s::text[]) AS keys(context_id, user_id)
+                CROSS JOIN LATERAL (
+                    SELECT time, reference_id, response_id FROM usages
+                    WHERE usages.context_id = keys.context_id
+                        AND usages.user_id = keys.user_id
+                        AND usages.time >= %s
+                    ORDER BY time DESC
+                    LIMIT %s
+                ) AS u
+                ORDER BY u.time DESC
+                """,
+                [
+                    [context_id for context_id, _ in usages],
+                    [user_id for _, user_id in usages],
+                    since or _MIN_TIME,
+                    limit,
+                ],
+                prepare=True,
+            )
+
+            async for row in cursor:
+                context_id, user_id = row[0], row[1]
+                usages[(context_id, user_id)].append(
+                    Usage(
+                        context_id=context_id,
+                        user_id=user_id,
+                        time=row[2],
+                        reference_id=row[3],
+                        response_id=row[4],
+                    )
+                )
+
+        _LOG.debug("Fetched usages for %d keys (limit was %d)", len(usages), limit)
+
+        return usages
+
+    async def get_daily_count(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        day: date,
+    ) -> DailyUsageCount:
+        if self._daily_count_timezone is None:
+            raise ValueError("Daily counts are not enabled for this repo")
+
+        async with self._cursor() as cursor:
+            await cursor.execute(
+                """
+                SELECT usage_count, last_time, last_reference_id, last_response_id
+                FROM daily_usage_counters
+                WHERE context_id = %s AND user_id = %s AND local_day = %s
+                """,
+                [context_id, user_id, day],
+                prepare=True,
+            )
+            row = await cursor.fetchone()
+
+        if row is None:
+            return DailyUsageCount(day=day, count=0, last_usage=None)
+
+        return DailyUsageCount(
+            day=day,
+            count=row[0],
+            last_usage=Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=row[1],
+                reference_id=row[2],
+                response_id=row[3],
+            ),
+        )
+
+    @property
+    def supports_states(self) -> bool:
+        return True
+
+    async def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
         async with self._cursor() as cursor:
             await cursor.execute(
                 """
-                DELETE FROM usages
-                WHERE time < %s
+                SELECT
+                    value,
+                    version,
+                    last_time,
+                    last_reference_id,
+                    last_response_id
+                FROM limiter_states
+                WHERE context_id = %s AND user_id = %s
                 """,
-                [until],
+                [context_id, user_id],
+                prepare=True,
+            )
+            row = await cursor.fetchone()
+
+        if row is None:
+            return None
+
+        return RateLimitingState(
+            value=row[0],
+            version=row[1],
+            last_usage=Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=row[2],
+                reference_id=row[3],
+                response_id=row[4],
+            ),
+        )
+
+    async def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        last_usage = state.last_usage
+        async with self._cursor() as cursor:
+            if expected is None:
+                await cursor.execute(
+                    """
+                    INSERT INTO limiter_states (
+                        context_id,
+                        user_id,
+                        value,
+                        version,
+                        last_time,
+                        last_reference_id,
+                        last_response_id
+                    )
+                    VALUES (%s, %s, %s, 0, %s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                    """,
+                    [
+                        context_id,
+                        user_id,
+                        state.value,
+                        last_usage.time,
+                        last_usage.reference_id,
+                        last_usage.response_id,
+                    ],
+                    prepare=True,
+                )
+            else:
+                await cursor.execute(
+                    """
+                    UPDATE limiter_states SET
+                        value = %s,
+                        version = version + 1,
+                        last_time = %s,
+                        last_reference_id = %s,
+                        last_response_id = %s
+                    WHERE context_id = %s AND user_id = %s AND version = %s
+                    """,
+                    [
+                        state.value,
+                        last_usage.time,
+                        last_usage.reference_id,
+                        last_usage.response_id,
+                        context_id,
+                        user_id,
+                        expected.version,
+                    ],
+                    prepare=True,
+                )
+
+            return cursor.rowcount == 1
+
+    async def _create_partitions(self) -> None:
+        # The usages table is partitioned by UTC day. Usages for days without a
+        # partition end up in the default partition, so we stay ahead.
+        today = datetime.now(UTC).date()
+        async with self._cursor() as cursor:
+            await cursor.execute(
+                "SELECT create_usage_partitions(%s, %s)",
+                [today, today + timedelta(days=_PARTITIONS_AHEAD)],
             )
+            row = await cursor.fetchone()
+
+        if row and row[0]:
+            _LOG.info("Created %d usage partitions", row[0])
+
+    async def _maintain_partitions(self, until: datetime) -> None:
+        await self._create_partitions()
+        if not self._drop_partitions:
+            return
+
+        # Rows in dropped partitions are not counted
+        async with self._cursor() as cursor:
+            await cursor.execute("SELECT drop_usage_partitions(%s)", [until])
+            row = await cursor.fetchone()
+
+        _LOG.info("Dropped %d usage partitions", row[0] if row else 0)
+
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        # A chunked housekeeping pass calls this with the same `until` until
+        # nothing is left, but partitions only need maintaining once per pass
+        if until != self._partitions_until:
+            await self._maintain_partitions(until)
+            self._partitions_until = until
+
+        # Only the partitions overlapping `until` (and the default partition)
+        # are left to scan.
+        dropped = 0
+        async with self._cursor() as cursor:
+            for table, key_columns, time_column in _EXPIRING_TABLES:
+                keys = sql.SQL(", ").join(map(sql.Identifier, key_columns))
+                await cursor.execute(
+                    sql.SQL(
+                        """
+                        DELETE FROM {table}
+                        WHERE ({keys}) IN (
+                            SELECT {keys} FROM {table}
+                            WHERE {time_column} < %s
+                            LIMIT %s
+                        )
+                        """
+                    ).format(
+                        table=sql.Identifier(table),
+                        keys=keys,
+                        time_column=sql.Identifier(time_column),
+                    ),
+                    [until, limit],
+                )
+                dropped += cursor.rowcount
+
+        _LOG.debug("Dropped %d rows older than %s", dropped, until)
+        return dropped
 
     async def close(self) -> None:
         await self._pool.close()
@@ -0,0 +1,399 @@
+import json
+import logging
+import secrets
+from collections.abc import Iterable, Sequence
+from datetime import UTC, datetime, timedelta
+from typing import Self
+
+import redis.asyncio as redis
+
+from .. import RateLimitingRepo, RateLimitingState, Usage, UsageCheck
+
+_LOG = logging.getLogger(__name__)
+
+# Records a usage, but only if the key's version is still the expected one. The
+# policy itself is not evaluated here, see RedisRateLimitingRepo.
+# KEYS: usages, version
+# ARGV: expected version ('' to skip the check), score, member, max history,
+#       min score, TTL in milliseconds
+_RECORD_IF_UNCHANGED_SCRIPT = """
+if ARGV[1] ~= '' and (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[4]) - 1)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[5])
+redis.call('INCR', KEYS[2])
+redis.call('PEXPIRE', KEYS[1], ARGV[6])
+redis.call('PEXPIRE', KEYS[2], ARGV[6])
+return 1
+"""
+
+# KEYS: state
+# ARGV: expected version ('' if there should be no state), value, last usage,
+#       TTL in milliseconds
+_COMPARE_AND_SET_SCRIPT = """
+local version = redis.call('HGET', KEYS[1], 'version')
+if ARGV[1] == '' then
+    if version then
+        return 0
+    end
+    version = 0
+elseif version ~= ARGV[1] then
+    return 0
+else
+    version = tonumber(version) + 1
+end
+redis.call(
+    'HSET', KEYS[1], 'version', version, 'value', ARGV[2], 'last_usage', ARGV[3]
+)
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+_EPOCH = datetime.fromtimestamp(0, tz=UTC)
+
+
+def _to_micros(time: datetime) -> int:
+    # Exact as a sorted set score, unlike float timestamps
+    return (time - _EPOCH) // timedelta(microseconds=1)
+
+
+class RedisRateLimitingRepo(RateLimitingRepo):
+    # Keeps the newest `max_history` usages of each key in a sorted set scored
+    # by time. Every write extends the key's TTL and removes usages older than
+    # the TTL, so there's nothing for drop_old_usages to do. The TTL must be at
+    # least as long as the longest period any policy looks at.
+    #
+    # add_usage_if_allowed reads the history together with a per-key version
+    # and records the usage with a script that only succeeds if the version is
+    # unchanged, retrying otherwise. Policies are opaque checks to the repo, so
+    # they run in Python and this takes two round trips instead of one. The
+    # script only makes the record conditional, it doesn't evaluate policies.
+    #
+    # All keys of a (context_id, user_id) pair share a hash tag, so the scripts
+    # work on Redis Cluster as well.
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        *,
+        ttl: timedelta,
+        max_history: int = 100,
+        key_prefix: str = "rate_limiter:",
+    ):
+        if ttl <= timedelta(0):
+            raise ValueError(f"TTL must be positive, but was {ttl}")
+        if max_history < 1:
+            raise ValueError(f"Max history must be positive, but was {max_history}")
+
+        self._client = client
+        self._ttl = ttl
+        self._max_history = max_history
+        self._key_prefix = key_prefix
+        self._record_script = client.register_script(_RECORD_IF_UNCHANGED_SCRIPT)
+        self._compare_and_set_script = client.register_script(_COMPARE_AND_SET_SCRIPT)
+
+    @classmethod
+    async def connect(
+        cls,
+        *,
+        host: str,
+        port: int = 6379,
+        database: int = 0,
+        username: str | None = None,
+        password: str | None = None,
+        max_connections: int = 10,
+        ttl: timedelta,
+        max_history: int = 100,
+        key_prefix: str = "rate_limiter:",
+    ) -> Self:
+        pool = redis.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=database,
+            username=username,
+            password=password,
+            max_connections=max_connections,
+            decode_responses=True,
+        )
+        client = redis.Redis.from_pool(pool)
+        await client.ping()
+        return cls(
+            client,
+            ttl=ttl,
+            max_history=max_history,
+            key_prefix=key_prefix,
+        )
+
+    def _key(self, kind: str, context_id: str, user_id: str) -> str:
+        # JSON keeps arbitrary IDs apart. The braces make it the hash tag, so
+        # Redis Cluster puts all keys of a pair into the same slot.
+        return f"{self._key_prefix}{kind}:{{{json.dumps([context_id, user_id])}}}"
+
+    @staticmethod
+    def _encode_usage(usage: Usage) -> str:
+        # The random suffix keeps identical usages from collapsing into one member
+        return json.dumps(
+            [
+                _to_micros(usage.time),
+                usage.reference_id,
+                usage.response_id,
+                secrets.token_hex(4),
+            ]
+        )
+
+    @staticmethod
+    def _decode_usage(context_id: str, user_id: str, member: str | bytes) -> Usage:
+        micros, reference_id, response_id, _ = json.loads(member)
+        return Usage(
+            context_id=context_id,
+            user_id=user_id,
+            time=_EPOCH + timedelta(microseconds=micros),
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+
+    def _check_limit(self, limit: int) -> None:
+        if limit > self._max_history:
+            raise ValueError(
+                f"Requested {limit} usages, but only the last {self._max_history}"
+                " are kept"
+            )
+
+    def _record_args(self, usage: Usage, expected_version: str) -> list[str | int]:
+        return [
+            expected_version,
+            _to_micros(usage.time),
+            self._encode_usage(usage),
+            self._max_history,
+            _to_micros(usage.time - self._ttl),
+            self._ttl // timedelta(milliseconds=1),
+        ]
+
+    async def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ):
+        await self.add_usages(
+            [
+                Usage(
+                    context_id=context_id,
+                    user_id=user_id,
+                    time=utc_time,
+                    reference_id=reference_id,
+                    response_id=response_id,
+                )
+            ]
+        )
+
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        count = 0
+        async with self._client.pipeline(transaction=False) as pipe:
+            for usage in usages:
+                await self._record_script(
+                    keys=[
+                        self._key("usages", usage.context_id, usage.user_id),
+                        self._key("version", usage.context_id, usage.user_id),
+                    ],
+                    args=self._record_args(usage, expected_version=""),
+                    client=pipe,
+                )
+                count += 1
+            await pipe.execute()
+
+        _LOG.debug("Inserted %d usages", count)
+
+    async def _select_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int,
+        since: datetime | None,
+    ) -> tuple[str, list[Usage]]:
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.get(self._key("version", context_id, user_id))
+            pipe.zrevrangebyscore(
+                self._key("usages", context_id, user_id),
+                "+inf",
+                "-inf" if since is None else _to_micros(since),
+                start=0,
+                num=limit,
+            )
+            version, members = await pipe.execute()
+
+        usages = [self._decode_usage(context_id, user_id, member) for member in members]
+        return version or "0", usages
+
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        self._check_limit(limit)
+        usage = Usage(
+            context_id=context_id,
+            user_id=user_id,
+            time=utc_time,
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+        keys = [
+            self._key("usages", context_id, user_id),
+            self._key("version", context_id, user_id),
+        ]
+        while True:
+            version, history = await self._select_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            offending_usage = await check(history)
+            if offending_usage is not None:
+                _LOG.debug(
+                    "Usage for user %s in context %s was denied",
+                    user_id,
+                    context_id,
+                )
+                return offending_usage
+
+            if await self._record_script(
+                keys=keys,
+                args=self._record_args(usage, expected_version=version),
+            ):
+                _LOG.debug(
+                    "Usage for user %s in context %s was inserted",
+                    user_id,
+                    context_id,
+                )
+                return None
+
+            _LOG.debug(
+                "History of user %s in context %s was changed concurrently, retrying",
+                user_id,
+                context_id,
+            )
+
+    async def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        self._check_limit(limit)
+        _, usages = await self._select_usages(
+            context_id=context_id,
+            user_id=user_id,
+            limit=limit,
+            since=since,
+        )
+
+        _LOG.debug(
+            "Found %d usages for user %s in context %s (limit was %d)",
+            len(usages),
+            user_id,
+            context_id,
+            limit,
+        )
+
+        return usages
+
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        self._check_limit(limit)
+        unique_keys = list(dict.fromkeys(keys))
+        async with self._client.pipeline(transaction=False) as pipe:
+            for context_id, user_id in unique_keys:
+                pipe.zrevrangebyscore(
+                    self._key("usages", context_id, user_id),
+                    "+inf",
+                    "-inf" if since is None else _to_micros(since),
+                    start=0,
+                    num=limit,
+                )
+            results = await pipe.execute()
+
+        usages = {
+            (context_id, user_id): [
+                self._decode_usage(context_id, user_id, member) for member in members
+            ]
+            for (context_id, user_id), members in zip(unique_keys, results)
+        }
+
+        _LOG.debug("Fetched usages for %d keys (limit was %d)", len(usages), limit)
+
+        return usages
+
+    @property
+    def supports_states(self) -> bool:
+        return True
+
+    async def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        fields = await self._client.hgetall(self._key("state", context_id, user_id))
+        if not fields:
+            return None
+
+        return RateLimitingState(
+            value=float(fields["value"]),
+            version=int(fields["version"]),
+            last_usage=self._decode_usage(context_id, user_id, fields["last_usage"]),
+        )
+
+    async def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        result = await self._compare_and_set_script(
+            keys=[self._key("state", context_id, user_id)],
+            args=[
+                "" if expected is None else str(expected.version),
+                repr(state.value),
+                self._encode_usage(state.last_usage),
+                self._ttl // timedelta(milliseconds=1),
+            ],
+        )
+        return bool(result)
+
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        # Old usages are trimmed on write and idle keys expire on their own
+        _LOG.debug("Not dropping usages, Redis expires them by TTL")
+        return 0
+
+    async def close(self) -> None:
+        await self._client.aclose()
@@ -0,0 +1,641 @@
+import asyncio
+import bisect
+import heapq
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+from collections import deque
+from collections.abc import Iterable, Sequence
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+from .. import RateLimitingRepo, Usage, UsageCheck
+from ._locking import KeyedLock
+
+_LOG = logging.getLogger(__name__)
+
+_MAGIC = b"RLLOG002"
+# magic, max key length, max ID length
+_HEADER = struct.Struct("<8sHH")
+_HEADER_SIZE = 64
+# CRC32 of the rest of the record
+_CHECKSUM = struct.Struct("<I")
+# Marks a missing reference or response ID
+_NO_ID = 0xFF
+# Marks a record that isn't a copy made by compaction
+_NO_SOURCE = -1
+_SUFFIX = ".seg"
+# Sealed segments with at most this share of live records are compacted
+_COMPACTION_THRESHOLD = 0.5
+
+_EPOCH = datetime.fromtimestamp(0, tz=UTC)
+
+
+def _to_micros(time: datetime) -> int:
+    return (time - _EPOCH) // timedelta(microseconds=1)
+
+
+@dataclass(kw_only=True)
+class _Segment:
+    number: int
+    path: Path
+    map: mmap.mmap
+    # Where the next record goes
+    end: int
+    # Records that are still referenced by the index
+    live: int = 0
+
+
+class SegmentLogRateLimitingRepo(RateLimitingRepo):
+    # Appends usages as fixed-width records to a log of memory-mapped segment
+    # files in `directory`, so an insert is a single memory write. The newest
+    # `max_history` usages of each key are found through an in-memory index of
+    # record offsets, which is rebuilt by scanning the segments on startup.
+    #
+    # Records are never updated in place. drop_old_usages removes old usages
+    # from the index and deletes segments that have no live records left. After
+    # that, it moves the live records of the sparsest segment to the end of the
+    # log, `limit` records per call, so the segment can be deleted as well. Each
+    # copy remembers where it was copied from, so if the original is still
+    # around on startup, the copy replaces it instead of counting twice. Copies
+    # are written back to disk before their original is deleted.
+    #
+    # Dirty segments are written back to disk `fsync_interval` after a write,
+    # so a crash loses at most that much. Zero writes back after every insert
+    # (blocking the event loop), None leaves it to the operating system. Every
+    # record has a checksum, so a torn write at the end of the log is ignored.
+    #
+    # Only one process may use a directory at a time. IDs and keys are stored in
+    # fixed-width fields, longer ones are rejected. Daily counts and states are
+    # not supported.
+
+    def __init__(
+        self,
+        directory: Path,
+        *,
+        segment_size: int = 16 * 2**20,
+        max_history: int = 100,
+        fsync_interval: timedelta | None = timedelta(seconds=1),
+        max_key_length: int = 128,
+        max_id_length: int = 36,
+    ) -> None:
+        if max_history < 1:
+            raise ValueError(f"Max history must be positive, but was {max_history}")
+        if not 0 < max_key_length < 2**16:
+            raise ValueError(
+                f"Max key length must be in [1, 65535], but was {max_key_length}"
+            )
+        if not 0 <= max_id_length < _NO_ID:
+            raise ValueError(
+                f"Max ID length must be in [0, {_NO_ID - 1}], but was {max_id_length}"
+            )
+        if fsync_interval is not None and fsync_interval < timedelta(0):
+            raise ValueError(
+                f"Fsync interval may not be negative, but was {fsync_interval}"
+            )
+
+        # time, source segment number and position, key length and bytes,
+        # reference ID length and bytes, response ID length and bytes
+        self._body = struct.Struct(
+            f"<qqIH{max_key_length}sB{max_id_length}sB{max_id_length}s"
+        )
+        self._record_size = _CHECKSUM.size + self._body.size
+        records_per_segment = (segment_size - _HEADER_SIZE) // self._record_size
+        if records_per_segment < 1:
+            raise ValueError(
+                f"Segment size must be at least {_HEADER_SIZE + self._record_size}"
+                f" bytes, but was {segment_size}"
+            )
+
+        self._directory = directory
+        self._segment_size = _HEADER_SIZE + records_per_segment * self._record_size
+        self._max_history = max_history
+        self._fsync_interval = (
+            None if fsync_interval is None else fsync_interval.total_seconds()
+        )
+        self._max_key_length = max_key_length
+        self._max_id_length = max_id_length
+        self._header = _HEADER.pack(_MAGIC, max_key_length, max_id_length)
+
+        # Record offsets (time, segment number, position) per key, oldest first
+        self._usages: dict[tuple[str, str], deque[tuple[int, int, int]]] = {}
+        # A heap with one entry per key pointing at the key's oldest usage, like
+        # in the in-memory repo
+        self._expiry_index: list[tuple[int, tuple[str, str]]] = []
+        self._indexed_times: dict[tuple[str, str], int] = {}
+        self._segments: dict[int, _Segment] = {}
+        # The segment that is being compacted and the position to continue at
+        self._compaction: tuple[int, int] | None = None
+        # Segments with writes that haven't been flushed yet or are being flushed
+        # right now. They must not be deleted.
+        self._dirty: set[int] = set()
+        self._flushing: set[int] = set()
+        self._flusher: asyncio.Task[None] | None = None
+        self._closing = asyncio.Event()
+        self._locks: KeyedLock[tuple[str, str]] = KeyedLock()
+
+        directory.mkdir(parents=True, exist_ok=True)
+        try:
+            self._load()
+        except BaseException:
+            self._close_segments()
+            raise
+
+    def _load(self) -> None:
+        paths = sorted(
+            self._directory.glob(f"*{_SUFFIX}"),
+            key=lambda path: int(path.stem),
+        )
+        for path in paths:
+            with path.open("r+b") as file:
+                segment_map = mmap.mmap(file.fileno(), 0)
+            segment = _Segment(
+                number=int(path.stem),
+                path=path,
+                map=segment_map,
+                end=_HEADER_SIZE,
+            )
+            self._segments[segment.number] = segment
+            if segment_map[: _HEADER.size] != self._header:
+                raise ValueError(
+                    f"{path} was written with different parameters or is not a"
+                    " rate limiting log segment"
+                )
+            self._scan(segment)
+
+        if self._segments:
+            self._active = self._segments[max(self._segments)]
+        else:
+            self._active = self._create_segment(0)
+
+        _LOG.info(
+            "Loaded %d keys from %d log segments in %s",
+            len(self._usages),
+            len(self._segments),
+            self._directory,
+        )
+
+    def _scan(self, segment: _Segment) -> None:
+        segment_map = segment.map
+        size = self._record_size
+        for position in range(_HEADER_SIZE, len(segment_map) - size + 1, size):
+            record = self._read_record(segment_map, position)
+            if record is None:
+                if segment_map[position : position + size].strip(b"\0"):
+                    # Anything after a torn record could reappear once the
+                    # record is overwritten
+                    _LOG.warning(
+                        "Ignoring torn records from position %d of %s",
+                        position,
+                        segment.path,
+                    )
+                    segment_map[position:] = bytes(len(segment_map) - position)
+                break
+
+            key, micros, source = record
+            if source is None or source[0] not in self._segments:
+                self._index_record(key, micros, segment, position)
+            else:
+                # Compaction was interrupted before the original was deleted
+                self._move_entry(key, source, segment, position)
+            segment.end = position + size
+
+    def _create_segment(self, number: int) -> _Segment:
+        path = self._directory / f"{number:010d}{_SUFFIX}"
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.ftruncate(fd, self._segment_size)
+            segment_map = mmap.mmap(fd, self._segment_size)
+        finally:
+            os.close(fd)
+
+        segment_map[: _HEADER.size] = self._header
+        segment = _Segment(number=number, path=path, map=segment_map, end=_HEADER_SIZE)
+        self._segments[number] = segment
+        self._dirty.add(number)
+        _LOG.debug("Started log segment %s", path)
+        return segment
+
+    def _read_record(
+        self,
+        segment_map: mmap.mmap,
+        position: int,
+    ) -> tuple[tuple[str, str], int, tuple[int, int] | None] | None:
+        # Returns the key, time and source (if it's a copy) of a valid record
+        (checksum,) = _CHECKSUM.unpack_from(segment_map, position)
+        body_start = position + _CHECKSUM.size
+        body = segment_map[body_start : body_start + self._body.size]
+        if zlib.crc32(body) != checksum:
+            return None
+
+        micros, source_number, source_position, key_length, key, *_ = self._body.unpack(
+            body
+        )
+        context_id, user_id = json.loads(key[:key_length])
+        source = (
+            None if source_number == _NO_SOURCE else (source_number, source_position)
+        )
+        return (context_id, user_id), micros, source
+
+    def _decode(
+        self,
+        context_id: str,
+        user_id: str,
+        number: int,
+        position: int,
+    ) -> Usage:
+        fields = self._body.unpack_from(
+            self._segments[number].map,
+            position + _CHECKSUM.size,
+        )
+        micros = fields[0]
+        reference_length, reference_id, response_length, response_id = fields[5:]
+        return Usage(
+            context_id=context_id,
+            user_id=user_id,
+            time=_EPOCH + timedelta(microseconds=micros),
+            reference_id=(
+                None
+                if reference_length == _NO_ID
+                else reference_id[:reference_length].decode()
+            ),
+            response_id=(
+                None
+                if response_length == _NO_ID
+                else response_id[:response_length].decode()
+            ),
+        )
+
+    def _encode_id(self, value: str | None) -> tuple[int, bytes]:
+        if value is None:
+            return _NO_ID, b""
+        encoded = value.encode()
+        if len(encoded) > self._max_id_length:
+            raise ValueError(f"ID {value} is longer than {self._max_id_length} bytes")
+        return len(encoded), encoded
+
+    def _encode(self, usage: Usage) -> bytes:
+        key = json.dumps([usage.context_id, usage.user_id]).encode()
+        if len(key) > self._max_key_length:
+            raise ValueError(
+                f"Key of user {usage.user_id} in context {usage.context_id} is"
+                f" longer than {self._max_key_length} bytes"
+            )
+
+        body = self._body.pack(
+            _to_micros(usage.time),
+            _NO_SOURCE,
+            0,
+            len(key),
+            key,
+            *self._encode_id(usage.reference_id),
+            *self._encode_id(usage.response_id),
+        )
+        return _CHECKSUM.pack(zlib.crc32(body)) + body
+
+    def _copy(self, segment: _Segment, position: int) -> bytes:
+        # The record at `position`, marked as a copy of it
+        body_start = position + _CHECKSUM.size
+        fields = list(self._body.unpack_from(segment.map, body_start))
+        fields[1:3] = segment.number, position
+        body = self._body.pack(*fields)
+        return _CHECKSUM.pack(zlib.crc32(body)) + body
+
+    def _append(self, record: bytes) -> tuple[_Segment, int]:
+        segment = self._active
+        if segment.end + self._record_size > len(segment.map):
+            segment = self._create_segment(segment.number + 1)
+            self._active = segment
+
+        position = segment.end
+        segment.map[position : position + self._record_size] = record
+        segment.end += self._record_size
+        self._dirty.add(segment.number)
+        return segment, position
+
+    def _index_record(
+        self,
+        key: tuple[str, str],
+        micros: int,
+        segment: _Segment,
+        position: int,
+    ) -> None:
+        entries = self._usages.get(key)
+        if entries is None:
+            entries = deque()
+            self._usages[key] = entries
+
+        entry = (micros, segment.number, position)
+        if not entries or entries[-1][0] <= micros:
+            entries.append(entry)
+        else:
+            # Usages are usually added in order, so this is the rare case
+            if len(entries) == self._max_history and micros < entries[0][0]:
+                # Too old to be part of the history anyway
+                return
+            index = bisect.bisect_right(entries, micros, key=lambda e: e[0])
+            entries.insert(index, entry)
+
+        segment.live += 1
+        if len(entries) > self._max_history:
+            _, number, _ = entries.popleft()
+            self._segments[number].live -= 1
+
+        indexed_time = self._indexed_times.get(key)
+        if indexed_time is None or entries[0][0] < indexed_time:
+            # An older entry for this key becomes stale and is skipped when popped
+            self._indexed_times[key] = entries[0][0]
+            heapq.heappush(self._expiry_index, (entries[0][0], key))
+
+    def _move_entry(
+        self,
+        key: tuple[str, str],
+        source: tuple[int, int],
+        target: _Segment,
+        target_position: int,
+    ) -> None:
+        # Points the index entry of the record at `source` to its copy. Nothing
+        # happens if that record isn't indexed (anymore).
+        entries = self._usages.get(key)
+        if entries is None:
+            return
+
+        number, position = source
+        for index, (micros, entry_number, entry_position) in enumerate(entries):
+            if entry_number == number and entry_position == position:
+                entries[index] = (micros, target.number, target_position)
+                self._segments[number].live -= 1
+                target.live += 1
+                return
+
+    def _insert(self, usage: Usage) -> None:
+        segment, position = self._append(self._encode(usage))
+        self._index_record(
+            (usage.context_id, usage.user_id),
+            _to_micros(usage.time),
+            segment,
+            position,
+        )
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._fsync_interval is None:
+            # Nothing to wait for before segments may be deleted
+            self._dirty.clear()
+            return
+
+        if not self._fsync_interval:
+            for number in self._dirty:
+                self._segments[number].map.flush()
+            self._dirty.clear()
+        elif self._flusher is None:
+            self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def _run_flusher(self) -> None:
+        assert self._fsync_interval is not None
+        try:
+            while self._dirty:
+                # close() cuts the wait short, but not the flush itself
+                with suppress(TimeoutError):
+                    await asyncio.wait_for(
+                        self._closing.wait(),
+                        self._fsync_interval,
+                    )
+                self._flushing, self._dirty = self._dirty, set()
+                maps = [self._segments[number].map for number in self._flushing]
+                try:
+                    await asyncio.to_thread(_flush_maps, maps)
+                except Exception:
+                    # There's nobody to report this to
+                    _LOG.exception("Could not flush %d log segments", len(maps))
+                finally:
+                    self._flushing = set()
+        finally:
+            self._flusher = None
+
+    def _check_limit(self, limit: int) -> None:
+        if limit > self._max_history:
+            raise ValueError(
+                f"Requested {limit} usages, but only the last {self._max_history}"
+                " are kept"
+            )
+
+    async def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ):
+        self._insert(
+            Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=utc_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
+        )
+
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        for usage in usages:
+            self._insert(usage)
+
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        async with self._locks.hold((context_id, user_id)):
+            history = await self.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            offending_usage = await check(history)
+            if offending_usage is None:
+                await self.add_usage(
+                    context_id=context_id,
+                    user_id=user_id,
+                    utc_time=utc_time,
+                    reference_id=reference_id,
+                    response_id=response_id,
+                )
+
+        return offending_usage
+
+    async def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        self._check_limit(limit)
+        entries = self._usages.get((context_id, user_id))
+        if not entries:
+            return []
+
+        min_time = None if since is None else _to_micros(since)
+        usages = []
+        for micros, number, position in itertools.islice(reversed(entries), limit):
+            if min_time is not None and micros < min_time:
+                break
+            usages.append(self._decode(context_id, user_id, number, position))
+
+        return usages
+
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        return {
+            (context_id, user_id): await self.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            for context_id, user_id in keys
+        }
+
+    def _is_deletable(self, segment: _Segment) -> bool:
+        return (
+            segment is not self._active
+            and segment.number not in self._dirty
+            and segment.number not in self._flushing
+        )
+
+    def _delete_dead_segments(self) -> None:
+        for segment in list(self._segments.values()):
+            if segment.live or not self._is_deletable(segment):
+                continue
+
+            if self._compaction is not None and self._compaction[0] == segment.number:
+                self._compaction = None
+            del self._segments[segment.number]
+            segment.map.close()
+            segment.path.unlink()
+            _LOG.debug("Deleted log segment %s", segment.path)
+
+    def _compact(self, limit: int | None) -> set[int]:
+        # Moves the live records of a sparse segment to the end of the log and
+        # returns the segments the copies went to
+        copied_to: set[int] = set()
+        if self._compaction is None:
+            candidates = [
+                segment
+                for segment in self._segments.values()
+                if self._is_deletable(segment)
+                and segment.live
+                <= _COMPACTION_THRESHOLD
+                * ((segment.end - _HEADER_SIZE) // self._record_size)
+            ]
+            if not candidates:
+                return copied_to
+            target = min(candidates, key=lambda segment: segment.live)
+            self._compaction = (target.number, _HEADER_SIZE)
+            _LOG.debug(
+                "Compacting log segment %s with %d live records",
+                target.path,
+                target.live,
+            )
+
+        number, start = self._compaction
+        segment = self._segments[number]
+        size = self._record_size
+        stop = segment.end if limit is None else min(segment.end, start + limit * size)
+        for position in range(start, stop, size):
+            record = self._read_record(segment.map, position)
+            if record is None:
+                continue
+
+            key, micros, _ = record
+            entries = self._usages.get(key)
+            if entries is not None and (micros, number, position) in entries:
+                target, target_position = self._append(self._copy(segment, position))
+                self._move_entry(key, (number, position), target, target_position)
+                copied_to.add(target.number)
+
+        self._compaction = None if stop == segment.end else (number, stop)
+        self._schedule_flush()
+        return copied_to
+
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        until_micros = _to_micros(until)
+        dropped = 0
+        while self._expiry_index and self._expiry_index[0][0] < until_micros:
+            if limit is not None and dropped >= limit:
+                break
+
+            micros, key = heapq.heappop(self._expiry_index)
+            if self._indexed_times.get(key) != micros:
+                continue
+
+            entries = self._usages[key]
+            while entries and entries[0][0] < until_micros:
+                if limit is not None and dropped >= limit:
+                    break
+                _, number, _ = entries.popleft()
+                self._segments[number].live -= 1
+                dropped += 1
+
+            if entries:
+                self._indexed_times[key] = entries[0][0]
+                heapq.heappush(self._expiry_index, (entries[0][0], key))
+            else:
+                del self._usages[key]
+                del self._indexed_times[key]
+
+        self._delete_dead_segments()
+        copied_to = self._compact(limit)
+        if copied_to and self._fsync_interval:
+            # The copies have to be on disk before their originals are deleted,
+            # or a crash would lose usages that were already durable
+            maps = [self._segments[number].map for number in copied_to]
+            await asyncio.to_thread(_flush_maps, maps)
+        self._delete_dead_segments()
+
+        _LOG.debug("Dropped %d usages older than %s", dropped, until)
+        return dropped
+
+    def _close_segments(self) -> None:
+        for segment in self._segments.values():
+            segment.map.close()
+        self._segments.clear()
+
+    async def close(self) -> None:
+        self._closing.set()
+        if self._flusher is not None:
+            await self._flusher
+        self._close_segments()
+
+
+def _flush_maps(maps: list[mmap.mmap]) -> None:
+    for segment_map in maps:
+        segment_map.flush()
@@ -0,0 +1,541 @@
+import asyncio
+import bisect
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from collections.abc import AsyncGenerator, Iterable, Sequence
+from contextlib import asynccontextmanager
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+from .. import RateLimitingRepo, Usage, UsageCheck
+
+_LOG = logging.getLogger(__name__)
+
+_MAGIC = b"RLSHM001"
+# magic, slots per stripe, stripes, max history, max key length, max ID length
+_HEADER = struct.Struct("<8sIIHHH")
+# The header gets a page of its own, so the slots are page aligned
+_HEADER_SIZE = mmap.PAGESIZE
+# state, key length, count, head, key hash
+_SLOT_HEADER = struct.Struct("<BxHHHxxQ")
+_EMPTY = 0
+_USED = 1
+_DELETED = 2
+# Marks a missing reference or response ID
+_NO_ID = 0xFF
+# How long to wait before trying again to get a stripe lock held by another
+# process
+_LOCK_RETRY_SECONDS = 0.0002
+
+_EPOCH = datetime.fromtimestamp(0, tz=UTC)
+
+
+def _to_micros(time: datetime) -> int:
+    return (time - _EPOCH) // timedelta(microseconds=1)
+
+
+def _hash_key(key: bytes) -> int:
+    # Python's hash() differs between processes
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class SharedMemoryRateLimitingRepo(RateLimitingRepo):
+    # Keeps the newest `max_history` usages per key in a fixed-size hash table in
+    # a memory-mapped file, so all processes on a host that open the same file
+    # share their usages. Put the file on a tmpfs like /dev/shm to never touch
+    # the disk. The file outlives the processes, so restarts keep their state.
+    #
+    # The table is split into `stripes` segments. A key's hash picks its
+    # segment and its home slot within that segment, collisions are resolved by
+    # linear probing inside the segment. Every access holds the segment's lock,
+    # which is an fcntl lock on one byte of the file (between processes) plus an
+    # asyncio lock (between coroutines of this process). Stripe locks are polled
+    # instead of waited for, so the event loop never blocks.
+    #
+    # IDs and keys are stored in fixed-width fields, longer ones are rejected.
+    # Usage times are kept with microsecond precision. Daily counts and states
+    # are not supported.
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        capacity: int = 10_000,
+        max_history: int = 10,
+        stripes: int = 16,
+        max_key_length: int = 128,
+        max_id_length: int = 36,
+    ) -> None:
+        if capacity < 1:
+            raise ValueError(f"Capacity must be positive, but was {capacity}")
+        if not 0 < max_history < 2**16:
+            raise ValueError(
+                f"Max history must be in [1, 65535], but was {max_history}"
+            )
+        if not 0 < stripes <= capacity:
+            raise ValueError(
+                f"Stripes must be in [1, capacity], but was {stripes} for a"
+                f" capacity of {capacity}"
+            )
+        if not 0 < max_key_length < 2**16:
+            raise ValueError(
+                f"Max key length must be in [1, 65535], but was {max_key_length}"
+            )
+        if not 0 <= max_id_length < _NO_ID:
+            raise ValueError(
+                f"Max ID length must be in [0, {_NO_ID - 1}], but was {max_id_length}"
+            )
+
+        self._slots_per_stripe = -(-capacity // stripes)
+        self._stripes = stripes
+        self._max_history = max_history
+        self._max_key_length = max_key_length
+        self._max_id_length = max_id_length
+        # time, reference ID length and bytes, response ID length and bytes
+        self._entry = struct.Struct(f"<qB{max_id_length}sB{max_id_length}s")
+        self._entries_offset = _SLOT_HEADER.size + max_key_length
+        slot_size = self._entries_offset + max_history * self._entry.size
+        # Keep the int64 fields aligned
+        self._slot_size = -(-slot_size // 8) * 8
+        size = _HEADER_SIZE + self._slot_size * self._slots_per_stripe * stripes
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._initialize(path, size)
+            self._map = mmap.mmap(self._fd, size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+        self._stripe_locks = [asyncio.Lock() for _ in range(stripes)]
+
+    def _initialize(self, path: Path, size: int) -> None:
+        header = _HEADER.pack(
+            _MAGIC,
+            self._slots_per_stripe,
+            self._stripes,
+            self._max_history,
+            self._max_key_length,
+            self._max_id_length,
+        )
+        # Byte 0 guards the header, so only one process creates the table
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            existing = os.pread(self._fd, _HEADER.size, 0)
+            if not existing.strip(b"\0"):
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, header, 0)
+                _LOG.info("Created shared rate limiting table in %s", path)
+            elif existing != header:
+                raise ValueError(
+                    f"{path} contains a table with different parameters or is not"
+                    " a rate limiting table"
+                )
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    @asynccontextmanager
+    async def _hold(self, stripe: int) -> AsyncGenerator[None, None]:
+        async with self._stripe_locks[stripe]:
+            while True:
+                try:
+                    fcntl.lockf(
+                        self._fd,
+                        fcntl.LOCK_EX | fcntl.LOCK_NB,
+                        1,
+                        stripe + 1,
+                    )
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    await asyncio.sleep(_LOCK_RETRY_SECONDS)
+
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe + 1)
+
+    def _encode_key(self, context_id: str, user_id: str) -> tuple[bytes, int, int]:
+        # Returns the key, its hash and its stripe
+        key = json.dumps([context_id, user_id]).encode()
+        if len(key) > self._max_key_length:
+            raise ValueError(
+                f"Key of user {user_id} in context {context_id} is longer than"
+                f" {self._max_key_length} bytes"
+            )
+        key_hash = _hash_key(key)
+        return key, key_hash, key_hash % self._stripes
+
+    def _encode_id(self, value: str | None) -> tuple[int, bytes]:
+        if value is None:
+            return _NO_ID, b""
+        encoded = value.encode()
+        if len(encoded) > self._max_id_length:
+            raise ValueError(f"ID {value} is longer than {self._max_id_length} bytes")
+        return len(encoded), encoded
+
+    def _slot_offset(self, stripe: int, index: int) -> int:
+        return (
+            _HEADER_SIZE + (stripe * self._slots_per_stripe + index) * self._slot_size
+        )
+
+    def _find_slot(
+        self,
+        key: bytes,
+        key_hash: int,
+        stripe: int,
+        *,
+        create: bool,
+    ) -> int | None:
+        # Returns the offset of the key's slot. Must hold the stripe lock.
+        slots = self._slots_per_stripe
+        home = (key_hash // self._stripes) % slots
+        reusable: int | None = None
+        for probe in range(slots):
+            offset = self._slot_offset(stripe, (home + probe) % slots)
+            state, key_length, _, _, slot_hash = _SLOT_HEADER.unpack_from(
+                self._map,
+                offset,
+            )
+            if state == _EMPTY:
+                if reusable is None:
+                    reusable = offset
+                break
+            if state == _DELETED:
+                if reusable is None:
+                    reusable = offset
+                continue
+
+            key_start = offset + _SLOT_HEADER.size
+            if (
+                slot_hash == key_hash
+                and self._map[key_start : key_start + key_length] == key
+            ):
+                return offset
+
+        if not create:
+            return None
+        if reusable is None:
+            raise ValueError(
+                f"Stripe {stripe} of the shared rate limiting table is full,"
+                " increase its capacity"
+            )
+
+        _SLOT_HEADER.pack_into(self._map, reusable, _USED, len(key), 0, 0, key_hash)
+        key_start = reusable + _SLOT_HEADER.size
+        self._map[key_start : key_start + len(key)] = key
+        return reusable
+
+    def _read_entries(
+        self,
+        offset: int,
+        context_id: str,
+        user_id: str,
+        limit: int,
+        min_time: int | None,
+    ) -> list[Usage]:
+        # Newest first
+        _, _, count, head, _ = _SLOT_HEADER.unpack_from(self._map, offset)
+        history = self._max_history
+        entries_offset = offset + self._entries_offset
+        usages = []
+        for age in range(min(limit, count)):
+            position = (head - 1 - age) % history
+            time, reference_length, reference_id, response_length, response_id = (
+                self._entry.unpack_from(
+                    self._map,
+                    entries_offset + position * self._entry.size,
+                )
+            )
+            if min_time is not None and time < min_time:
+                break
+
+            usages.append(
+                Usage(
+                    context_id=context_id,
+                    user_id=user_id,
+                    time=_EPOCH + timedelta(microseconds=time),
+                    reference_id=(
+                        None
+                        if reference_length == _NO_ID
+                        else reference_id[:reference_length].decode()
+                    ),
+                    response_id=(
+                        None
+                        if response_length == _NO_ID
+                        else response_id[:response_length].decode()
+                    ),
+                )
+            )
+
+        return usages
+
+    def _insert(self, key: bytes, key_hash: int, stripe: int, usage: Usage) -> None:
+        # Must hold the stripe lock
+        reference = self._encode_id(usage.reference_id)
+        response = self._encode_id(usage.response_id)
+        time = _to_micros(usage.time)
+
+        offset = self._find_slot(key, key_hash, stripe, create=True)
+        assert offset is not None
+        _, key_length, count, head, _ = _SLOT_HEADER.unpack_from(self._map, offset)
+        history = self._max_history
+        entry_size = self._entry.size
+        entries_offset = offset + self._entries_offset
+
+        newest = (
+            self._entry.unpack_from(
+                self._map,
+                entries_offset + (head - 1) % history * entry_size,
+            )[0]
+            if count
+            else None
+        )
+        if newest is None or newest <= time:
+            self._entry.pack_into(
+                self._map,
+                entries_offset + head * entry_size,
+                time,
+                *reference,
+                *response,
+            )
+            head = (head + 1) % history
+            count = min(count + 1, history)
+        else:
+            # Out of order, so the whole ring is rewritten in order
+            entries = [
+                self._entry.unpack_from(
+                    self._map,
+                    entries_offset + (head - count + age) % history * entry_size,
+                )
+                for age in range(count)
+            ]
+            bisect.insort_right(
+                entries,
+                (time, *reference, *response),
+                key=lambda entry: entry[0],
+            )
+            entries = entries[-history:]
+            for position, entry in enumerate(entries):
+                self._entry.pack_into(
+                    self._map,
+                    entries_offset + position * entry_size,
+                    *entry,
+                )
+            count = len(entries)
+            head = count % history
+
+        _SLOT_HEADER.pack_into(
+            self._map,
+            offset,
+            _USED,
+            key_length,
+            count,
+            head,
+            key_hash,
+        )
+
+    def _check_limit(self, limit: int) -> None:
+        if limit > self._max_history:
+            raise ValueError(
+                f"Requested {limit} usages, but only the last {self._max_history}"
+                " are kept"
+            )
+
+    async def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ):
+        key, key_hash, stripe = self._encode_key(context_id, user_id)
+        usage = Usage(
+            context_id=context_id,
+            user_id=user_id,
+            time=utc_time,
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+        async with self._hold(stripe):
+            self._insert(key, key_hash, stripe, usage)
+
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        for usage in usages:
+            key, key_hash, stripe = self._encode_key(usage.context_id, usage.user_id)
+            async with self._hold(stripe):
+                self._insert(key, key_hash, stripe, usage)
+
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        self._check_limit(limit)
+        key, key_hash, stripe = self._encode_key(context_id, user_id)
+        async with self._hold(stripe):
+            offset = self._find_slot(key, key_hash, stripe, create=False)
+            history = (
+                []
+                if offset is None
+                else self._read_entries(
+                    offset,
+                    context_id,
+                    user_id,
+                    limit,
+                    None if since is None else _to_micros(since),
+                )
+            )
+            offending_usage = await check(history)
+            if offending_usage is None:
+                self._insert(
+                    key,
+                    key_hash,
+                    stripe,
+                    Usage(
+                        context_id=context_id,
+                        user_id=user_id,
+                        time=utc_time,
+                        reference_id=reference_id,
+                        response_id=response_id,
+                    ),
+                )
+
+        return offending_usage
+
+    async def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        self._check_limit(limit)
+        key, key_hash, stripe = self._encode_key(context_id, user_id)
+        async with self._hold(stripe):
+            offset = self._find_slot(key, key_hash, stripe, create=False)
+            if offset is None:
+                return []
+            return self._read_entries(
+                offset,
+                context_id,
+                user_id,
+                limit,
+                None if since is None else _to_micros(since),
+            )
+
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        return {
+            (context_id, user_id): await self.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            for context_id, user_id in keys
+        }
+
+    def _drop_from_stripe(self, stripe: int, until: int, limit: int | None) -> int:
+        # Must hold the stripe lock. Usages are dropped oldest first per slot.
+        history = self._max_history
+        entry_size = self._entry.size
+        dropped = 0
+        for index in range(self._slots_per_stripe):
+            if limit is not None and dropped >= limit:
+                break
+
+            offset = self._slot_offset(stripe, index)
+            state, key_length, count, head, key_hash = _SLOT_HEADER.unpack_from(
+                self._map,
+                offset,
+            )
+            if state != _USED:
+                continue
+
+            entries_offset = offset + self._entries_offset
+            oldest = (head - count) % history
+            expired = 0
+            while expired < count and (limit is None or dropped < limit):
+                time = self._entry.unpack_from(
+                    self._map,
+                    entries_offset + (oldest + expired) % history * entry_size,
+                )[0]
+                if time >= until:
+                    break
+                expired += 1
+                dropped += 1
+
+            if expired:
+                _SLOT_HEADER.pack_into(
+                    self._map,
+                    offset,
+                    _USED if expired < count else _DELETED,
+                    key_length,
+                    count - expired,
+                    head,
+                    key_hash,
+                )
+
+        self._reclaim_deleted(stripe)
+        return dropped
+
+    def _reclaim_deleted(self, stripe: int) -> None:
+        # A deleted slot followed by an empty one doesn't continue any probe
+        # sequence, so it can be empty again. Walking backwards twice handles
+        # the wrap-around at the end of the stripe.
+        slots = self._slots_per_stripe
+        followed_by_empty = False
+        for index in reversed(range(2 * slots)):
+            offset = self._slot_offset(stripe, index % slots)
+            state = self._map[offset]
+            if state == _EMPTY:
+                followed_by_empty = True
+            elif state == _DELETED and followed_by_empty:
+                self._map[offset] = _EMPTY
+            else:
+                followed_by_empty = False
+
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        until_micros = _to_micros(until)
+        dropped = 0
+        for stripe in range(self._stripes):
+            remaining = None if limit is None else limit - dropped
+            if remaining == 0:
+                break
+            async with self._hold(stripe):
+                dropped += self._drop_from_stripe(stripe, until_micros, remaining)
+
+        _LOG.debug("Dropped %d usages older than %s", dropped, until)
+        return dropped
+
+    async def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
@@ -1,64 +1,754 @@
 import asyncio
 import functools
+import json
 import logging
+import math
+import queue
 import sqlite3
-from collections.abc import Callable, Generator
+import threading
+import time
+from collections.abc import Callable, Generator, Iterable, Sequence
+from concurrent.futures import Executor, ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import UTC, datetime
+from datetime import UTC, date, datetime, timedelta, tzinfo
 from pathlib import Path
-from typing import Self
+from typing import Self, cast
 
-from opentelemetry import context
+from opentelemetry import context, metrics
 
-from .. import RateLimitingRepo, Usage
+from .. import (
+    DailyUsageCount,
+    RateLimitingRepo,
+    RateLimitingState,
+    SyncRateLimitingRepo,
+    SyncUsageCheck,
+    Usage,
+    UsageCheck,
+)
+from ._daily_counts import aggregate_daily_counts
 
 _LOG = logging.getLogger(__name__)
+_meter = metrics.get_meter(__name__)
 
+_executor_wait = _meter.create_histogram(
+    "rate_limiter.sqlite.executor.wait",
+    unit="s",
+    description="Time a database call waited for a free SQLite thread",
+)
+_READ_ATTRIBUTES = {"executor": "read"}
+_WRITE_ATTRIBUTES = {"executor": "write"}
 
-class SqliteRateLimitingRepo(RateLimitingRepo):
-    def __init__(self, connection: sqlite3.Connection):
+_MIN_EPOCH_SECONDS = -(2**63)
+_BUSY_TIMEOUT_MS = 5000
+# Tables cleaned up by drop_old_usages, with the column that decides expiry
+_EXPIRING_TABLES = (
+    ("usages", "time"),
+    ("daily_usage_counters", "last_time"),
+    ("limiter_states", "last_time"),
+)
+
+
+def _to_epoch_seconds(time: datetime | None) -> int:
+    # Usage times are stored as whole epoch seconds
+    if time is None:
+        return _MIN_EPOCH_SECONDS
+    return math.floor(time.timestamp())
+
+
+def _instrument(connection: sqlite3.Connection) -> sqlite3.Connection:
+    try:
+        from opentelemetry.instrumentation.sqlite3 import SQLite3Instrumentor
+    except ImportError:
+        _LOG.info("Not instrumenting sqlite3 connection")
+        return connection
+
+    return SQLite3Instrumentor().instrument_connection(connection)
+
+
+def _open_connections(
+    db_file: Path,
+    read_connections: int,
+) -> tuple[sqlite3.Connection, list[sqlite3.Connection]]:
+    connection = sqlite3.connect(db_file, check_same_thread=False)
+    # WAL lets readers continue while a write is in progress. With WAL,
+    # synchronous=NORMAL only risks the latest commits on power loss, not
+    # corruption.
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(f"PRAGMA busy_timeout={_BUSY_TIMEOUT_MS}")
+
+    readers = []
+    for _ in range(read_connections):
+        reader = sqlite3.connect(
+            f"{db_file.absolute().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+        )
+        reader.execute(f"PRAGMA busy_timeout={_BUSY_TIMEOUT_MS}")
+        readers.append(reader)
+
+    return connection, readers
+
+
+class _SqliteStore:
+    # The queries shared by the async and the sync repo. Everything in here
+    # blocks, the async repo runs it on its executors.
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        daily_count_timezone: tzinfo | None,
+        read_connections: Sequence[sqlite3.Connection],
+    ):
+        self._connection = _instrument(connection)
+        # The connection may be used by different threads
+        self._lock = threading.Lock()
+        # Only usages added while this is set are counted
+        self._daily_count_timezone = daily_count_timezone
+        self._read_connections: queue.SimpleQueue[sqlite3.Connection] = (
+            queue.SimpleQueue()
+        )
+        for read_connection in read_connections:
+            self._read_connections.put(_instrument(read_connection))
+        self._read_connection_count = len(read_connections)
+
+    @property
+    def daily_count_timezone(self) -> tzinfo | None:
+        return self._daily_count_timezone
+
+    @property
+    def supports_states(self) -> bool:
+        return True
+
+    @contextmanager
+    def _cursor(self) -> Generator[sqlite3.Cursor, None, None]:
+        with self._lock:
+            cursor = self._connection.cursor()
+            try:
+                yield cursor
+                cursor.connection.commit()
+            except BaseException:
+                cursor.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def _read_cursor(self) -> Generator[sqlite3.Cursor, None, None]:
+        if not self._read_connection_count:
+            with self._cursor() as cursor:
+                yield cursor
+            return
+
+        connection = self._read_connections.get()
+        cursor = connection.cursor()
         try:
-            from opentelemetry.instrumentation.sqlite3 import SQLite3Instrumentor
+            yield cursor
+        finally:
+            cursor.close()
+            self._read_connections.put(connection)
+
+    @staticmethod
+    def _insert_usage(
+        cursor: sqlite3.Cursor,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ) -> None:
+        cursor.execute(
+            """
+            INSERT INTO usages (
+                context_id,
+                user_id,
+                time,
+                reference_id,
+                response_id
+            )
+            VALUES (?, ?, ?, ?, ?);
+            """,
+            [
+                context_id,
+                user_id,
+                int(utc_time.timestamp()),
+                reference_id,
+                response_id,
+            ],
+        )
+
+    def _count_usages(self, cursor: sqlite3.Cursor, usages: Iterable[Usage]) -> None:
+        timezone = self._daily_count_timezone
+        if timezone is None:
+            return
+
+        cursor.executemany(
+            """
+            INSERT INTO daily_usage_counters AS counters (
+                context_id,
+                user_id,
+                local_day,
+                usage_count,
+                last_time,
+                last_reference_id,
+                last_response_id
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (context_id, user_id, local_day) DO UPDATE SET
+                usage_count = counters.usage_count + excluded.usage_count,
+                last_time = max(counters.last_time, excluded.last_time),
+                last_reference_id = CASE
+                    WHEN excluded.last_time >= counters.last_time
+                    THEN excluded.last_reference_id
+                    ELSE counters.last_reference_id
+                END,
+                last_response_id = CASE
+                    WHEN excluded.last_time >= counters.last_time
+                    THEN excluded.last_response_id
+                    ELSE counters.last_response_id
+                END
+            """,
+            (
+                (
+                    increment.context_id,
+                    increment.user_id,
+                    increment.day.isoformat(),
+                    increment.count,
+                    int(increment.last_usage.time.timestamp()),
+                    increment.last_usage.reference_id,
+                    increment.last_usage.response_id,
+                )
+                for increment in aggregate_daily_counts(usages, timezone)
+            ),
+        )
+
+    def _add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ):
+        with self._cursor() as cursor:
+            self._insert_usage(
+                cursor,
+                context_id=context_id,
+                user_id=user_id,
+                utc_time=utc_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
+            self._count_usages(
+                cursor,
+                [
+                    Usage(
+                        context_id=context_id,
+                        user_id=user_id,
+                        time=utc_time,
+                        reference_id=reference_id,
+                        response_id=response_id,
+                    )
+                ],
+            )
+        _LOG.debug("Inserted usage for user %s in context %s", user_id, context_id)
+
+    def _insert_usages(self, cursor: sqlite3.Cursor, usages: list[Usage]) -> None:
+        cursor.executemany(
+            """
+            INSERT INTO usages (
+                context_id,
+                user_id,
+                time,
+                reference_id,
+                response_id
+            )
+            VALUES (?, ?, ?, ?, ?);
+            """,
+            (
+                (
+                    usage.context_id,
+                    usage.user_id,
+                    int(usage.time.timestamp()),
+                    usage.reference_id,
+                    usage.response_id,
+                )
+                for usage in usages
+            ),
+        )
+        self._count_usages(cursor, usages)
+
+    def _add_usages(self, *, usages: list[Usage]) -> None:
+        # All usages are inserted in a single transaction
+        with self._cursor() as cursor:
+            self._insert_usages(cursor, usages)
+        _LOG.debug("Inserted %d usages", len(usages))
+
+    def _add_usages_of_callers(
+        self,
+        *,
+        batches: list[list[Usage]],
+    ) -> list[sqlite3.IntegrityError | None]:
+        # Inserts the usages of several callers in a single transaction, but
+        # each caller's usages are inserted or rejected on their own. Returns
+        # the error of each caller.
+        errors: list[sqlite3.IntegrityError | None] = []
+        with self._cursor() as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            for usages in batches:
+                cursor.execute("SAVEPOINT caller")
+                try:
+                    self._insert_usages(cursor, usages)
+                except sqlite3.IntegrityError as e:
+                    cursor.execute("ROLLBACK TO caller")
+                    errors.append(e)
+                else:
+                    errors.append(None)
+                cursor.execute("RELEASE caller")
+        _LOG.debug("Inserted usages of %d callers", len(batches))
+        return errors
+
+    def _insert_and_count(self, cursor: sqlite3.Cursor, usage: Usage) -> None:
+        self._insert_usage(
+            cursor,
+            context_id=usage.context_id,
+            user_id=usage.user_id,
+            utc_time=usage.time,
+            reference_id=usage.reference_id,
+            response_id=usage.response_id,
+        )
+        self._count_usages(cursor, [usage])
+
+    def _add_usage_if_allowed(
+        self,
+        *,
+        usage: Usage,
+        limit: int,
+        check: SyncUsageCheck,
+        since: datetime | None,
+    ) -> Usage | None:
+        with self._cursor() as cursor:
+            # Take the write lock right away so other processes can't insert
+            # between our read and our write.
+            cursor.execute("BEGIN IMMEDIATE")
+            history = self._select_usages(
+                cursor,
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                limit=limit,
+                since=since,
+            )
+            offending_usage = check(history)
+            if offending_usage is None:
+                self._insert_and_count(cursor, usage)
+
+        _LOG.debug(
+            "Usage for user %s in context %s was %s",
+            usage.user_id,
+            usage.context_id,
+            "denied" if offending_usage else "inserted",
+        )
+        return offending_usage
+
+    def _add_usage_if_unchanged(
+        self,
+        *,
+        usage: Usage,
+        limit: int,
+        since: datetime | None,
+        expected: list[Usage],
+    ) -> bool:
+        # Inserts the usage only if the history is still the expected one
+        with self._cursor() as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            history = self._select_usages(
+                cursor,
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                limit=limit,
+                since=since,
+            )
+            if history != expected:
+                return False
+
+            self._insert_and_count(cursor, usage)
+
+        _LOG.debug(
+            "Usage for user %s in context %s was inserted",
+            usage.user_id,
+            usage.context_id,
+        )
+        return True
+
+    @staticmethod
+    def _select_usages(
+        cursor: sqlite3.Cursor,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int,
+        since: datetime | None,
+    ) -> list[Usage]:
+        # Times are stored as whole seconds, so this may include usages from up
+        # to a second before `since`.
+        result = cursor.execute(
+            """
+            SELECT time, reference_id, response_id FROM usages
+            WHERE context_id = ? AND user_id = ? AND time >= ?
+            ORDER BY time DESC
+            LIMIT ?
+            """,
+            [context_id, user_id, _to_epoch_seconds(since), limit],
+        )
+        return [
+            Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=datetime.fromtimestamp(row[0], tz=UTC),
+                reference_id=row[1],
+                response_id=row[2],
+            )
+            for row in result
+        ]
+
+    def _get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        with self._read_cursor() as cursor:
+            usages = self._select_usages(
+                cursor,
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+
+        _LOG.debug(
+            "Found %d usages for user %s in context %s (limit was %d)",
+            len(usages),
+            user_id,
+            context_id,
+            limit,
+        )
+
+        return usages
+
+    def _get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int,
+        since: datetime | None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        usages: dict[tuple[str, str], list[Usage]] = {key: [] for key in keys}
+        if not usages:
+            return usages
+
+        with self._read_cursor() as cursor:
+            # The keys are passed as a single JSON parameter to avoid running into
+            # the limit for the number of SQL variables.
+            result = cursor.execute(
+                """
+                WITH keys AS (
+                    SELECT
+                        json_extract(value, '$[0]') AS context_id,
+                        json_extract(value, '$[1]') AS user_id
+                    FROM json_each(?)
+                )
+                SELECT context_id, user_id, time, reference_id, response_id
+                FROM (
+                    SELECT
+                        usages.*,
+                        row_number() OVER (
+                            PARTITION BY usages.context_id, usages.user_id
+                            ORDER BY usages.time DESC
+                        ) AS position
+                    FROM usages
+                    JOIN keys
+                        ON usages.context_id = keys.context_id
+                        AND usages.user_id = keys.user_id
+                    WHERE usages.time >= ?
+                )
+                WHERE position <= ?
+                ORDER BY time DESC
+                """,
+                [json.dumps(list(usages)), _to_epoch_seconds(since), limit],
+            )
+            for row in result:
+                context_id, user_id = row[0], row[1]
+                usages[(context_id, user_id)].append(
+                    Usage(
+                        context_id=context_id,
+                        user_id=user_id,
+                        time=datetime.fromtimestamp(row[2], tz=UTC),
+                        reference_id=row[3],
+                        response_id=row[4],
+                    )
+                )
+
+        _LOG.debug("Fetched usages for %d keys (limit was %d)", len(usages), limit)
+
+        return usages
+
+    def _get_daily_count(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        day: date,
+    ) -> DailyUsageCount:
+        if self._daily_count_timezone is None:
+            raise ValueError("Daily counts are not enabled for this repo")
+
+        with self._read_cursor() as cursor:
+            row = cursor.execute(
+                """
+                SELECT usage_count, last_time, last_reference_id, last_response_id
+                FROM daily_usage_counters
+                WHERE context_id = ? AND user_id = ? AND local_day = ?
+                """,
+                [context_id, user_id, day.isoformat()],
+            ).fetchone()
+
+        if row is None:
+            return DailyUsageCount(day=day, count=0, last_usage=None)
+
+        return DailyUsageCount(
+            day=day,
+            count=row[0],
+            last_usage=Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=datetime.fromtimestamp(row[1], tz=UTC),
+                reference_id=row[2],
+                response_id=row[3],
+            ),
+        )
+
+    def _get_state(self, *, context_id: str, user_id: str) -> RateLimitingState | None:
+        with self._read_cursor() as cursor:
+            row = cursor.execute(
+                """
+                SELECT
+                    value,
+                    version,
+                    last_time,
+                    last_reference_id,
+                    last_response_id
+                FROM limiter_states
+                WHERE context_id = ? AND user_id = ?
+                """,
+                [context_id, user_id],
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return RateLimitingState(
+            value=row[0],
+            version=row[1],
+            last_usage=Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=datetime.fromtimestamp(row[2], tz=UTC),
+                reference_id=row[3],
+                response_id=row[4],
+            ),
+        )
+
+    def _compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        last_usage = state.last_usage
+        with self._cursor() as cursor:
+            if expected is None:
+                cursor.execute(
+                    """
+                    INSERT INTO limiter_states (
+                        context_id,
+                        user_id,
+                        value,
+                        version,
+                        last_time,
+                        last_reference_id,
+                        last_response_id
+                    )
+                    VALUES (?, ?, ?, 0, ?, ?, ?)
+                    ON CONFLICT DO NOTHING
+                    """,
+                    [
+                        context_id,
+                        user_id,
+                        state.value,
+                        int(last_usage.time.timestamp()),
+                        last_usage.reference_id,
+                        last_usage.response_id,
+                    ],
+                )
+            else:
+                cursor.execute(
+                    """
+                    UPDATE limiter_states SET
+                        value = ?,
+                        version = version + 1,
+                        last_time = ?,
+                        last_reference_id = ?,
+                        last_response_id = ?
+                    WHERE context_id = ? AND user_id = ? AND version = ?
+                    """,
+                    [
+                        state.value,
+                        int(last_usage.time.timestamp()),
+                        last_usage.reference_id,
+                        last_usage.response_id,
+                        context_id,
+                        user_id,
+                        expected.version,
+                    ],
+                )
+
+            return cursor.rowcount == 1
+
+    def _drop_old_usages(self, *, until: datetime, limit: int | None) -> int:
+        # Times are whole seconds, so the cutoff has to be one as well
+        cutoff = _to_epoch_seconds(until)
+        dropped = 0
+        with self._cursor() as cursor:
+            for table, time_column in _EXPIRING_TABLES:
+                cursor.execute(
+                    f"""
+                    DELETE FROM {table}
+                    WHERE rowid IN (
+                        SELECT rowid FROM {table}
+                        WHERE {time_column} < ?
+                        LIMIT ?
+                    )
+                    """,
+                    [cutoff, -1 if limit is None else limit],
+                )
+                dropped += cursor.rowcount
+
+        _LOG.debug("Dropped %d rows older than %s", dropped, until)
+        return dropped
+
+    def _close(self) -> None:
+        for _ in range(self._read_connection_count):
+            self._read_connections.get().close()
+        self._connection.close()
+
+
+class SqliteRateLimitingRepo(_SqliteStore, RateLimitingRepo):
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        daily_count_timezone: tzinfo | None = None,
+        *,
+        read_connections: Sequence[sqlite3.Connection] = (),
+        group_commit_window: timedelta | None = None,
+    ):
+        super().__init__(connection, daily_count_timezone, read_connections)
 
-            connection = SQLite3Instrumentor().instrument_connection(
-                connection,
+        # Writes run on a single thread of their own, so they never wait for
+        # reads (or other users of the default executor). There's one read
+        # thread per read connection, so a free connection is always available.
+        # Without read connections, reads use the writer connection and thread.
+        self._write_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="sqlite-rate-limiter-write",
+        )
+        self._read_executor = (
+            ThreadPoolExecutor(
+                max_workers=self._read_connection_count,
+                thread_name_prefix="sqlite-rate-limiter-read",
             )
-        except ImportError:
-            _LOG.info("Not instrumenting sqlite3 connection")
+            if read_connections
+            else self._write_executor
+        )
 
-        self._connection = connection
+        # If set, usages added within this window are inserted in a single
+        # transaction. Callers still only return once their usage is committed.
+        self._group_commit_delay = (
+            None if group_commit_window is None else group_commit_window.total_seconds()
+        )
+        # The usages of each caller, and the future it waits for
+        self._batch: list[tuple[list[Usage], asyncio.Future[None]]] = []
+        self._batch_timer: asyncio.TimerHandle | None = None
+        self._commits: set[asyncio.Task[None]] = set()
 
     @staticmethod
-    async def _run_in_executor[T](func: Callable[[], T]) -> T:
+    async def _run_in_executor[T](
+        executor: Executor,
+        func: Callable[[], T],
+        attributes: dict[str, str],
+    ) -> T:
         loop = asyncio.get_running_loop()
         ctx = context.get_current()
+        submitted = time.perf_counter()
 
         def __with_context() -> T:
+            _executor_wait.record(time.perf_counter() - submitted, attributes)
             token = context.attach(ctx)
             try:
                 return func()
             finally:
                 context.detach(token)
 
-        return await loop.run_in_executor(None, __with_context)
+        return await loop.run_in_executor(executor, __with_context)
+
+    async def _run_write[T](self, func: Callable[[], T]) -> T:
+        return await self._run_in_executor(
+            self._write_executor,
+            func,
+            _WRITE_ATTRIBUTES,
+        )
+
+    async def _run_read[T](self, func: Callable[[], T]) -> T:
+        return await self._run_in_executor(
+            self._read_executor,
+            func,
+            _READ_ATTRIBUTES,
+        )
 
     @classmethod
-    async def connect(cls, db_file: Path) -> Self:
+    async def connect(
+        cls,
+        db_file: Path,
+        daily_count_timezone: tzinfo | None = None,
+        *,
+        read_connections: int = 4,
+        group_commit_window: timedelta | None = None,
+    ) -> Self:
+        # Enables WAL mode on the database file
         if db_file.exists() and not db_file.is_file():
             raise ValueError(f"Database file {db_file} exists and is not a file")
+        if read_connections < 0:
+            raise ValueError(
+                f"Read connections may not be negative, but was {read_connections}"
+            )
 
-        partial = functools.partial(sqlite3.connect, db_file)
-        connection = await cls._run_in_executor(partial)
-        return cls(connection)
-
-    @contextmanager
-    def _cursor(self) -> Generator[sqlite3.Cursor, None, None]:
-        cursor = self._connection.cursor()
-        try:
-            yield cursor
-            cursor.connection.commit()
-        finally:
-            cursor.close()
+        connection, readers = await asyncio.to_thread(
+            _open_connections,
+            db_file,
+            read_connections,
+        )
+        return cls(
+            connection,
+            daily_count_timezone=daily_count_timezone,
+            read_connections=readers,
+            group_commit_window=group_commit_window,
+        )
 
     async def add_usage(
         self,
@@ -69,6 +759,20 @@ class SqliteRateLimitingRepo(RateLimitingRepo):
         reference_id: str | None,
         response_id: str | None,
     ):
+        if self._group_commit_delay is not None:
+            await self._add_to_batch(
+                [
+                    Usage(
+                        context_id=context_id,
+                        user_id=user_id,
+                        time=utc_time,
+                        reference_id=reference_id,
+                        response_id=response_id,
+                    )
+                ]
+            )
+            return
+
         partial = functools.partial(
             self._add_usage,
             context_id=context_id,
@@ -77,9 +781,57 @@ class SqliteRateLimitingRepo(RateLimitingRepo):
             reference_id=reference_id,
             response_id=response_id,
         )
-        await self._run_in_executor(partial)
+        await self._run_write(partial)
 
-    def _add_usage(
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        if self._group_commit_delay is not None:
+            await self._add_to_batch(list(usages))
+            return
+
+        partial = functools.partial(self._add_usages, usages=list(usages))
+        await self._run_write(partial)
+
+    async def _add_to_batch(self, usages: list[Usage]) -> None:
+        loop = asyncio.get_running_loop()
+        if self._batch_timer is None:
+            delay = cast(float, self._group_commit_delay)
+            self._batch_timer = loop.call_later(delay, self._commit_batch)
+
+        committed = loop.create_future()
+        self._batch.append((usages, committed))
+        # The commit is shared, so one cancelled caller must not cancel it
+        await asyncio.shield(committed)
+
+    def _commit_batch(self) -> None:
+        batch = self._batch
+        self._batch = []
+        self._batch_timer = None
+
+        async def _commit() -> None:
+            try:
+                errors = await self._run_write(
+                    functools.partial(
+                        self._add_usages_of_callers,
+                        batches=[usages for usages, _ in batch],
+                    )
+                )
+            except Exception as e:
+                for _, committed in batch:
+                    committed.set_exception(e)
+                return
+
+            # Callers only see their own outcome
+            for (_, committed), error in zip(batch, errors, strict=True):
+                if error is None:
+                    committed.set_result(None)
+                else:
+                    committed.set_exception(error)
+
+        task = asyncio.get_running_loop().create_task(_commit())
+        self._commits.add(task)
+        task.add_done_callback(self._commits.discard)
+
+    async def add_usage_if_allowed(
         self,
         *,
         context_id: str,
@@ -87,28 +839,55 @@ class SqliteRateLimitingRepo(RateLimitingRepo):
         utc_time: datetime,
         reference_id: str | None,
         response_id: str | None,
-    ):
-        with self._cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT INTO usages (
-                    context_id,
-                    user_id,
-                    time,
-                    reference_id,
-                    response_id
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        # The check runs on the event loop. Running it inside the write
+        # transaction would hold the write lock (and the only write thread) while
+        # waiting for the loop, so the usage is instead only inserted if the
+        # history is still what the check saw, and we retry otherwise.
+        usage = Usage(
+            context_id=context_id,
+            user_id=user_id,
+            time=utc_time,
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+        while True:
+            history = await self._run_read(
+                functools.partial(
+                    self._get_usages,
+                    context_id=context_id,
+                    user_id=user_id,
+                    limit=limit,
+                    since=since,
                 )
-                VALUES (?, ?, ?, ?, ?);
-                """,
-                [
-                    context_id,
+            )
+            offending_usage = await check(history)
+            if offending_usage is not None:
+                _LOG.debug(
+                    "Usage for user %s in context %s was denied",
                     user_id,
-                    int(utc_time.timestamp()),
-                    reference_id,
-                    response_id,
-                ],
+                    context_id,
+                )
+                return offending_usage
+
+            partial = functools.partial(
+                self._add_usage_if_unchanged,
+                usage=usage,
+                limit=limit,
+                since=since,
+                expected=history,
+            )
+            if await self._run_write(partial):
+                return None
+
+            _LOG.debug(
+                "History of user %s in context %s was changed concurrently, retrying",
+                user_id,
+                context_id,
             )
-        _LOG.debug("Inserted usage for user %s in context %s", user_id, context_id)
 
     async def get_usages(
         self,
@@ -116,66 +895,244 @@ class SqliteRateLimitingRepo(RateLimitingRepo):
         context_id: str,
         user_id: str,
         limit: int = 1,
+        since: datetime | None = None,
     ) -> list[Usage]:
         partial = functools.partial(
             self._get_usages,
             context_id=context_id,
             user_id=user_id,
             limit=limit,
+            since=since,
         )
-        return await self._run_in_executor(partial)
+        return await self._run_read(partial)
 
-    def _get_usages(
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        partial = functools.partial(
+            self._get_usages_many,
+            keys=keys,
+            limit=limit,
+            since=since,
+        )
+        return await self._run_read(partial)
+
+    async def get_daily_count(
         self,
         *,
         context_id: str,
         user_id: str,
-        limit: int = 1,
-    ) -> list[Usage]:
-        with self._cursor() as cursor:
-            result = cursor.execute(
-                """
-                SELECT time, reference_id, response_id FROM usages
-                WHERE context_id = ? AND user_id = ?
-                ORDER BY time DESC
-                LIMIT ?
-                """,
-                [context_id, user_id, limit],
-            )
-            usages = [
-                Usage(
-                    context_id=context_id,
-                    user_id=user_id,
-                    time=datetime.fromtimestamp(row[0], tz=UTC),
-                    reference_id=row[1],
-                    response_id=row[2],
-                )
-                for row in result
-            ]
+        day: date,
+    ) -> DailyUsageCount:
+        partial = functools.partial(
+            self._get_daily_count,
+            context_id=context_id,
+            user_id=user_id,
+            day=day,
+        )
+        return await self._run_read(partial)
 
-        _LOG.debug(
-            "Found %d usages for user %s in context %s (limit was %d)",
-            len(usages),
-            user_id,
-            context_id,
-            limit,
+    async def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        partial = functools.partial(
+            self._get_state,
+            context_id=context_id,
+            user_id=user_id,
         )
+        return await self._run_read(partial)
 
-        return usages
+    async def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        partial = functools.partial(
+            self._compare_and_set_state,
+            context_id=context_id,
+            user_id=user_id,
+            expected=expected,
+            state=state,
+        )
+        return await self._run_write(partial)
 
-    async def drop_old_usages(self, *, until: datetime) -> None:
-        partial = functools.partial(self._drop_old_usages, until=until)
-        await self._run_in_executor(partial)
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        partial = functools.partial(self._drop_old_usages, until=until, limit=limit)
+        return await self._run_write(partial)
 
-    def _drop_old_usages(self, *, until: datetime) -> None:
-        with self._cursor() as cursor:
-            cursor.execute(
-                """
-                DELETE FROM usages
-                WHERE time < ?
-                """,
-                [until.timestamp()],
+    async def close(self) -> None:
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._commit_batch()
+        if self._commits:
+            await asyncio.wait(self._commits)
+
+        await self._run_write(self._close)
+        self._write_executor.shutdown(wait=False)
+        self._read_executor.shutdown(wait=False)
+
+
+class SyncSqliteRateLimitingRepo(_SqliteStore, SyncRateLimitingRepo):
+    # Runs every call on the calling thread, for use with SyncRateLimiter. Reads
+    # take a free read connection (or wait for one), writes are serialized on
+    # the writer connection.
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        daily_count_timezone: tzinfo | None = None,
+        *,
+        read_connections: Sequence[sqlite3.Connection] = (),
+    ):
+        super().__init__(connection, daily_count_timezone, read_connections)
+
+    @classmethod
+    def connect(
+        cls,
+        db_file: Path,
+        daily_count_timezone: tzinfo | None = None,
+        *,
+        read_connections: int = 4,
+    ) -> Self:
+        # Enables WAL mode on the database file
+        if db_file.exists() and not db_file.is_file():
+            raise ValueError(f"Database file {db_file} exists and is not a file")
+        if read_connections < 0:
+            raise ValueError(
+                f"Read connections may not be negative, but was {read_connections}"
             )
 
-    async def close(self) -> None:
-        await self._run_in_executor(self._connection.close)
+        connection, readers = _open_connections(db_file, read_connections)
+        return cls(
+            connection,
+            daily_count_timezone=daily_count_timezone,
+            read_connections=readers,
+        )
+
+    def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ) -> None:
+        self._add_usage(
+            context_id=context_id,
+            user_id=user_id,
+            utc_time=utc_time,
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+
+    def add_usages(self, usages: Iterable[Usage]) -> None:
+        self._add_usages(usages=list(usages))
+
+    def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: SyncUsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        # The check is synchronous, so it can run inside the write transaction
+        return self._add_usage_if_allowed(
+            usage=Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=utc_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            ),
+            limit=limit,
+            check=check,
+            since=since,
+        )
+
+    def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        return self._get_usages(
+            context_id=context_id,
+            user_id=user_id,
+            limit=limit,
+            since=since,
+        )
+
+    def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        return self._get_usages_many(keys=keys, limit=limit, since=since)
+
+    def get_daily_count(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        day: date,
+    ) -> DailyUsageCount:
+        return self._get_daily_count(context_id=context_id, user_id=user_id, day=day)
+
+    def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        return self._get_state(context_id=context_id, user_id=user_id)
+
+    def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        return self._compare_and_set_state(
+            context_id=context_id,
+            user_id=user_id,
+            expected=expected,
+            state=state,
+        )
+
+    def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        return self._drop_old_usages(until=until, limit=limit)
+
+    def close(self) -> None:
+        self._close()
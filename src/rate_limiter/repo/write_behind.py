@@ -0,0 +1,399 @@
+import asyncio
+import logging
+from collections.abc import AsyncGenerator, Iterable, Sequence
+from contextlib import asynccontextmanager, suppress
+from datetime import date, datetime, timedelta, tzinfo
+
+from .. import (
+    DailyUsageCount,
+    RateLimitingRepo,
+    RateLimitingState,
+    Usage,
+    UsageCheck,
+)
+from ._locking import KeyedLock
+
+_LOG = logging.getLogger(__name__)
+
+
+class _FlushGate:
+    # A writer-preferring read/write lock. While a batch is being flushed, nobody
+    # may read from the underlying repo, otherwise the flushed usages could be
+    # seen both in the repo and in the pending overlay.
+
+    def __init__(self) -> None:
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._flushing = False
+
+    @asynccontextmanager
+    async def read(self) -> AsyncGenerator[None, None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._flushing)
+            self._readers += 1
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def flush(self) -> AsyncGenerator[None, None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._flushing)
+            self._flushing = True
+            await self._condition.wait_for(lambda: self._readers == 0)
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._flushing = False
+                self._condition.notify_all()
+
+
+class WriteBehindRateLimitingRepo(RateLimitingRepo):
+    def __init__(
+        self,
+        repo: RateLimitingRepo,
+        *,
+        max_batch_size: int = 500,
+        max_delay: timedelta = timedelta(milliseconds=50),
+        max_pending: int = 10_000,
+        max_flush_attempts: int = 3,
+        retry_delay: timedelta = timedelta(milliseconds=100),
+    ):
+        if max_batch_size < 1:
+            raise ValueError(
+                f"Max batch size must be positive, but was {max_batch_size}"
+            )
+        if max_pending < max_batch_size:
+            raise ValueError(
+                "Max pending usages may not be less than the max batch size"
+                f" ({max_pending} < {max_batch_size})"
+            )
+        if max_flush_attempts < 1:
+            raise ValueError(
+                f"Max flush attempts must be positive, but was {max_flush_attempts}"
+            )
+
+        self._repo = repo
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay.total_seconds()
+        self._max_flush_attempts = max_flush_attempts
+        self._retry_delay = retry_delay.total_seconds()
+        # Once max_pending usages are queued, add_usage waits for a flush
+        self._queue: asyncio.Queue[Usage | None] = asyncio.Queue(maxsize=max_pending)
+        self._pending: dict[tuple[str, str], list[Usage]] = {}
+        self._gate = _FlushGate()
+        self._locks: KeyedLock[tuple[str, str]] = KeyedLock()
+        self._flusher: asyncio.Task[None] | None = None
+        self._is_closed = False
+        # The error of the last batch that couldn't be flushed, raised by the
+        # next call that enqueues usages or by close()
+        self._flush_error: Exception | None = None
+
+    def _raise_flush_error(self) -> None:
+        error, self._flush_error = self._flush_error, None
+        if error is not None:
+            raise error
+
+    def _ensure_flusher(self) -> None:
+        if self._is_closed:
+            raise ValueError("Repo is already closed")
+        self._raise_flush_error()
+
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def _run_flusher(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: list[Usage] = []
+            deadline: float | None = None
+            while len(batch) < self._max_batch_size:
+                if deadline is None:
+                    item = await self._queue.get()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except TimeoutError:
+                        break
+
+                if item is None:
+                    # Sent by close(), everything pending should be flushed now
+                    self._queue.task_done()
+                    break
+
+                batch.append(item)
+                if deadline is None:
+                    deadline = loop.time() + self._max_delay
+
+            if batch:
+                await self._flush(batch)
+
+    def _remove_pending(self, batch: list[Usage]) -> None:
+        for usage in batch:
+            key = (usage.context_id, usage.user_id)
+            pending = self._pending[key]
+            pending.remove(usage)
+            if not pending:
+                del self._pending[key]
+            self._queue.task_done()
+
+    async def _try_flush(self, batch: list[Usage]) -> Exception | None:
+        async with self._gate.flush():
+            try:
+                await self._repo.add_usages(batch)
+            except Exception as e:
+                return e
+            self._remove_pending(batch)
+            return None
+
+    async def _flush(self, batch: list[Usage]) -> None:
+        # The batch stays in the pending overlay between attempts, so readers
+        # only have to wait while it's being written
+        attempt = 1
+        while (error := await self._try_flush(batch)) is not None:
+            if attempt == self._max_flush_attempts:
+                _LOG.warning(
+                    "Could not flush %d usages after %d attempts, splitting them",
+                    len(batch),
+                    attempt,
+                )
+                await self._flush_split(batch, error)
+                return
+
+            _LOG.warning("Could not flush %d usages, retrying", len(batch))
+            await asyncio.sleep(self._retry_delay * 2 ** (attempt - 1))
+            attempt += 1
+
+        _LOG.debug("Flushed %d usages", len(batch))
+
+    async def _flush_split(self, batch: list[Usage], error: Exception) -> None:
+        # Halves a batch that keeps failing until only the usages that fail on
+        # their own are left, so one bad usage doesn't drop the others
+        if len(batch) == 1:
+            (usage,) = batch
+            _LOG.error(
+                "Could not flush usage of user %s in context %s, dropping it: %s",
+                usage.user_id,
+                usage.context_id,
+                error,
+            )
+            self._flush_error = error
+            self._remove_pending(batch)
+            return
+
+        middle = len(batch) // 2
+        for half in (batch[:middle], batch[middle:]):
+            half_error = await self._try_flush(half)
+            if half_error is not None:
+                await self._flush_split(half, half_error)
+
+    async def _enqueue(self, usage: Usage) -> None:
+        self._ensure_flusher()
+        await self._queue.put(usage)
+        self._pending.setdefault((usage.context_id, usage.user_id), []).append(usage)
+
+    @staticmethod
+    def _merge(
+        stored: list[Usage],
+        pending: list[Usage],
+        limit: int,
+        since: datetime | None,
+    ) -> list[Usage]:
+        if since is not None:
+            pending = [usage for usage in pending if usage.time >= since]
+        if not pending:
+            return stored
+
+        usages = sorted(
+            [*stored, *pending],
+            key=lambda usage: usage.time,
+            reverse=True,
+        )
+        return usages[:limit]
+
+    async def add_usage(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+    ):
+        await self._enqueue(
+            Usage(
+                context_id=context_id,
+                user_id=user_id,
+                time=utc_time,
+                reference_id=reference_id,
+                response_id=response_id,
+            )
+        )
+
+    async def add_usages(self, usages: Iterable[Usage]) -> None:
+        for usage in usages:
+            await self._enqueue(usage)
+
+    async def add_usage_if_allowed(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        utc_time: datetime,
+        reference_id: str | None,
+        response_id: str | None,
+        limit: int,
+        check: UsageCheck,
+        since: datetime | None = None,
+    ) -> Usage | None:
+        # This is only atomic with respect to other users of this instance
+        async with self._locks.hold((context_id, user_id)):
+            history = await self.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            offending_usage = await check(history)
+            if offending_usage is None:
+                await self.add_usage(
+                    context_id=context_id,
+                    user_id=user_id,
+                    utc_time=utc_time,
+                    reference_id=reference_id,
+                    response_id=response_id,
+                )
+
+        return offending_usage
+
+    async def get_usages(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> list[Usage]:
+        async with self._gate.read():
+            stored = await self._repo.get_usages(
+                context_id=context_id,
+                user_id=user_id,
+                limit=limit,
+                since=since,
+            )
+            pending = list(self._pending.get((context_id, user_id), []))
+
+        return self._merge(stored, pending, limit, since)
+
+    async def get_usages_many(
+        self,
+        *,
+        keys: Sequence[tuple[str, str]],
+        limit: int = 1,
+        since: datetime | None = None,
+    ) -> dict[tuple[str, str], list[Usage]]:
+        async with self._gate.read():
+            stored = await self._repo.get_usages_many(
+                keys=keys,
+                limit=limit,
+                since=since,
+            )
+            pending = {key: list(self._pending.get(key, [])) for key in stored}
+
+        return {
+            key: self._merge(usages, pending[key], limit, since)
+            for key, usages in stored.items()
+        }
+
+    @property
+    def daily_count_timezone(self) -> tzinfo | None:
+        return self._repo.daily_count_timezone
+
+    async def get_daily_count(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        day: date,
+    ) -> DailyUsageCount:
+        timezone = self._repo.daily_count_timezone
+        async with self._gate.read():
+            stored = await self._repo.get_daily_count(
+                context_id=context_id,
+                user_id=user_id,
+                day=day,
+            )
+            pending = list(self._pending.get((context_id, user_id), []))
+
+        # The repo only counts the usages once they're flushed
+        pending = [
+            usage for usage in pending if usage.time.astimezone(timezone).date() == day
+        ]
+        if not pending:
+            return stored
+
+        last_usage = max(pending, key=lambda usage: usage.time)
+        if stored.last_usage is not None and stored.last_usage.time > last_usage.time:
+            last_usage = stored.last_usage
+        return DailyUsageCount(
+            day=day,
+            count=stored.count + len(pending),
+            last_usage=last_usage,
+        )
+
+    @property
+    def supports_states(self) -> bool:
+        return self._repo.supports_states
+
+    async def get_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+    ) -> RateLimitingState | None:
+        return await self._repo.get_state(context_id=context_id, user_id=user_id)
+
+    async def compare_and_set_state(
+        self,
+        *,
+        context_id: str,
+        user_id: str,
+        expected: RateLimitingState | None,
+        state: RateLimitingState,
+    ) -> bool:
+        return await self._repo.compare_and_set_state(
+            context_id=context_id,
+            user_id=user_id,
+            expected=expected,
+            state=state,
+        )
+
+    async def drop_old_usages(
+        self,
+        *,
+        until: datetime,
+        limit: int | None = None,
+    ) -> int:
+        return await self._repo.drop_old_usages(until=until, limit=limit)
+
+    async def close(self) -> None:
+        self._is_closed = True
+        if self._flusher is not None:
+            await self._queue.put(None)
+            await self._queue.join()
+            self._flusher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flusher
+
+        await self._repo.close()
+        self._raise_flush_error()
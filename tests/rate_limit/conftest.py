@@ -1,4 +1,6 @@
+import sqlite3
 from datetime import datetime, timedelta, tzinfo
+from pathlib import Path
 from zoneinfo import ZoneInfo
 
 import pytest
@@ -47,3 +49,20 @@ def tomorrow(timezone) -> datetime:
         microsecond=0,
     )
     return result
+
+
+def _migration_version(path: Path) -> int:
+    return int(path.name[1:].split("__", maxsplit=1)[0])
+
+
+@pytest.fixture()
+def sqlite_db_file(tmp_path) -> Path:
+    migrations_dir = Path(__file__).parents[2] / "migrations" / "sqlite" / "sql"
+    db_file = tmp_path / "usages.db"
+    connection = sqlite3.connect(db_file)
+    try:
+        for migration in sorted(migrations_dir.glob("*.sql"), key=_migration_version):
+            connection.executescript(migration.read_text())
+    finally:
+        connection.close()
+    return db_file
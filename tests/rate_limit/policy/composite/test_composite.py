@@ -0,0 +1,154 @@
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from rate_limiter import Usage
+from rate_limiter.policy import (
+    CompositeRateLimitingPolicy,
+    DailyLimitRateLimitingPolicy,
+    GcraRateLimitingPolicy,
+    SlidingWindowRateLimitingPolicy,
+)
+
+_START = datetime(2024, 1, 1, 12, tzinfo=UTC)
+
+
+def _history(*minutes: int) -> list[Usage]:
+    return [
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=_START + timedelta(minutes=minute),
+            reference_id=str(minute),
+            response_id=None,
+        )
+        for minute in sorted(minutes, reverse=True)
+    ]
+
+
+class _UnknownNextAllowedTime(SlidingWindowRateLimitingPolicy):
+    def __init__(self) -> None:
+        super().__init__(limit=1, window=timedelta(hours=1))
+
+    def get_next_allowed_time(self, *, at_time, offending_usage):
+        return None
+
+
+@pytest.fixture()
+def policy() -> CompositeRateLimitingPolicy:
+    return CompositeRateLimitingPolicy(
+        policies=[
+            SlidingWindowRateLimitingPolicy(limit=1, window=timedelta(minutes=1)),
+            SlidingWindowRateLimitingPolicy(limit=3, window=timedelta(hours=1)),
+        ]
+    )
+
+
+def test_requirements(policy):
+    assert policy.requested_history == 3
+    assert policy.requested_window == timedelta(hours=1)
+
+
+def test_child_without_window():
+    policy = CompositeRateLimitingPolicy(
+        policies=[
+            SlidingWindowRateLimitingPolicy(limit=1, window=timedelta(minutes=1)),
+            DailyLimitRateLimitingPolicy(limit=2),
+        ]
+    )
+    assert policy.requested_history == 2
+    assert policy.requested_window is None
+
+
+@pytest.mark.parametrize(
+    "policies",
+    [
+        [],
+        [GcraRateLimitingPolicy(limit=1, period=timedelta(minutes=1))],
+    ],
+)
+def test_invalid_policies(policies):
+    with pytest.raises(ValueError):
+        CompositeRateLimitingPolicy(policies=policies)
+
+
+@pytest.mark.asyncio
+async def test_allow(policy):
+    assert (
+        await policy.get_offending_usage(
+            at_time=_START + timedelta(minutes=2),
+            last_usages=_history(0, 1),
+        )
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_single_denial(policy):
+    history = _history(0)
+    at_time = _START + timedelta(seconds=30)
+
+    offending_usage = await policy.get_offending_usage(
+        at_time=at_time,
+        last_usages=history,
+    )
+    assert offending_usage == history[0]
+    assert policy.get_next_allowed_time(
+        at_time=at_time,
+        offending_usage=offending_usage,
+    ) == _START + timedelta(minutes=1)
+
+
+@pytest.mark.asyncio
+async def test_most_restrictive_denial(policy):
+    history = _history(0, 1, 2)
+    at_time = _START + timedelta(minutes=2, seconds=30)
+
+    # Both policies deny, but the hourly one for longer
+    offending_usage = await policy.get_offending_usage(
+        at_time=at_time,
+        last_usages=history,
+    )
+    assert offending_usage == history[-1]
+    assert policy.get_next_allowed_time(
+        at_time=at_time,
+        offending_usage=offending_usage,
+    ) == _START + timedelta(hours=1)
+
+
+@pytest.mark.asyncio
+async def test_next_allowed_time_ignores_other_evaluations(policy):
+    history = _history(0, 1, 2)
+    at_time = _START + timedelta(minutes=2, seconds=30)
+    offending_usage = await policy.get_offending_usage(
+        at_time=at_time,
+        last_usages=history,
+    )
+
+    # Another evaluation in between, e.g. from another thread
+    await policy.get_offending_usage(
+        at_time=_START + timedelta(seconds=30),
+        last_usages=_history(0),
+    )
+
+    assert policy.get_next_allowed_time(
+        at_time=at_time,
+        offending_usage=offending_usage,
+    ) == _START + timedelta(hours=1)
+
+
+def test_next_allowed_time_with_unknown_child():
+    policy = CompositeRateLimitingPolicy(
+        policies=[
+            SlidingWindowRateLimitingPolicy(limit=1, window=timedelta(minutes=1)),
+            _UnknownNextAllowedTime(),
+        ]
+    )
+
+    assert (
+        policy.get_next_allowed_time(
+            at_time=_START,
+            offending_usage=_history(0)[0],
+        )
+        is None
+    )
@@ -1,5 +1,6 @@
 import pytest
 
+from rate_limiter import DailyUsageCount
 from rate_limiter.policy.daily_limit import DailyLimitRateLimitingPolicy
 
 
@@ -26,3 +27,32 @@ def test_invalid_limit(limit):
 def test_requested_history_matches_limit(limit):
     policy = DailyLimitRateLimitingPolicy(limit=limit)
     assert policy.requested_history == limit
+
+
+def test_next_allowed_time_is_next_midnight(now, tomorrow, create_usage):
+    policy = DailyLimitRateLimitingPolicy()
+    next_allowed_time = policy.get_next_allowed_time(
+        at_time=now,
+        offending_usage=create_usage(now),
+    )
+    assert next_allowed_time == tomorrow
+
+
+@pytest.mark.parametrize(
+    "count,is_allowed",
+    [
+        (0, True),
+        (1, True),
+        (2, False),
+        (3, False),
+    ],
+)
+@pytest.mark.asyncio
+async def test_get_offending_daily_usage(now, create_usage, count, is_allowed):
+    policy = DailyLimitRateLimitingPolicy(limit=2)
+    last_usage = create_usage(now)
+    offending_usage = await policy.get_offending_daily_usage(
+        at_time=now,
+        daily_count=DailyUsageCount(day=now.date(), count=count, last_usage=last_usage),
+    )
+    assert offending_usage is (None if is_allowed else last_usage)
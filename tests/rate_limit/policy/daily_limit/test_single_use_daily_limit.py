@@ -1,3 +1,5 @@
+from datetime import UTC, datetime
+
 import pytest
 
 from rate_limiter import RateLimitingPolicy
@@ -60,3 +62,28 @@ async def test_get_offending_usages_later_today(policy, now, create_usage, later
     usage = create_usage(later_today)
     offending_usage = await policy.get_offending_usage(at_time=now, last_usages=[usage])
     assert offending_usage is usage
+
+
+@pytest.mark.asyncio
+async def test_get_offending_usages_same_day_of_other_month(
+    policy,
+    timezone,
+    create_usage,
+):
+    usage = create_usage(datetime(2024, 1, 15, 12, tzinfo=timezone))
+    offending_usage = await policy.get_offending_usage(
+        at_time=datetime(2024, 2, 15, 12, tzinfo=timezone),
+        last_usages=[usage],
+    )
+    assert offending_usage is None
+
+
+@pytest.mark.asyncio
+async def test_get_offending_usages_utc_usage(policy, timezone, create_usage):
+    # 23:30 UTC is already the next day in Berlin
+    usage = create_usage(datetime(2024, 1, 15, 23, 30, tzinfo=UTC))
+    offending_usage = await policy.get_offending_usage(
+        at_time=datetime(2024, 1, 16, 12, tzinfo=timezone),
+        last_usages=[usage],
+    )
+    assert offending_usage is usage
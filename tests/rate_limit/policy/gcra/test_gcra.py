@@ -0,0 +1,120 @@
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from rate_limiter import RateLimitingState, Usage
+from rate_limiter.policy import GcraRateLimitingPolicy
+
+_START = datetime(2024, 1, 1, tzinfo=UTC)
+
+
+def _usage(time: datetime) -> Usage:
+    return Usage(
+        context_id="context",
+        user_id="user",
+        time=time,
+        reference_id=None,
+        response_id=None,
+    )
+
+
+def _acquire(
+    policy: GcraRateLimitingPolicy,
+    state: RateLimitingState | None,
+    time: datetime,
+) -> tuple[RateLimitingState | None, Usage | None]:
+    offending_usage = policy.get_offending_state_usage(at_time=time, state=state)
+    if offending_usage is None:
+        state = policy.record_usage(state=state, usage=_usage(time))
+    return state, offending_usage
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"limit": 0, "period": timedelta(hours=1)},
+        {"limit": 1, "period": timedelta(0)},
+        {"limit": 1, "period": timedelta(hours=1), "burst": 0},
+    ],
+)
+def test_invalid_arguments(kwargs):
+    with pytest.raises(ValueError):
+        GcraRateLimitingPolicy(**kwargs)
+
+
+def test_no_state():
+    policy = GcraRateLimitingPolicy(limit=1, period=timedelta(hours=1))
+    assert policy.get_offending_state_usage(at_time=_START, state=None) is None
+
+
+def test_burst():
+    policy = GcraRateLimitingPolicy(limit=100, period=timedelta(hours=1), burst=10)
+    state = None
+    for _ in range(10):
+        state, offending_usage = _acquire(policy, state, _START)
+        assert offending_usage is None
+
+    state, offending_usage = _acquire(policy, state, _START)
+    assert offending_usage == _usage(_START)
+
+
+def test_refill():
+    policy = GcraRateLimitingPolicy(limit=100, period=timedelta(hours=1), burst=10)
+    state = None
+    for _ in range(10):
+        state, _ = _acquire(policy, state, _START)
+
+    # One token is refilled every 36 seconds
+    state, offending_usage = _acquire(policy, state, _START + timedelta(seconds=35))
+    assert offending_usage is not None
+    state, offending_usage = _acquire(policy, state, _START + timedelta(seconds=36))
+    assert offending_usage is None
+    state, offending_usage = _acquire(policy, state, _START + timedelta(seconds=36))
+    assert offending_usage is not None
+
+
+def test_sustained_rate():
+    policy = GcraRateLimitingPolicy(limit=100, period=timedelta(hours=1), burst=10)
+    state = None
+    allowed = 0
+    for second in range(0, 3600, 6):
+        state, offending_usage = _acquire(
+            policy,
+            state,
+            _START + timedelta(seconds=second),
+        )
+        allowed += offending_usage is None
+
+    # The initial burst plus the refill over the hour
+    assert allowed == 10 + 99
+
+
+def test_next_allowed_time_without_burst():
+    policy = GcraRateLimitingPolicy(limit=100, period=timedelta(hours=1))
+    state, _ = _acquire(policy, None, _START)
+    _, offending_usage = _acquire(policy, state, _START)
+    assert offending_usage is not None
+
+    next_allowed_time = policy.get_next_allowed_time(
+        at_time=_START,
+        offending_usage=offending_usage,
+    )
+    assert next_allowed_time == _START + timedelta(seconds=36)
+    _, offending_usage = _acquire(policy, state, next_allowed_time)
+    assert offending_usage is None
+
+
+def test_next_allowed_time_is_lower_bound():
+    policy = GcraRateLimitingPolicy(limit=100, period=timedelta(hours=1), burst=10)
+    state = None
+    for _ in range(10):
+        state, _ = _acquire(policy, state, _START)
+    _, offending_usage = _acquire(policy, state, _START)
+    assert offending_usage is not None
+
+    next_allowed_time = policy.get_next_allowed_time(
+        at_time=_START,
+        offending_usage=offending_usage,
+    )
+    assert next_allowed_time is not None
+    assert next_allowed_time <= _START + timedelta(seconds=36)
@@ -0,0 +1,106 @@
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from rate_limiter import Usage
+from rate_limiter.policy import SlidingWindowRateLimitingPolicy
+
+_START = datetime(2024, 1, 1, tzinfo=UTC)
+
+
+def _history(*seconds: int) -> list[Usage]:
+    # Newest first, like the repos return them
+    return [
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=_START + timedelta(seconds=second),
+            reference_id=str(second),
+            response_id=None,
+        )
+        for second in sorted(seconds, reverse=True)
+    ]
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"limit": 0, "window": timedelta(hours=1)},
+        {"limit": 1, "window": timedelta(0)},
+    ],
+)
+def test_invalid_arguments(kwargs):
+    with pytest.raises(ValueError):
+        SlidingWindowRateLimitingPolicy(**kwargs)
+
+
+@pytest.mark.asyncio
+async def test_fewer_usages_than_limit():
+    policy = SlidingWindowRateLimitingPolicy(limit=3, window=timedelta(minutes=1))
+    assert (
+        await policy.get_offending_usage(at_time=_START, last_usages=_history(0, 1))
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_limit_reached():
+    policy = SlidingWindowRateLimitingPolicy(limit=3, window=timedelta(minutes=1))
+    history = _history(0, 10, 20)
+
+    offending_usage = await policy.get_offending_usage(
+        at_time=_START + timedelta(seconds=30),
+        last_usages=history,
+    )
+    assert offending_usage == history[-1]
+    assert policy.get_next_allowed_time(
+        at_time=_START + timedelta(seconds=30),
+        offending_usage=offending_usage,
+    ) == _START + timedelta(minutes=1)
+
+
+@pytest.mark.asyncio
+async def test_window_slides():
+    policy = SlidingWindowRateLimitingPolicy(limit=3, window=timedelta(minutes=1))
+    history = _history(0, 10, 20)
+
+    assert (
+        await policy.get_offending_usage(
+            at_time=_START + timedelta(minutes=1),
+            last_usages=history,
+        )
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_usages_after_at_time_are_ignored():
+    policy = SlidingWindowRateLimitingPolicy(limit=2, window=timedelta(minutes=1))
+    history = _history(0, 10, 20, 90)
+
+    assert (
+        await policy.get_offending_usage(
+            at_time=_START + timedelta(seconds=30),
+            last_usages=history,
+        )
+        == _history(10)[0]
+    )
+    assert (
+        await policy.get_offending_usage(
+            at_time=_START + timedelta(seconds=5),
+            last_usages=history,
+        )
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_large_history():
+    policy = SlidingWindowRateLimitingPolicy(limit=5000, window=timedelta(hours=2))
+    history = _history(*range(0, 10_000))
+
+    offending_usage = await policy.get_offending_usage(
+        at_time=_START + timedelta(seconds=9_999),
+        last_usages=history,
+    )
+    assert offending_usage == _history(5_000)[0]
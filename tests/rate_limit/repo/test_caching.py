@@ -0,0 +1,276 @@
+from datetime import UTC, datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from rate_limiter import Usage
+from rate_limiter.repo import (
+    CacheStatistics,
+    CachingRateLimitingRepo,
+    SqliteRateLimitingRepo,
+)
+
+
+class _CountingRepo(SqliteRateLimitingRepo):
+    reads: int = 0
+
+    async def get_usages(self, **kwargs):
+        self.reads += 1
+        return await super().get_usages(**kwargs)
+
+    async def get_usages_many(self, **kwargs):
+        self.reads += 1
+        return await super().get_usages_many(**kwargs)
+
+
+@pytest_asyncio.fixture
+async def inner_repo(sqlite_db_file):
+    return await _CountingRepo.connect(sqlite_db_file)
+
+
+@pytest_asyncio.fixture
+async def repo(inner_repo):
+    repo = CachingRateLimitingRepo(inner_repo, max_entries=2)
+    try:
+        yield repo
+    finally:
+        await repo.close()
+
+
+@pytest.fixture()
+def start() -> datetime:
+    return datetime.now(UTC).replace(microsecond=0)
+
+
+async def _add(repo, user_id: str, time: datetime) -> None:
+    await repo.add_usage(
+        context_id="context",
+        user_id=user_id,
+        utc_time=time,
+        reference_id=None,
+        response_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_repeated_reads_hit_cache(repo, inner_repo, start):
+    await _add(repo, "user", start)
+
+    for _ in range(3):
+        usages = await repo.get_usages(context_id="context", user_id="user")
+        assert [usage.time for usage in usages] == [start]
+
+    assert inner_repo.reads == 1
+    assert repo.statistics.hits == 2
+    assert repo.statistics.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_writes_update_cache(repo, inner_repo, start):
+    await _add(repo, "user", start)
+    await repo.get_usages(context_id="context", user_id="user", limit=2)
+    await _add(repo, "user", start + timedelta(seconds=1))
+    await _add(repo, "user", start + timedelta(seconds=2))
+
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=2)
+
+    assert [usage.time for usage in usages] == [
+        start + timedelta(seconds=2),
+        start + timedelta(seconds=1),
+    ]
+    assert inner_repo.reads == 1
+
+
+@pytest.mark.asyncio
+async def test_deeper_history_is_fetched(repo, inner_repo, start):
+    await _add(repo, "user", start)
+    await _add(repo, "user", start + timedelta(seconds=1))
+    await repo.get_usages(context_id="context", user_id="user", limit=1)
+
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=2)
+
+    assert len(usages) == 2
+    assert inner_repo.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction(repo, inner_repo):
+    for user_id in ["a", "b", "a", "c", "a"]:
+        await repo.get_usages(context_id="context", user_id=user_id)
+
+    assert repo.statistics == CacheStatistics(
+        hits=2,
+        misses=3,
+        evictions=1,
+    )
+
+
+@pytest.mark.asyncio
+async def test_drop_old_usages_purges_cache(repo, inner_repo, start):
+    await _add(repo, "user", start - timedelta(days=2))
+    await repo.get_usages_many(keys=[("context", "user")])
+
+    await repo.drop_old_usages(until=start - timedelta(days=1))
+
+    assert await repo.get_usages(context_id="context", user_id="user") == []
+    assert inner_repo.reads == 1
+
+
+@pytest.mark.asyncio
+async def test_drop_old_usages_with_limit_refetches(repo, inner_repo, start):
+    await _add(repo, "user", start - timedelta(days=3))
+    await _add(repo, "user", start - timedelta(days=2))
+    await repo.get_usages(context_id="context", user_id="user", limit=2)
+
+    assert await repo.drop_old_usages(until=start - timedelta(days=1), limit=1) == 1
+
+    # One of the old usages is still stored, so the cache must not hide it
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=2)
+    assert usages == await inner_repo.get_usages(
+        context_id="context",
+        user_id="user",
+        limit=2,
+    )
+    assert len(usages) == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_check_does_not_leak_fetch_tokens(repo, start):
+    async def _check(history: list[Usage]) -> Usage | None:
+        raise RuntimeError("Policy failed")
+
+    with pytest.raises(RuntimeError):
+        await repo.add_usage_if_allowed(
+            context_id="context",
+            user_id="user",
+            utc_time=start,
+            reference_id=None,
+            response_id=None,
+            limit=1,
+            check=_check,
+        )
+
+    assert repo._fetch_tokens == {}
+
+
+@pytest.mark.asyncio
+async def test_expired_entries_are_refetched(inner_repo, start):
+    repo = CachingRateLimitingRepo(inner_repo, ttl=timedelta(0))
+    await repo.get_usages(context_id="context", user_id="user")
+    await repo.get_usages(context_id="context", user_id="user")
+    await repo.close()
+
+    assert inner_repo.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_add_usage_if_allowed_fills_cache(repo, inner_repo, start):
+    async def _check(history: list[Usage]) -> Usage | None:
+        return None
+
+    await repo.add_usage_if_allowed(
+        context_id="context",
+        user_id="user",
+        utc_time=start,
+        reference_id=None,
+        response_id=None,
+        limit=1,
+        check=_check,
+    )
+    usages = await repo.get_usages(context_id="context", user_id="user")
+
+    assert [usage.time for usage in usages] == [start]
+    assert inner_repo.reads == 0
+
+
+class _RetryingRepo(SqliteRateLimitingRepo):
+    # Checks once more, like a repo whose optimistic write lost a race
+    async def add_usage_if_allowed(self, **kwargs):
+        history = await self.get_usages(
+            context_id=kwargs["context_id"],
+            user_id=kwargs["user_id"],
+            limit=kwargs["limit"],
+        )
+        await kwargs["check"](history)
+        return await super().add_usage_if_allowed(**kwargs)
+
+
+@pytest.mark.asyncio
+async def test_add_usage_if_allowed_caches_last_history(sqlite_db_file, start):
+    inner_repo = await _RetryingRepo.connect(sqlite_db_file)
+    repo = CachingRateLimitingRepo(inner_repo)
+    checks = 0
+
+    async def _check(history: list[Usage]) -> Usage | None:
+        nonlocal checks
+        checks += 1
+        return None
+
+    try:
+        await _add(inner_repo, "user", start - timedelta(minutes=2))
+        await _add(inner_repo, "user", start - timedelta(minutes=1))
+        await repo.add_usage_if_allowed(
+            context_id="context",
+            user_id="user",
+            utc_time=start,
+            reference_id=None,
+            response_id=None,
+            limit=5,
+            check=_check,
+        )
+
+        cached = await repo.get_usages(context_id="context", user_id="user", limit=5)
+        stored = await inner_repo.get_usages(
+            context_id="context",
+            user_id="user",
+            limit=5,
+        )
+    finally:
+        await repo.close()
+
+    assert checks == 2
+    assert cached == stored
+    assert len(cached) == 3
+
+
+@pytest.mark.asyncio
+async def test_cached_usages_are_filtered_by_since(repo, inner_repo, start):
+    for minutes in range(3):
+        await _add(repo, "user", start - timedelta(minutes=minutes))
+
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=3)
+    assert len(usages) == 3
+
+    since = start - timedelta(minutes=1)
+    assert (
+        await repo.get_usages(
+            context_id="context",
+            user_id="user",
+            limit=3,
+            since=since,
+        )
+        == usages[:2]
+    )
+    assert inner_repo.reads == 1
+
+
+@pytest.mark.asyncio
+async def test_daily_count(sqlite_db_file, timezone, start):
+    inner_repo = await SqliteRateLimitingRepo.connect(
+        sqlite_db_file,
+        daily_count_timezone=timezone,
+    )
+    repo = CachingRateLimitingRepo(inner_repo)
+    try:
+        assert repo.daily_count_timezone == timezone
+        await _add(repo, "user", start)
+
+        daily_count = await repo.get_daily_count(
+            context_id="context",
+            user_id="user",
+            day=start.astimezone(timezone).date(),
+        )
+    finally:
+        await repo.close()
+
+    assert daily_count.count == 1
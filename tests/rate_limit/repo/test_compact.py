@@ -0,0 +1,167 @@
+import tracemalloc
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from rate_limiter import Usage
+from rate_limiter.repo import CompactInMemoryRateLimitingRepo, InMemoryRateLimitingRepo
+
+
+@pytest.fixture()
+def repo() -> CompactInMemoryRateLimitingRepo:
+    return CompactInMemoryRateLimitingRepo(max_history=3)
+
+
+@pytest.fixture()
+def start() -> datetime:
+    return datetime.now(UTC).replace(microsecond=0)
+
+
+def _usage(
+    time: datetime,
+    user_id: str = "user",
+    reference_id: str | None = None,
+) -> Usage:
+    return Usage(
+        context_id="context",
+        user_id=user_id,
+        time=time,
+        reference_id=reference_id,
+        response_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_no_usages(repo):
+    assert await repo.get_usages(context_id="context", user_id="user") == []
+
+
+@pytest.mark.asyncio
+async def test_keeps_newest_usages(repo, start):
+    usages = [
+        _usage(start + timedelta(seconds=i), reference_id=str(i)) for i in range(5)
+    ]
+    await repo.add_usages(usages)
+
+    stored = await repo.get_usages(context_id="context", user_id="user", limit=3)
+
+    assert stored == usages[:1:-1]
+
+
+@pytest.mark.asyncio
+async def test_out_of_order_usages(repo, start):
+    usages = [
+        _usage(start + timedelta(seconds=i), reference_id=str(i)) for i in range(4)
+    ]
+    await repo.add_usages([usages[1], usages[3], usages[0], usages[2]])
+
+    stored = await repo.get_usages(context_id="context", user_id="user", limit=3)
+
+    assert stored == usages[:0:-1]
+
+
+@pytest.mark.asyncio
+async def test_limit_exceeds_history(repo):
+    with pytest.raises(ValueError):
+        await repo.get_usages(context_id="context", user_id="user", limit=4)
+
+
+@pytest.mark.asyncio
+async def test_drop_old_usages(repo, start):
+    old = start - timedelta(days=2)
+    await repo.add_usages(
+        [
+            _usage(old, user_id="old", reference_id="old"),
+            _usage(old, user_id="mixed"),
+            _usage(start, user_id="mixed"),
+        ]
+    )
+
+    await repo.drop_old_usages(until=start - timedelta(days=1))
+
+    assert await repo.get_usages_many(
+        keys=[("context", "old"), ("context", "mixed")],
+        limit=3,
+    ) == {
+        ("context", "old"): [],
+        ("context", "mixed"): [_usage(start, user_id="mixed")],
+    }
+    assert repo._free_slots == [0]
+    assert repo._reference_ids == {}
+
+    # Released slots are reused
+    await repo.add_usage(
+        context_id="context",
+        user_id="new",
+        utc_time=start,
+        reference_id=None,
+        response_id=None,
+    )
+    assert repo._free_slots == []
+
+
+@pytest.mark.asyncio
+async def test_default_max_history():
+    repo = CompactInMemoryRateLimitingRepo()
+
+    assert await repo.get_usages(context_id="context", user_id="user", limit=100) == []
+    with pytest.raises(ValueError):
+        await repo.get_usages(context_id="context", user_id="user", limit=101)
+
+
+@pytest.mark.parametrize("max_history", [1, 10])
+@pytest.mark.asyncio
+async def test_memory_per_usage(max_history, start):
+    key_count = 10_000
+    user_ids = [f"user-{index}" for index in range(key_count)]
+    times = [start + timedelta(seconds=i) for i in range(max_history)]
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        repo = CompactInMemoryRateLimitingRepo(max_history=max_history)
+        for user_id in user_ids:
+            for time in times:
+                await repo.add_usage(
+                    context_id="context",
+                    user_id=user_id,
+                    utc_time=time,
+                    reference_id=None,
+                    response_id=None,
+                )
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    # See the numbers documented on the class
+    assert used / key_count < 100 + 8 * max_history
+
+
+@pytest.mark.asyncio
+async def test_snapshot_and_restore(repo, start, tmp_path):
+    usages = [
+        _usage(start - timedelta(days=2), user_id="old"),
+        *[_usage(start + timedelta(seconds=i), reference_id=str(i)) for i in range(4)],
+    ]
+    await repo.add_usages(usages)
+    await repo.snapshot(tmp_path / "snapshot")
+
+    # Snapshots can be restored into the other in-memory repos, too
+    in_memory = InMemoryRateLimitingRepo()
+    assert await in_memory.restore(tmp_path / "snapshot") == 4
+    restored = CompactInMemoryRateLimitingRepo(max_history=2)
+    assert (
+        await restored.restore(
+            tmp_path / "snapshot",
+            until=start - timedelta(days=1),
+        )
+        == 2
+    )
+
+    for target in (in_memory, restored):
+        assert await target.get_usages(
+            context_id="context",
+            user_id="user",
+            limit=2,
+        ) == [usages[4], usages[3]]
+    assert await restored.get_usages(context_id="context", user_id="old") == []
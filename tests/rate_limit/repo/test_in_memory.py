@@ -0,0 +1,390 @@
+import asyncio
+import gc
+import time
+from collections.abc import Awaitable
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+from rate_limiter import RateLimitingState, Usage
+from rate_limiter.repo import (
+    CompactInMemoryRateLimitingRepo,
+    InMemoryRateLimitingRepo,
+    SyncInMemoryRateLimitingRepo,
+)
+
+
+@pytest.fixture()
+def repo() -> InMemoryRateLimitingRepo:
+    return InMemoryRateLimitingRepo()
+
+
+@pytest.mark.asyncio
+async def test_add_usage_if_allowed_is_atomic(repo):
+    timestamp = datetime.now(UTC)
+
+    async def _check(history: list[Usage]) -> Usage | None:
+        # Give concurrent acquisitions a chance to interleave
+        await asyncio.sleep(0)
+        return history[0] if history else None
+
+    results = await asyncio.gather(
+        *[
+            repo.add_usage_if_allowed(
+                context_id="context",
+                user_id="user",
+                utc_time=timestamp,
+                reference_id=str(i),
+                response_id=None,
+                limit=1,
+                check=_check,
+            )
+            for i in range(5)
+        ]
+    )
+
+    assert sum(result is None for result in results) == 1
+    assert await repo.get_usages(context_id="context", user_id="user") == [
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=timestamp,
+            reference_id="0",
+            response_id=None,
+        )
+    ]
+
+
+def _usage(time: datetime, user_id: str = "user") -> Usage:
+    return Usage(
+        context_id="context",
+        user_id=user_id,
+        time=time,
+        reference_id=None,
+        response_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_keeps_multiple_usages(repo):
+    start = datetime.now(UTC)
+    usages = [_usage(start + timedelta(seconds=i)) for i in range(3)]
+    await repo.add_usages([usages[0], usages[2], usages[1]])
+
+    stored = await repo.get_usages(context_id="context", user_id="user", limit=5)
+
+    assert stored == usages[::-1]
+
+
+@pytest.mark.asyncio
+async def test_history_is_bounded():
+    repo = InMemoryRateLimitingRepo(max_history=2)
+    start = datetime.now(UTC)
+    usages = [_usage(start + timedelta(seconds=i)) for i in range(4)]
+    await repo.add_usages(usages)
+    await repo.add_usage(
+        context_id="context",
+        user_id="user",
+        utc_time=start - timedelta(days=1),
+        reference_id=None,
+        response_id=None,
+    )
+
+    stored = await repo.get_usages(context_id="context", user_id="user", limit=2)
+
+    assert stored == [usages[3], usages[2]]
+
+
+@pytest.mark.asyncio
+async def test_drop_old_usages(repo):
+    now = datetime.now(UTC)
+    await repo.add_usages(
+        [
+            _usage(now - timedelta(days=3), user_id="old"),
+            _usage(now - timedelta(days=3), user_id="mixed"),
+            _usage(now, user_id="mixed"),
+            _usage(now, user_id="new"),
+        ]
+    )
+
+    await repo.drop_old_usages(until=now - timedelta(days=1))
+    # Dropping again must not find anything left to drop
+    await repo.drop_old_usages(until=now - timedelta(days=1))
+
+    usages = await repo.get_usages_many(
+        keys=[("context", "old"), ("context", "mixed"), ("context", "new")],
+        limit=5,
+    )
+    assert usages == {
+        ("context", "old"): [],
+        ("context", "mixed"): [_usage(now, user_id="mixed")],
+        ("context", "new"): [_usage(now, user_id="new")],
+    }
+
+    await repo.drop_old_usages(until=now + timedelta(seconds=1))
+    assert repo._usages == {}
+    assert repo._expiry_index == []
+
+
+@pytest.mark.asyncio
+async def test_compare_and_set_state(repo):
+    timestamp = datetime.now(UTC)
+    assert await repo.get_state(context_id="context", user_id="user") is None
+
+    first = RateLimitingState(value=1.0, last_usage=_usage(timestamp))
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=first,
+    )
+    stored = await repo.get_state(context_id="context", user_id="user")
+    assert stored is not None
+    assert stored.value == 1.0
+
+    second = RateLimitingState(value=2.0, last_usage=_usage(timestamp))
+    # Somebody else stored a state in the meantime
+    assert not await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=second,
+    )
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=stored,
+        state=second,
+    )
+    assert not await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=stored,
+        state=second,
+    )
+
+    await repo.drop_old_usages(until=timestamp + timedelta(seconds=1))
+    assert await repo.get_state(context_id="context", user_id="user") is None
+
+
+@pytest.mark.asyncio
+async def test_get_usages_since(repo):
+    timestamp = datetime.now(UTC)
+    await repo.add_usages(
+        [_usage(timestamp - timedelta(minutes=minutes)) for minutes in range(5)]
+    )
+
+    usages = await repo.get_usages(
+        context_id="context",
+        user_id="user",
+        limit=4,
+        since=timestamp - timedelta(minutes=2),
+    )
+    assert usages == [_usage(timestamp - timedelta(minutes=m)) for m in range(3)]
+
+
+@pytest.mark.asyncio
+async def test_drop_old_usages_in_chunks(repo):
+    now = datetime.now(UTC)
+    await repo.add_usages(
+        [_usage(now - timedelta(days=3), user_id=f"user{i}") for i in range(3)]
+    )
+
+    assert await repo.drop_old_usages(until=now, limit=2) == 2
+    assert await repo.drop_old_usages(until=now, limit=2) == 1
+    assert await repo.drop_old_usages(until=now, limit=2) == 0
+    assert repo._usages == {}
+
+
+@pytest.mark.asyncio
+async def test_drop_old_states_in_chunks(repo):
+    now = datetime.now(UTC)
+    for i in range(3):
+        old = _usage(now - timedelta(days=3), user_id=f"user{i}")
+        assert await repo.compare_and_set_state(
+            context_id="context",
+            user_id=f"user{i}",
+            expected=None,
+            state=RateLimitingState(value=1.0, last_usage=old),
+        )
+    # Used again since, so only its newer usage counts
+    stored = await repo.get_state(context_id="context", user_id="user0")
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user0",
+        expected=stored,
+        state=RateLimitingState(value=2.0, last_usage=_usage(now, user_id="user0")),
+    )
+
+    assert await repo.drop_old_usages(until=now, limit=1) == 1
+    assert await repo.drop_old_usages(until=now, limit=1) == 1
+    assert await repo.drop_old_usages(until=now, limit=1) == 0
+    assert list(repo._states) == [("context", "user0")]
+    assert repo._state_expiry_index == [(now, ("context", "user0"))]
+
+
+@pytest.mark.asyncio
+async def test_snapshot_and_restore(repo, tmp_path):
+    now = datetime.now(UTC)
+    old = _usage(now - timedelta(days=2), user_id="old")
+    usages = [
+        _usage(now - timedelta(days=2)),
+        _usage(now - timedelta(seconds=1)),
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=now,
+            reference_id="référence",
+            response_id=None,
+        ),
+    ]
+    await repo.add_usages([old, *usages])
+    state = RateLimitingState(value=1.5, last_usage=usages[2])
+    await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=state,
+    )
+    await repo.snapshot(tmp_path / "snapshot")
+
+    restored = InMemoryRateLimitingRepo(max_history=2)
+    await restored.add_usages([_usage(now, user_id="other")])
+    assert (
+        await restored.restore(
+            tmp_path / "snapshot",
+            until=now - timedelta(days=1),
+        )
+        == 3
+    )
+
+    assert await restored.get_usages_many(
+        keys=[("context", "user"), ("context", "old"), ("context", "other")],
+        limit=2,
+    ) == {
+        ("context", "user"): [usages[2], usages[1]],
+        ("context", "old"): [],
+        ("context", "other"): [],
+    }
+    assert await restored.get_state(context_id="context", user_id="user") == state
+    assert await restored.drop_old_usages(until=now) == 1
+
+
+@pytest.mark.asyncio
+async def test_snapshots_on_close(repo, tmp_path):
+    path = tmp_path / "snapshot"
+    repo.start_snapshots(path, interval=timedelta(milliseconds=10))
+    now = datetime.now(UTC)
+    await repo.add_usages([_usage(now)])
+    await asyncio.sleep(0.05)
+    assert path.exists()
+
+    await repo.add_usages([_usage(now + timedelta(seconds=1))])
+    await repo.close()
+
+    restored = InMemoryRateLimitingRepo()
+    assert await restored.restore(path) == 2
+    # Only the snapshot itself is left
+    assert list(tmp_path.iterdir()) == [path]
+
+
+@pytest.mark.asyncio
+async def test_restore_rejects_other_files(repo, tmp_path):
+    await repo.snapshot(tmp_path / "snapshot")
+    data = bytearray((tmp_path / "snapshot").read_bytes())
+    data[-5] ^= 0xFF
+    (tmp_path / "snapshot").write_bytes(data)
+
+    with pytest.raises(ValueError):
+        await repo.restore(tmp_path / "snapshot")
+
+    (tmp_path / "other").write_bytes(b"SQLite format 3\0")
+    with pytest.raises(ValueError):
+        await repo.restore(tmp_path / "other")
+
+
+async def _longest_stall(operation: Awaitable[object]) -> tuple[float, float]:
+    # Returns how long the operation took and the longest time in between in
+    # which the event loop couldn't run anything else
+    longest = 0.0
+    finished = asyncio.Event()
+
+    async def _tick() -> None:
+        nonlocal longest
+        last = time.perf_counter()
+        while not finished.is_set():
+            await asyncio.sleep(0.001)
+            now = time.perf_counter()
+            longest = max(longest, now - last)
+            last = now
+
+    ticks = asyncio.create_task(_tick())
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await operation
+    duration = time.perf_counter() - started
+    finished.set()
+    await ticks
+    return duration, longest
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "repo_type",
+    [InMemoryRateLimitingRepo, CompactInMemoryRateLimitingRepo],
+)
+async def test_snapshot_and_restore_dont_block(repo_type, tmp_path):
+    # The compact repo keeps whole seconds
+    now = datetime.now(UTC).replace(microsecond=0)
+    key_count = 50_000
+    repo = repo_type(max_history=10)
+    await repo.add_usages(
+        [_usage(now, user_id=f"user-{index}") for index in range(key_count)]
+    )
+    restored = repo_type(max_history=10)
+
+    # Collections are the interpreter's pauses, not the repo's
+    gc.disable()
+    try:
+        duration, stall = await _longest_stall(repo.snapshot(tmp_path / "snapshot"))
+        assert stall < duration / 4
+        duration, stall = await _longest_stall(restored.restore(tmp_path / "snapshot"))
+        assert stall < duration / 4
+    finally:
+        gc.enable()
+
+    assert await restored.get_usages(
+        context_id="context",
+        user_id=f"user-{key_count - 1}",
+    ) == [_usage(now, user_id=f"user-{key_count - 1}")]
+
+
+def test_sync_snapshot_keeps_any_ids(tmp_path):
+    now = datetime.now(UTC)
+    usages = [
+        Usage(
+            context_id="con\0text",
+            user_id="",
+            time=now + timedelta(seconds=i),
+            reference_id=reference_id,
+            response_id="",
+        )
+        for i, reference_id in enumerate([None, "", "a\0b", "\udcff"])
+    ]
+    repo = SyncInMemoryRateLimitingRepo()
+    repo.add_usages(usages)
+    repo.snapshot(tmp_path / "snapshot")
+
+    restored = SyncInMemoryRateLimitingRepo()
+    assert restored.restore(tmp_path / "snapshot") == 4
+    assert restored.get_usages(context_id="con\0text", user_id="", limit=4) == [
+        *reversed(usages)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rejects_limit_beyond_max_history():
+    repo = InMemoryRateLimitingRepo(max_history=2)
+
+    with pytest.raises(ValueError):
+        await repo.get_usages(context_id="context", user_id="user", limit=3)
@@ -1,9 +1,10 @@
-from datetime import UTC, datetime
+import asyncio
+from datetime import UTC, datetime, timedelta
 
 import pytest
 import pytest_asyncio
 
-from rate_limiter import Usage
+from rate_limiter import DailyUsageCount, RateLimitingState, Usage
 from rate_limiter.repo import PostgresRateLimitingRepo
 
 
@@ -19,7 +20,7 @@ async def repo():
         yield repo
     finally:
         async with repo._cursor() as cursor:
-            await cursor.execute("TRUNCATE TABLE usages;")
+            await cursor.execute("TRUNCATE TABLE usages, limiter_states;")
         await repo.close()
 
 
@@ -52,3 +53,287 @@ async def test_add_usage(repo):
             response_id="response",
         )
     ]
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_add_usage_if_allowed_is_atomic(repo):
+    start = datetime.now(UTC)
+
+    async def _check(history: list[Usage]) -> Usage | None:
+        await asyncio.sleep(0)
+        return history[0] if len(history) >= 2 else None
+
+    results = await asyncio.gather(
+        *[
+            repo.add_usage_if_allowed(
+                context_id="context",
+                user_id="user",
+                utc_time=start + timedelta(seconds=i),
+                reference_id=None,
+                response_id=None,
+                limit=2,
+                check=_check,
+            )
+            for i in range(5)
+        ]
+    )
+
+    assert sum(result is None for result in results) == 2
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=10)
+    assert len(usages) == 2
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_get_usages_many(repo):
+    start = datetime.now(UTC)
+    for i in range(3):
+        await repo.add_usage(
+            context_id="context",
+            user_id="user",
+            utc_time=start + timedelta(seconds=i),
+            reference_id=str(i),
+            response_id=None,
+        )
+
+    usages = await repo.get_usages_many(
+        keys=[("context", "user"), ("context", "nobody")],
+        limit=2,
+    )
+
+    assert [usage.reference_id for usage in usages[("context", "user")]] == ["2", "1"]
+    assert usages[("context", "nobody")] == []
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_add_usages(repo):
+    start = datetime.now(UTC)
+    usages = [
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=start + timedelta(seconds=i),
+            reference_id=str(i),
+            response_id=None,
+        )
+        for i in range(100)
+    ]
+
+    await repo.add_usages(usages)
+
+    stored = await repo.get_usages(context_id="context", user_id="user", limit=200)
+    assert stored == usages[::-1]
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_compare_and_set_state(repo):
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+    usage = Usage(
+        context_id="context",
+        user_id="user",
+        time=timestamp,
+        reference_id="ref",
+        response_id=None,
+    )
+    assert await repo.get_state(context_id="context", user_id="user") is None
+
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=RateLimitingState(value=1.5, last_usage=usage),
+    )
+    stored = await repo.get_state(context_id="context", user_id="user")
+    assert stored == RateLimitingState(value=1.5, last_usage=usage, version=0)
+
+    # Somebody else stored a state in the meantime
+    assert not await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=RateLimitingState(value=2.5, last_usage=usage),
+    )
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=stored,
+        state=RateLimitingState(value=2.5, last_usage=usage),
+    )
+    assert not await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=stored,
+        state=RateLimitingState(value=3.5, last_usage=usage),
+    )
+    assert await repo.get_state(
+        context_id="context",
+        user_id="user",
+    ) == RateLimitingState(value=2.5, last_usage=usage, version=1)
+
+    await repo.drop_old_usages(until=timestamp + timedelta(seconds=1))
+    assert await repo.get_state(context_id="context", user_id="user") is None
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_daily_count(timezone):
+    repo = await PostgresRateLimitingRepo.connect(
+        host="localhost",
+        database="postgres",
+        username="postgres",
+        password="notsecret",
+        daily_count_timezone=timezone,
+    )
+    day = datetime(2024, 3, 1, 12, tzinfo=timezone)
+    usages = [
+        Usage(
+            context_id="context",
+            user_id="counted",
+            time=time.astimezone(UTC),
+            reference_id=str(index),
+            response_id=None,
+        )
+        for index, time in enumerate(
+            [
+                day - timedelta(days=1),
+                day.replace(hour=0, minute=0),
+                day + timedelta(hours=2),
+                day,
+            ]
+        )
+    ]
+    try:
+        await repo.add_usages(usages[:2])
+        for usage in usages[2:]:
+            await repo.add_usage(
+                context_id=usage.context_id,
+                user_id=usage.user_id,
+                utc_time=usage.time,
+                reference_id=usage.reference_id,
+                response_id=usage.response_id,
+            )
+
+        daily_count = await repo.get_daily_count(
+            context_id="context",
+            user_id="counted",
+            day=day.date(),
+        )
+        assert daily_count == DailyUsageCount(
+            day=day.date(),
+            count=3,
+            last_usage=usages[2],
+        )
+    finally:
+        async with repo._cursor() as cursor:
+            await cursor.execute("TRUNCATE TABLE usages, daily_usage_counters;")
+        await repo.close()
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_without_prepared_statements():
+    repo = await PostgresRateLimitingRepo.connect(
+        host="localhost",
+        database="postgres",
+        username="postgres",
+        password="notsecret",
+        prepare_threshold=None,
+    )
+    try:
+        timestamp = datetime.now(UTC)
+        await repo.add_usage(
+            context_id="context",
+            user_id="unprepared",
+            utc_time=timestamp,
+            reference_id=None,
+            response_id=None,
+        )
+        usages = await repo.get_usages(context_id="context", user_id="unprepared")
+        assert [usage.time for usage in usages] == [timestamp]
+    finally:
+        async with repo._cursor() as cursor:
+            await cursor.execute("TRUNCATE TABLE usages;")
+        await repo.close()
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_drop_partitions():
+    repo = await PostgresRateLimitingRepo.connect(
+        host="localhost",
+        database="postgres",
+        username="postgres",
+        password="notsecret",
+        drop_partitions=True,
+    )
+    now = datetime.now(UTC)
+    old_day = (now - timedelta(days=3)).date()
+    try:
+        async with repo._cursor() as cursor:
+            await cursor.execute(
+                "SELECT create_usage_partitions(%s, %s)",
+                [old_day, old_day],
+            )
+
+        for time in (now - timedelta(days=3), now):
+            await repo.add_usage(
+                context_id="context",
+                user_id="partitioned",
+                utc_time=time,
+                reference_id=None,
+                response_id=None,
+            )
+
+        await repo.drop_old_usages(until=now - timedelta(days=1))
+
+        usages = await repo.get_usages(
+            context_id="context",
+            user_id="partitioned",
+            limit=2,
+        )
+        assert [usage.time for usage in usages] == [now]
+        async with repo._cursor() as cursor:
+            await cursor.execute(
+                "SELECT to_regclass(%s)",
+                [f"usages_{old_day:%Y%m%d}"],
+            )
+            assert await cursor.fetchone() == (None,)
+    finally:
+        async with repo._cursor() as cursor:
+            await cursor.execute("TRUNCATE TABLE usages;")
+        await repo.close()
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_partitions_are_maintained_once_per_pass(repo):
+    maintained: list[datetime] = []
+    maintain_partitions = repo._maintain_partitions
+
+    async def _counting_maintain_partitions(until: datetime) -> None:
+        maintained.append(until)
+        await maintain_partitions(until)
+
+    repo._maintain_partitions = _counting_maintain_partitions
+    now = datetime.now(UTC)
+    await repo.add_usages(
+        Usage(
+            context_id="context",
+            user_id="chunked",
+            time=now - timedelta(days=2, seconds=i),
+            reference_id=None,
+            response_id=None,
+        )
+        for i in range(5)
+    )
+
+    until = now - timedelta(days=1)
+    dropped = [await repo.drop_old_usages(until=until, limit=2) for _ in range(4)]
+    assert dropped == [2, 2, 1, 0]
+    assert maintained == [until]
+
+    await repo.drop_old_usages(until=now)
+    assert maintained == [until, now]
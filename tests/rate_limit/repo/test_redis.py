@@ -0,0 +1,232 @@
+import asyncio
+import shutil
+import socket
+import subprocess
+from collections.abc import AsyncGenerator, Generator
+from datetime import UTC, datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from rate_limiter import RateLimitingState, Usage
+from rate_limiter.repo import RedisRateLimitingRepo
+
+redis = pytest.importorskip("redis")
+
+
+@pytest.fixture(scope="module")
+def redis_port() -> Generator[int, None, None]:
+    executable = shutil.which("redis-server")
+    if executable is None:
+        pytest.skip("redis-server is not installed")
+
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+
+    process = subprocess.Popen(
+        [executable, "--port", str(port), "--save", "", "--appendonly", "no"],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        yield port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@pytest_asyncio.fixture
+async def repo(redis_port) -> AsyncGenerator[RedisRateLimitingRepo, None]:
+    for _ in range(50):
+        try:
+            repo = await RedisRateLimitingRepo.connect(
+                host="localhost",
+                port=redis_port,
+                ttl=timedelta(days=1),
+                max_history=10,
+            )
+            break
+        except redis.exceptions.ConnectionError:
+            # The server may still be starting
+            await asyncio.sleep(0.1)
+    else:
+        pytest.fail("Could not connect to redis-server")
+
+    try:
+        yield repo
+    finally:
+        await repo._client.flushdb()
+        await repo.close()
+
+
+def _usage(time: datetime, user_id: str = "user") -> Usage:
+    return Usage(
+        context_id="context",
+        user_id=user_id,
+        time=time,
+        reference_id="ref",
+        response_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_keys_of_a_user_share_a_slot():
+    # Doesn't connect, so no server is needed
+    repo = RedisRateLimitingRepo(redis.asyncio.Redis(), ttl=timedelta(days=1))
+    try:
+        for context_id, user_id in [("context", "user"), ("{con}text", "us}er")]:
+            slots = {
+                redis.crc.key_slot(repo._key(kind, context_id, user_id).encode())
+                for kind in ("usages", "version", "state")
+            }
+            assert len(slots) == 1
+    finally:
+        await repo.close()
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_no_usages(repo):
+    assert await repo.get_usages(context_id="context", user_id="user") == []
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_add_usage(repo):
+    timestamp = datetime.now(UTC)
+    await repo.add_usage(
+        context_id="context",
+        user_id="user",
+        utc_time=timestamp,
+        reference_id="ref",
+        response_id=None,
+    )
+
+    assert await repo.get_usages(context_id="context", user_id="user") == [
+        _usage(timestamp)
+    ]
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_add_usage_if_allowed_is_atomic(repo):
+    timestamp = datetime.now(UTC)
+
+    async def _check(history: list[Usage]) -> Usage | None:
+        # Give concurrent acquisitions a chance to interleave
+        await asyncio.sleep(0)
+        return history[0] if history else None
+
+    results = await asyncio.gather(
+        *[
+            repo.add_usage_if_allowed(
+                context_id="context",
+                user_id="user",
+                utc_time=timestamp,
+                reference_id="ref",
+                response_id=None,
+                limit=1,
+                check=_check,
+            )
+            for _ in range(5)
+        ]
+    )
+
+    assert sum(result is None for result in results) == 1
+    assert await repo.get_usages(context_id="context", user_id="user", limit=5) == [
+        _usage(timestamp)
+    ]
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_history_is_capped_and_ordered(repo):
+    timestamp = datetime.now(UTC)
+    usages = [_usage(timestamp - timedelta(minutes=minutes)) for minutes in range(15)]
+    # Out of order on purpose
+    await repo.add_usages(reversed(usages))
+
+    assert (
+        await repo.get_usages(context_id="context", user_id="user", limit=10)
+        == (usages[:10])
+    )
+    assert (
+        await repo.get_usages(
+            context_id="context",
+            user_id="user",
+            limit=10,
+            since=timestamp - timedelta(minutes=2),
+        )
+        == usages[:3]
+    )
+    with pytest.raises(ValueError):
+        await repo.get_usages(context_id="context", user_id="user", limit=11)
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_get_usages_many(repo):
+    timestamp = datetime.now(UTC)
+    await repo.add_usages([_usage(timestamp, "a"), _usage(timestamp, "b")])
+
+    assert await repo.get_usages_many(
+        keys=[("context", "a"), ("context", "b"), ("context", "c")],
+    ) == {
+        ("context", "a"): [_usage(timestamp, "a")],
+        ("context", "b"): [_usage(timestamp, "b")],
+        ("context", "c"): [],
+    }
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_keys_expire(repo):
+    await repo.add_usage(
+        context_id="context",
+        user_id="user",
+        utc_time=datetime.now(UTC),
+        reference_id=None,
+        response_id=None,
+    )
+
+    ttl = await repo._client.pttl(repo._key("usages", "context", "user"))
+    assert 0 < ttl <= timedelta(days=1) // timedelta(milliseconds=1)
+
+
+@pytest.mark.local
+@pytest.mark.asyncio
+async def test_compare_and_set_state(repo):
+    usage = _usage(datetime.now(UTC))
+    assert await repo.get_state(context_id="context", user_id="user") is None
+
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=RateLimitingState(value=1.5, last_usage=usage),
+    )
+    stored = await repo.get_state(context_id="context", user_id="user")
+    assert stored == RateLimitingState(value=1.5, last_usage=usage, version=0)
+
+    assert not await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=RateLimitingState(value=2.5, last_usage=usage),
+    )
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=stored,
+        state=RateLimitingState(value=2.5, last_usage=usage),
+    )
+    assert not await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=stored,
+        state=RateLimitingState(value=3.5, last_usage=usage),
+    )
+    assert await repo.get_state(
+        context_id="context",
+        user_id="user",
+    ) == RateLimitingState(value=2.5, last_usage=usage, version=1)
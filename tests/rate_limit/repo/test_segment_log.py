@@ -0,0 +1,312 @@
+import asyncio
+from datetime import UTC, datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from rate_limiter import Usage
+from rate_limiter.repo import SegmentLogRateLimitingRepo, segment_log
+
+# Room for four records per segment with the default key and ID lengths
+_RECORD_SIZE = 228
+_SEGMENT_SIZE = 64 + 4 * _RECORD_SIZE
+
+
+@pytest.fixture()
+def directory(tmp_path):
+    return tmp_path / "log"
+
+
+@pytest_asyncio.fixture
+async def repo(directory):
+    repo = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=3,
+    )
+    try:
+        yield repo
+    finally:
+        await repo.close()
+
+
+@pytest.fixture()
+def start() -> datetime:
+    return datetime.now(UTC)
+
+
+def _usage(
+    time: datetime,
+    user_id: str = "user",
+    reference_id: str | None = None,
+) -> Usage:
+    return Usage(
+        context_id="context",
+        user_id=user_id,
+        time=time,
+        reference_id=reference_id,
+        response_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_no_usages(repo):
+    assert await repo.get_usages(context_id="context", user_id="user") == []
+
+
+@pytest.mark.asyncio
+async def test_keeps_newest_usages(repo, start):
+    usages = [
+        _usage(start + timedelta(seconds=seconds), reference_id=str(seconds))
+        for seconds in (0, 1, 3, 4)
+    ]
+    # One of them out of order
+    await repo.add_usages([usages[0], usages[1], usages[3], usages[2]])
+
+    stored = await repo.get_usages(context_id="context", user_id="user", limit=3)
+    assert stored == [usages[3], usages[2], usages[1]]
+
+    since = await repo.get_usages(
+        context_id="context",
+        user_id="user",
+        limit=3,
+        since=start + timedelta(seconds=3),
+    )
+    assert since == [usages[3], usages[2]]
+
+    with pytest.raises(ValueError):
+        await repo.get_usages(context_id="context", user_id="user", limit=4)
+
+
+@pytest.mark.asyncio
+async def test_rejects_long_ids(repo, start):
+    with pytest.raises(ValueError):
+        await repo.add_usages([_usage(start, reference_id="x" * 37)])
+    with pytest.raises(ValueError):
+        await repo.add_usages([_usage(start, user_id="x" * 200)])
+
+    assert await repo.get_usages(context_id="context", user_id="user") == []
+
+
+@pytest.mark.asyncio
+async def test_restores_index_on_startup(repo, directory, start):
+    usages = [
+        _usage(start + timedelta(seconds=i), user_id=f"user{i % 2}") for i in range(10)
+    ]
+    await repo.add_usages(usages)
+    await repo.close()
+
+    restarted = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=3,
+    )
+    try:
+        stored = await restarted.get_usages_many(
+            keys=[("context", "user0"), ("context", "user1")],
+            limit=3,
+        )
+        # New usages go to a fresh segment once the last one is full
+        await restarted.add_usages([_usage(start, user_id="user2")] * 3)
+    finally:
+        await restarted.close()
+
+    assert stored == {
+        ("context", "user0"): [usages[8], usages[6], usages[4]],
+        ("context", "user1"): [usages[9], usages[7], usages[5]],
+    }
+    assert len(list(directory.iterdir())) == 4
+
+
+@pytest.mark.asyncio
+async def test_ignores_torn_records(repo, directory, start):
+    await repo.add_usages([_usage(start), _usage(start + timedelta(seconds=1))])
+    await repo.close()
+
+    segment = directory / "0000000000.seg"
+    data = bytearray(segment.read_bytes())
+    # Corrupt the second record
+    data[64 + _RECORD_SIZE + 10] ^= 0xFF
+    segment.write_bytes(data)
+
+    restarted = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=3,
+    )
+    try:
+        usages = await restarted.get_usages(
+            context_id="context",
+            user_id="user",
+            limit=3,
+        )
+    finally:
+        await restarted.close()
+
+    assert usages == [_usage(start)]
+
+
+def test_rejects_other_parameters(repo, directory):
+    with pytest.raises(ValueError):
+        SegmentLogRateLimitingRepo(
+            directory,
+            segment_size=_SEGMENT_SIZE,
+            max_id_length=64,
+        )
+
+
+@pytest.mark.asyncio
+async def test_drops_old_segments(repo, directory, start):
+    old = [
+        _usage(start - timedelta(days=3, seconds=i), user_id=f"old{i}")
+        for i in range(4)
+    ]
+    new = [_usage(start, user_id="new")]
+    await repo.add_usages([*old, *new])
+    # Segments are only deleted once their writes are flushed, which close() does
+    await repo.close()
+
+    repo = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=3,
+    )
+    try:
+        assert await repo.drop_old_usages(until=start - timedelta(days=1)) == 4
+        assert await repo.get_usages(context_id="context", user_id="old0") == []
+        assert await repo.get_usages(context_id="context", user_id="new") == new
+    finally:
+        await repo.close()
+
+    assert [path.name for path in directory.iterdir()] == ["0000000001.seg"]
+
+
+@pytest.mark.asyncio
+async def test_compacts_sparse_segments(directory, start):
+    repo = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=1,
+        fsync_interval=timedelta(0),
+    )
+    try:
+        # Only the newest usage of each user stays live, so the first segment
+        # ends up with one live record out of four
+        usages = [
+            _usage(start + timedelta(seconds=i), user_id=user_id)
+            for i, user_id in enumerate(["b", "b", "b", "a", "b", "b"])
+        ]
+        await repo.add_usages(usages)
+        assert len(list(directory.iterdir())) == 2
+
+        assert await repo.drop_old_usages(until=start - timedelta(days=1), limit=1) == 0
+        assert len(list(directory.iterdir())) == 2
+        assert await repo.drop_old_usages(until=start - timedelta(days=1)) == 0
+
+        assert [path.name for path in directory.iterdir()] == ["0000000001.seg"]
+        assert await repo.get_usages(context_id="context", user_id="a") == [usages[3]]
+        assert await repo.get_usages(context_id="context", user_id="b") == [usages[5]]
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_flushes_copies_before_deleting_originals(
+    directory,
+    start,
+    monkeypatch,
+):
+    flushed_with: list[list[str]] = []
+    flush_maps = segment_log._flush_maps
+
+    def _recording_flush_maps(maps):
+        flushed_with.append(sorted(path.name for path in directory.iterdir()))
+        flush_maps(maps)
+
+    monkeypatch.setattr(segment_log, "_flush_maps", _recording_flush_maps)
+    repo = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=1,
+        fsync_interval=timedelta(milliseconds=100),
+    )
+    try:
+        await repo.add_usages(
+            [
+                _usage(start + timedelta(seconds=i), user_id=user_id)
+                for i, user_id in enumerate(["a", "b", "b", "b", "b"])
+            ]
+        )
+        # Until the originals are flushed, they can't be compacted
+        await asyncio.sleep(0.3)
+        flushed_with.clear()
+
+        assert await repo.drop_old_usages(until=start - timedelta(days=1)) == 0
+        assert [path.name for path in directory.iterdir()] == ["0000000001.seg"]
+    finally:
+        await repo.close()
+
+    # The original was still there when its copy was flushed
+    assert flushed_with[0] == ["0000000000.seg", "0000000001.seg"]
+
+
+@pytest.mark.asyncio
+async def test_interrupted_compaction(directory, start):
+    repo = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=1,
+        fsync_interval=timedelta(0),
+    )
+    usages = [
+        _usage(start + timedelta(seconds=i), user_id=user_id)
+        for i, user_id in enumerate(["a", "b", "b", "b", "b"])
+    ]
+    try:
+        await repo.add_usages(usages)
+        first_segment = directory / "0000000000.seg"
+        original = first_segment.read_bytes()
+
+        # Moves the only live record of the first segment and deletes it
+        assert await repo.drop_old_usages(until=start - timedelta(days=1)) == 0
+        assert not first_segment.exists()
+    finally:
+        await repo.close()
+
+    # As if the process had died before the segment was deleted
+    first_segment.write_bytes(original)
+    restarted = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=3,
+    )
+    try:
+        stored = await restarted.get_usages(
+            context_id="context",
+            user_id="a",
+            limit=3,
+        )
+    finally:
+        await restarted.close()
+
+    assert stored == [usages[0]]
+
+
+@pytest.mark.asyncio
+async def test_deletes_segments_without_fsync(directory, start):
+    repo = SegmentLogRateLimitingRepo(
+        directory,
+        segment_size=_SEGMENT_SIZE,
+        max_history=3,
+        fsync_interval=None,
+    )
+    try:
+        await repo.add_usages(
+            [_usage(start - timedelta(days=3), user_id=f"old{i}") for i in range(4)]
+        )
+        await repo.add_usages([_usage(start, user_id="new")])
+
+        assert await repo.drop_old_usages(until=start - timedelta(days=1)) == 4
+        assert [path.name for path in directory.iterdir()] == ["0000000001.seg"]
+    finally:
+        await repo.close()
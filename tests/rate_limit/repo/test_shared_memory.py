@@ -0,0 +1,223 @@
+import asyncio
+import subprocess
+import sys
+import textwrap
+from datetime import UTC, datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from rate_limiter import Usage
+from rate_limiter.repo import SharedMemoryRateLimitingRepo
+
+
+@pytest.fixture()
+def table_file(tmp_path):
+    return tmp_path / "usages.shm"
+
+
+@pytest_asyncio.fixture
+async def repo(table_file):
+    repo = SharedMemoryRateLimitingRepo(table_file, capacity=64, max_history=3)
+    try:
+        yield repo
+    finally:
+        await repo.close()
+
+
+@pytest.fixture()
+def start() -> datetime:
+    return datetime.now(UTC)
+
+
+def _usage(
+    time: datetime,
+    user_id: str = "user",
+    reference_id: str | None = None,
+) -> Usage:
+    return Usage(
+        context_id="context",
+        user_id=user_id,
+        time=time,
+        reference_id=reference_id,
+        response_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_no_usages(repo):
+    assert await repo.get_usages(context_id="context", user_id="user") == []
+
+
+@pytest.mark.asyncio
+async def test_keeps_newest_usages(repo, start):
+    usages = [
+        _usage(start + timedelta(seconds=seconds), reference_id=str(seconds))
+        for seconds in (0, 1, 3, 4)
+    ]
+    # One of them out of order
+    await repo.add_usages([usages[0], usages[1], usages[3], usages[2]])
+
+    stored = await repo.get_usages(context_id="context", user_id="user", limit=3)
+    assert stored == [usages[3], usages[2], usages[1]]
+
+    since = await repo.get_usages(
+        context_id="context",
+        user_id="user",
+        limit=3,
+        since=start + timedelta(seconds=3),
+    )
+    assert since == [usages[3], usages[2]]
+
+    with pytest.raises(ValueError):
+        await repo.get_usages(context_id="context", user_id="user", limit=4)
+
+
+@pytest.mark.asyncio
+async def test_shared_between_instances(repo, table_file, start):
+    await repo.add_usages([_usage(start, user_id=f"user{i}") for i in range(10)])
+
+    other = SharedMemoryRateLimitingRepo(table_file, capacity=64, max_history=3)
+    try:
+        usages = await other.get_usages_many(
+            keys=[("context", f"user{i}") for i in range(11)],
+        )
+    finally:
+        await other.close()
+
+    assert usages == {
+        **{
+            ("context", f"user{i}"): [_usage(start, user_id=f"user{i}")]
+            for i in range(10)
+        },
+        ("context", "user10"): [],
+    }
+
+
+def test_rejects_other_parameters(repo, table_file):
+    with pytest.raises(ValueError):
+        SharedMemoryRateLimitingRepo(table_file, capacity=64, max_history=4)
+
+
+@pytest.mark.asyncio
+async def test_rejects_long_ids(repo, start):
+    with pytest.raises(ValueError):
+        await repo.add_usages([_usage(start, reference_id="x" * 37)])
+    with pytest.raises(ValueError):
+        await repo.add_usages([_usage(start, user_id="x" * 200)])
+
+
+@pytest.mark.asyncio
+async def test_table_full(table_file, start):
+    repo = SharedMemoryRateLimitingRepo(table_file, capacity=4, stripes=1)
+    try:
+        await repo.add_usages([_usage(start, user_id=f"user{i}") for i in range(4)])
+        with pytest.raises(ValueError):
+            await repo.add_usages([_usage(start, user_id="user4")])
+
+        # Dropping the old keys makes room again
+        assert await repo.drop_old_usages(until=start + timedelta(seconds=1)) == 4
+        await repo.add_usages([_usage(start, user_id=f"user{i}") for i in range(4, 8)])
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_drop_old_usages(repo, start):
+    await repo.add_usages(
+        [
+            _usage(start - timedelta(days=3), user_id="old"),
+            _usage(start - timedelta(days=3), user_id="mixed"),
+            _usage(start, user_id="mixed"),
+            _usage(start, user_id="new"),
+        ]
+    )
+
+    assert await repo.drop_old_usages(until=start - timedelta(days=1), limit=1) == 1
+    assert await repo.drop_old_usages(until=start - timedelta(days=1)) == 1
+    assert await repo.drop_old_usages(until=start - timedelta(days=1)) == 0
+
+    usages = await repo.get_usages_many(
+        keys=[("context", "old"), ("context", "mixed"), ("context", "new")],
+        limit=3,
+    )
+    assert usages == {
+        ("context", "old"): [],
+        ("context", "mixed"): [_usage(start, user_id="mixed")],
+        ("context", "new"): [_usage(start, user_id="new")],
+    }
+
+
+@pytest.mark.asyncio
+async def test_add_usage_if_allowed_is_atomic(repo, start):
+    async def _check(history: list[Usage]) -> Usage | None:
+        await asyncio.sleep(0.01)
+        return history[0] if history else None
+
+    results = await asyncio.gather(
+        *[
+            repo.add_usage_if_allowed(
+                context_id="context",
+                user_id="user",
+                utc_time=start + timedelta(seconds=seconds),
+                reference_id=None,
+                response_id=None,
+                limit=1,
+                check=_check,
+            )
+            for seconds in range(5)
+        ]
+    )
+
+    assert sum(result is None for result in results) == 1
+
+
+_WORKER = """
+import asyncio
+import sys
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+from rate_limiter import RateLimiter
+from rate_limiter.policy import DailyLimitRateLimitingPolicy
+from rate_limiter.repo import SharedMemoryRateLimitingRepo
+
+
+async def main():
+    repo = SharedMemoryRateLimitingRepo(Path(sys.argv[1]), capacity=64, max_history=3)
+    rate_limiter = RateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=3),
+        repo=repo,
+        timezone=UTC,
+        denial_cache_size=0,
+    )
+    start = datetime.now(UTC).replace(hour=12)
+    offset = int(sys.argv[2])
+    allowed = 0
+    for index in range(20):
+        offending_usage = await rate_limiter.try_acquire(
+            context_id=1,
+            user_id=2,
+            at_time=start + timedelta(milliseconds=offset + index * 10),
+        )
+        allowed += offending_usage is None
+    await rate_limiter.close()
+    print(allowed)
+
+
+asyncio.run(main())
+"""
+
+
+def test_shared_between_processes(table_file):
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-c", textwrap.dedent(_WORKER), str(table_file), str(i)],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for i in range(4)
+    ]
+    allowed = sum(int(process.communicate(timeout=30)[0]) for process in processes)
+
+    assert allowed == 3
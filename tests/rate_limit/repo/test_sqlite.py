@@ -0,0 +1,501 @@
+import asyncio
+import sqlite3
+from datetime import UTC, datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from rate_limiter import DailyUsageCount, RateLimitingState, Usage
+from rate_limiter.repo import SqliteRateLimitingRepo
+
+
+@pytest_asyncio.fixture
+async def repo(sqlite_db_file):
+    repo = await SqliteRateLimitingRepo.connect(sqlite_db_file)
+    try:
+        yield repo
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_no_usages(repo):
+    usages = await repo.get_usages(context_id="context", user_id="user")
+    assert usages == []
+
+
+@pytest.mark.asyncio
+async def test_add_usage(repo):
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+    await repo.add_usage(
+        context_id="context",
+        user_id="user",
+        utc_time=timestamp,
+        reference_id="ref",
+        response_id="response",
+    )
+
+    usages = await repo.get_usages(context_id="context", user_id="user")
+    assert usages == [
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=timestamp,
+            reference_id="ref",
+            response_id="response",
+        )
+    ]
+
+
+@pytest.mark.asyncio
+async def test_add_usage_if_allowed_is_atomic(repo):
+    start = datetime.now(UTC).replace(microsecond=0)
+
+    async def _check(history: list[Usage]) -> Usage | None:
+        # Give concurrent acquisitions a chance to interleave
+        await asyncio.sleep(0)
+        return history[0] if len(history) >= 2 else None
+
+    results = await asyncio.gather(
+        *[
+            repo.add_usage_if_allowed(
+                context_id="context",
+                user_id="user",
+                utc_time=start + timedelta(seconds=i),
+                reference_id=None,
+                response_id=None,
+                limit=2,
+                check=_check,
+            )
+            for i in range(5)
+        ]
+    )
+
+    assert sum(result is None for result in results) == 2
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=10)
+    assert len(usages) == 2
+
+
+@pytest.mark.asyncio
+async def test_pending_check_does_not_block_writes(repo):
+    start = datetime.now(UTC).replace(microsecond=0)
+    checking = asyncio.Event()
+    release = asyncio.Event()
+
+    async def _check(history: list[Usage]) -> Usage | None:
+        checking.set()
+        await release.wait()
+        return None
+
+    acquisition = asyncio.create_task(
+        repo.add_usage_if_allowed(
+            context_id="context",
+            user_id="user",
+            utc_time=start,
+            reference_id=None,
+            response_id=None,
+            limit=1,
+            check=_check,
+        )
+    )
+    await checking.wait()
+    await asyncio.wait_for(
+        repo.add_usage(
+            context_id="context",
+            user_id="other",
+            utc_time=start,
+            reference_id=None,
+            response_id=None,
+        ),
+        timeout=5,
+    )
+
+    release.set()
+    assert await acquisition is None
+
+
+@pytest.mark.asyncio
+async def test_get_usages_many(repo):
+    start = datetime.now(UTC).replace(microsecond=0)
+    for i in range(3):
+        await repo.add_usage(
+            context_id="context",
+            user_id="user",
+            utc_time=start + timedelta(seconds=i),
+            reference_id=str(i),
+            response_id=None,
+        )
+    await repo.add_usage(
+        context_id="context",
+        user_id="other",
+        utc_time=start,
+        reference_id="other",
+        response_id=None,
+    )
+
+    usages = await repo.get_usages_many(
+        keys=[("context", "user"), ("context", "other"), ("context", "nobody")],
+        limit=2,
+    )
+
+    assert usages.keys() == {
+        ("context", "user"),
+        ("context", "other"),
+        ("context", "nobody"),
+    }
+    assert [usage.reference_id for usage in usages[("context", "user")]] == ["2", "1"]
+    assert [usage.reference_id for usage in usages[("context", "other")]] == ["other"]
+    assert usages[("context", "nobody")] == []
+
+
+@pytest.mark.asyncio
+async def test_add_usages(repo):
+    start = datetime.now(UTC).replace(microsecond=0)
+    usages = [
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=start + timedelta(seconds=i),
+            reference_id=str(i),
+            response_id=None,
+        )
+        for i in range(100)
+    ]
+
+    await repo.add_usages(usages)
+
+    stored = await repo.get_usages(context_id="context", user_id="user", limit=200)
+    assert stored == usages[::-1]
+
+
+@pytest_asyncio.fixture
+async def counting_repo(sqlite_db_file, timezone):
+    repo = await SqliteRateLimitingRepo.connect(
+        sqlite_db_file,
+        daily_count_timezone=timezone,
+    )
+    try:
+        yield repo
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_daily_count(counting_repo, timezone):
+    day = datetime(2024, 3, 1, 12, tzinfo=timezone)
+    times = [
+        day - timedelta(days=1),
+        day.replace(hour=0, minute=0),
+        day + timedelta(hours=2),
+        day,
+    ]
+    await counting_repo.add_usages(
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=time.astimezone(UTC),
+            reference_id=str(index),
+            response_id=None,
+        )
+        for index, time in enumerate(times[:2])
+    )
+    for index, time in enumerate(times[2:], start=2):
+        await counting_repo.add_usage(
+            context_id="context",
+            user_id="user",
+            utc_time=time.astimezone(UTC),
+            reference_id=str(index),
+            response_id=None,
+        )
+
+    daily_count = await counting_repo.get_daily_count(
+        context_id="context",
+        user_id="user",
+        day=day.date(),
+    )
+
+    assert daily_count == DailyUsageCount(
+        day=day.date(),
+        count=3,
+        last_usage=Usage(
+            context_id="context",
+            user_id="user",
+            time=times[2],
+            reference_id="2",
+            response_id=None,
+        ),
+    )
+
+    await counting_repo.drop_old_usages(until=day + timedelta(days=1))
+    daily_count = await counting_repo.get_daily_count(
+        context_id="context",
+        user_id="user",
+        day=day.date(),
+    )
+    assert daily_count.count == 0
+
+
+@pytest.mark.asyncio
+async def test_daily_count_disabled(repo):
+    with pytest.raises(ValueError):
+        await repo.get_daily_count(
+            context_id="context",
+            user_id="user",
+            day=datetime.now(UTC).date(),
+        )
+
+
+@pytest.mark.asyncio
+async def test_compare_and_set_state(repo):
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+    usage = Usage(
+        context_id="context",
+        user_id="user",
+        time=timestamp,
+        reference_id="ref",
+        response_id=None,
+    )
+    assert await repo.get_state(context_id="context", user_id="user") is None
+
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=RateLimitingState(value=1.5, last_usage=usage),
+    )
+    stored = await repo.get_state(context_id="context", user_id="user")
+    assert stored == RateLimitingState(value=1.5, last_usage=usage, version=0)
+
+    # Somebody else stored a state in the meantime
+    assert not await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=None,
+        state=RateLimitingState(value=2.5, last_usage=usage),
+    )
+    assert await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=stored,
+        state=RateLimitingState(value=2.5, last_usage=usage),
+    )
+    assert not await repo.compare_and_set_state(
+        context_id="context",
+        user_id="user",
+        expected=stored,
+        state=RateLimitingState(value=3.5, last_usage=usage),
+    )
+    assert await repo.get_state(
+        context_id="context",
+        user_id="user",
+    ) == RateLimitingState(value=2.5, last_usage=usage, version=1)
+
+    await repo.drop_old_usages(until=timestamp + timedelta(seconds=1))
+    assert await repo.get_state(context_id="context", user_id="user") is None
+
+
+@pytest.mark.asyncio
+async def test_get_usages_since(repo):
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+    usages = [
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=timestamp - timedelta(minutes=minutes),
+            reference_id=None,
+            response_id=None,
+        )
+        for minutes in range(5)
+    ]
+    await repo.add_usages(usages)
+    since = timestamp - timedelta(minutes=2)
+
+    assert (
+        await repo.get_usages(
+            context_id="context", user_id="user", limit=4, since=since
+        )
+        == usages[:3]
+    )
+    assert await repo.get_usages_many(
+        keys=[("context", "user")],
+        limit=2,
+        since=since,
+    ) == {("context", "user"): usages[:2]}
+
+
+@pytest.mark.asyncio
+async def test_wal_mode(repo):
+    journal_mode = await repo._run_write(
+        lambda: repo._connection.execute("PRAGMA journal_mode").fetchone()[0]
+    )
+    assert journal_mode == "wal"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reads_see_writes(repo):
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+
+    async def _add_and_read(user_id: str) -> list[Usage]:
+        await repo.add_usage(
+            context_id="context",
+            user_id=user_id,
+            utc_time=timestamp,
+            reference_id=None,
+            response_id=None,
+        )
+        return await repo.get_usages(context_id="context", user_id=user_id)
+
+    results = await asyncio.gather(*[_add_and_read(str(i)) for i in range(20)])
+
+    assert [len(usages) for usages in results] == [1] * 20
+
+
+@pytest.mark.asyncio
+async def test_without_read_connections(sqlite_db_file):
+    repo = await SqliteRateLimitingRepo.connect(sqlite_db_file, read_connections=0)
+    try:
+        timestamp = datetime.now(UTC).replace(microsecond=0)
+        await repo.add_usage(
+            context_id="context",
+            user_id="user",
+            utc_time=timestamp,
+            reference_id=None,
+            response_id=None,
+        )
+        assert len(await repo.get_usages(context_id="context", user_id="user")) == 1
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_group_commit(sqlite_db_file):
+    repo = await SqliteRateLimitingRepo.connect(
+        sqlite_db_file,
+        group_commit_window=timedelta(milliseconds=20),
+    )
+    transactions = 0
+    add_usages_of_callers = repo._add_usages_of_callers
+
+    def _counting_add_usages_of_callers(
+        *,
+        batches: list[list[Usage]],
+    ) -> list[sqlite3.IntegrityError | None]:
+        nonlocal transactions
+        transactions += 1
+        return add_usages_of_callers(batches=batches)
+
+    repo._add_usages_of_callers = _counting_add_usages_of_callers  # type: ignore[method-assign]
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+    try:
+        await asyncio.gather(
+            *[
+                repo.add_usage(
+                    context_id="context",
+                    user_id=str(i),
+                    utc_time=timestamp,
+                    reference_id=None,
+                    response_id=None,
+                )
+                for i in range(50)
+            ]
+        )
+        assert transactions == 1
+
+        # Everything is committed once add_usage returns
+        usages = await repo.get_usages_many(
+            keys=[("context", str(i)) for i in range(50)]
+        )
+        assert all(len(user_usages) == 1 for user_usages in usages.values())
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_group_commit_isolates_callers(sqlite_db_file):
+    repo = await SqliteRateLimitingRepo.connect(
+        sqlite_db_file,
+        group_commit_window=timedelta(milliseconds=20),
+    )
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+    alice = Usage(
+        context_id="context",
+        user_id="alice",
+        time=timestamp,
+        reference_id=None,
+        response_id=None,
+    )
+    bob = Usage(
+        context_id="context",
+        user_id="bob",
+        time=timestamp,
+        reference_id=None,
+        response_id=None,
+    )
+    try:
+        await repo.add_usages([bob])
+        # Times are stored in whole seconds, so bob's second usage is a duplicate
+        results = await asyncio.gather(
+            repo.add_usages([alice]),
+            repo.add_usages([bob]),
+            return_exceptions=True,
+        )
+        assert results[0] is None
+        assert isinstance(results[1], sqlite3.IntegrityError)
+
+        assert await repo.get_usages_many(
+            keys=[("context", "alice"), ("context", "bob")],
+        ) == {("context", "alice"): [alice], ("context", "bob"): [bob]}
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_group_commit_is_flushed_on_close(sqlite_db_file):
+    repo = await SqliteRateLimitingRepo.connect(
+        sqlite_db_file,
+        group_commit_window=timedelta(hours=1),
+    )
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+    add = asyncio.create_task(
+        repo.add_usage(
+            context_id="context",
+            user_id="user",
+            utc_time=timestamp,
+            reference_id=None,
+            response_id=None,
+        )
+    )
+    await asyncio.sleep(0)
+    await repo.close()
+    await add
+
+    repo = await SqliteRateLimitingRepo.connect(sqlite_db_file)
+    try:
+        assert len(await repo.get_usages(context_id="context", user_id="user")) == 1
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_drop_old_usages_in_chunks(repo):
+    timestamp = datetime.now(UTC).replace(microsecond=0)
+    await repo.add_usages(
+        Usage(
+            context_id="context",
+            user_id="user",
+            time=timestamp - timedelta(minutes=minutes),
+            reference_id=None,
+            response_id=None,
+        )
+        for minutes in range(4)
+    )
+
+    # Times are stored as whole seconds, so the second of the cutoff is kept
+    cutoff = timestamp - timedelta(minutes=2, microseconds=-500_000)
+    assert await repo.drop_old_usages(until=cutoff, limit=1) == 1
+    assert await repo.drop_old_usages(until=cutoff, limit=1) == 0
+
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=5)
+    assert [usage.time for usage in usages] == [
+        timestamp - timedelta(minutes=minutes) for minutes in range(3)
+    ]
@@ -0,0 +1,248 @@
+import asyncio
+import sqlite3
+from datetime import UTC, datetime, timedelta
+
+import pytest
+import pytest_asyncio
+
+from rate_limiter import DailyUsageCount, Usage
+from rate_limiter.repo import SqliteRateLimitingRepo, WriteBehindRateLimitingRepo
+
+
+class _CountingRepo(SqliteRateLimitingRepo):
+    batch_sizes: list[int]
+
+    async def add_usages(self, usages):
+        usages = list(usages)
+        self.batch_sizes.append(len(usages))
+        await super().add_usages(usages)
+
+
+@pytest_asyncio.fixture
+async def inner_repo(sqlite_db_file):
+    repo = await _CountingRepo.connect(sqlite_db_file)
+    repo.batch_sizes = []
+    return repo
+
+
+def _usage(time: datetime, reference_id: str) -> Usage:
+    return Usage(
+        context_id="context",
+        user_id="user",
+        time=time,
+        reference_id=reference_id,
+        response_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_pending_usages_are_visible(inner_repo):
+    repo = WriteBehindRateLimitingRepo(inner_repo, max_delay=timedelta(hours=1))
+    start = datetime.now(UTC).replace(microsecond=0)
+    await repo.add_usages(
+        _usage(start + timedelta(seconds=i), str(i)) for i in range(3)
+    )
+
+    assert inner_repo.batch_sizes == []
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=2)
+    assert [usage.reference_id for usage in usages] == ["2", "1"]
+
+    await repo.close()
+    assert inner_repo.batch_sizes == [3]
+
+
+@pytest.mark.asyncio
+async def test_flushes_after_max_delay(inner_repo):
+    repo = WriteBehindRateLimitingRepo(inner_repo, max_delay=timedelta(milliseconds=1))
+    start = datetime.now(UTC).replace(microsecond=0)
+    await repo.add_usages(
+        _usage(start + timedelta(seconds=i), str(i)) for i in range(3)
+    )
+
+    for _ in range(100):
+        if inner_repo.batch_sizes:
+            break
+        await asyncio.sleep(0.01)
+
+    assert inner_repo.batch_sizes == [3]
+    usages = await repo.get_usages(context_id="context", user_id="user", limit=10)
+    assert [usage.reference_id for usage in usages] == ["2", "1", "0"]
+    await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_flushes_in_batches(inner_repo):
+    repo = WriteBehindRateLimitingRepo(
+        inner_repo,
+        max_batch_size=2,
+        max_pending=2,
+        max_delay=timedelta(hours=1),
+    )
+    start = datetime.now(UTC).replace(microsecond=0)
+    await repo.add_usages(
+        _usage(start + timedelta(seconds=i), str(i)) for i in range(5)
+    )
+    await repo.close()
+
+    assert sum(inner_repo.batch_sizes) == 5
+    assert max(inner_repo.batch_sizes) <= 2
+
+
+@pytest.mark.asyncio
+async def test_add_usage_if_allowed(inner_repo):
+    repo = WriteBehindRateLimitingRepo(inner_repo, max_delay=timedelta(hours=1))
+
+    async def _check(history: list[Usage]) -> Usage | None:
+        await asyncio.sleep(0)
+        return history[0] if history else None
+
+    results = await asyncio.gather(
+        *[
+            repo.add_usage_if_allowed(
+                context_id="context",
+                user_id="user",
+                utc_time=datetime.now(UTC),
+                reference_id=str(i),
+                response_id=None,
+                limit=1,
+                check=_check,
+            )
+            for i in range(5)
+        ]
+    )
+    await repo.close()
+
+    assert sum(result is None for result in results) == 1
+    assert inner_repo.batch_sizes == [1]
+
+
+class _FailingRepo(_CountingRepo):
+    failures: int
+
+    async def add_usages(self, usages):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("Database is unavailable")
+        await super().add_usages(usages)
+
+
+@pytest_asyncio.fixture
+async def failing_repo(sqlite_db_file):
+    repo = await _FailingRepo.connect(sqlite_db_file)
+    repo.batch_sizes = []
+    return repo
+
+
+@pytest.mark.asyncio
+async def test_retries_failed_flushes(failing_repo):
+    failing_repo.failures = 2
+    repo = WriteBehindRateLimitingRepo(
+        failing_repo,
+        max_delay=timedelta(milliseconds=1),
+        max_flush_attempts=3,
+        retry_delay=timedelta(milliseconds=1),
+    )
+    start = datetime.now(UTC).replace(microsecond=0)
+    await repo.add_usages([_usage(start, "0")])
+    await repo.close()
+
+    assert failing_repo.failures == 0
+    assert failing_repo.batch_sizes == [1]
+
+
+@pytest.mark.asyncio
+async def test_surfaces_dropped_batches(failing_repo):
+    failing_repo.failures = 2
+    repo = WriteBehindRateLimitingRepo(
+        failing_repo,
+        max_delay=timedelta(milliseconds=1),
+        max_flush_attempts=2,
+        retry_delay=timedelta(milliseconds=1),
+    )
+    start = datetime.now(UTC).replace(microsecond=0)
+    await repo.add_usages([_usage(start, "0")])
+    await repo._queue.join()
+
+    # The next write reports the dropped batch, but goes through afterwards
+    with pytest.raises(OSError):
+        await repo.add_usages([_usage(start, "1")])
+    await repo.add_usages([_usage(start, "1")])
+    await repo.close()
+    assert failing_repo.batch_sizes == [1]
+
+
+@pytest.mark.asyncio
+async def test_close_surfaces_dropped_batches(failing_repo):
+    failing_repo.failures = 1
+    repo = WriteBehindRateLimitingRepo(
+        failing_repo,
+        max_delay=timedelta(hours=1),
+        max_flush_attempts=1,
+    )
+    await repo.add_usages([_usage(datetime.now(UTC), "0")])
+
+    with pytest.raises(OSError):
+        await repo.close()
+    assert failing_repo.batch_sizes == []
+
+
+@pytest.mark.asyncio
+async def test_drops_only_failing_usages(inner_repo):
+    start = datetime.now(UTC).replace(microsecond=0)
+    duplicate = Usage(
+        context_id="context",
+        user_id="bob",
+        time=start,
+        reference_id=None,
+        response_id=None,
+    )
+    await inner_repo.add_usages([duplicate])
+    repo = WriteBehindRateLimitingRepo(
+        inner_repo,
+        max_delay=timedelta(milliseconds=1),
+        max_flush_attempts=1,
+    )
+    # Times are stored in whole seconds, so the second usage of bob is rejected
+    usages = [_usage(start + timedelta(seconds=i), str(i)) for i in range(3)]
+    await repo.add_usages([usages[0], duplicate, *usages[1:]])
+    await repo._queue.join()
+
+    assert await inner_repo.get_usages_many(
+        keys=[("context", "user"), ("context", "bob")],
+        limit=3,
+    ) == {("context", "user"): usages[::-1], ("context", "bob"): [duplicate]}
+    with pytest.raises(sqlite3.IntegrityError):
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_daily_count_includes_pending_usages(sqlite_db_file, timezone):
+    inner_repo = await SqliteRateLimitingRepo.connect(
+        sqlite_db_file,
+        daily_count_timezone=timezone,
+    )
+    repo = WriteBehindRateLimitingRepo(inner_repo, max_delay=timedelta(hours=1))
+    day = datetime(2024, 3, 1, 12, tzinfo=timezone)
+    usages = [_usage(day.astimezone(UTC), "0")]
+    await inner_repo.add_usages(usages)
+    try:
+        assert repo.daily_count_timezone == timezone
+        pending = [
+            _usage((day + timedelta(hours=1)).astimezone(UTC), "1"),
+            _usage((day + timedelta(days=1)).astimezone(UTC), "2"),
+        ]
+        await repo.add_usages(pending)
+
+        daily_count = await repo.get_daily_count(
+            context_id="context",
+            user_id="user",
+            day=day.date(),
+        )
+    finally:
+        await repo.close()
+
+    assert daily_count == DailyUsageCount(
+        day=day.date(),
+        count=2,
+        last_usage=pending[0],
+    )
@@ -0,0 +1,412 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from rate_limiter import RateLimiter, Usage
+from rate_limiter.policy import (
+    CompositeRateLimitingPolicy,
+    DailyLimitRateLimitingPolicy,
+    GcraRateLimitingPolicy,
+    SlidingWindowRateLimitingPolicy,
+)
+from rate_limiter.repo import (
+    CachingRateLimitingRepo,
+    CompactInMemoryRateLimitingRepo,
+    InMemoryRateLimitingRepo,
+    SqliteRateLimitingRepo,
+)
+
+
+class _CountingRepo(InMemoryRateLimitingRepo):
+    reads: int = 0
+
+    async def get_usages(self, **kwargs):
+        self.reads += 1
+        return await super().get_usages(**kwargs)
+
+
+@pytest.fixture()
+def repo() -> _CountingRepo:
+    return _CountingRepo()
+
+
+@pytest.fixture()
+def rate_limiter(repo, timezone) -> RateLimiter:
+    return RateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=1),
+        repo=repo,
+        timezone=timezone,
+    )
+
+
+@pytest.mark.asyncio
+async def test_try_acquire(rate_limiter, now, yesterday):
+    assert (
+        await rate_limiter.try_acquire(context_id=1, user_id=2, at_time=yesterday)
+        is None
+    )
+    assert await rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now) is None
+
+    offending_usage = await rate_limiter.try_acquire(
+        context_id=1,
+        user_id=2,
+        at_time=now,
+        reference_id="denied",
+    )
+    assert offending_usage is not None
+    assert offending_usage.time == now
+    assert (
+        await rate_limiter.get_offending_usage(
+            context_id=1,
+            user_id=2,
+            at_time=now,
+        )
+        == offending_usage
+    )
+
+
+@pytest.mark.asyncio
+async def test_get_offending_usages_many(rate_limiter, now):
+    await rate_limiter.add_usage(context_id=1, user_id=2, time=now)
+
+    offending_usages = await rate_limiter.get_offending_usages_many(
+        keys=[(1, 2), ("1", "3")],
+        at_time=now,
+    )
+
+    assert offending_usages.keys() == {("1", "2"), ("1", "3")}
+    assert offending_usages[("1", "2")] is not None
+    assert offending_usages[("1", "3")] is None
+
+
+@pytest.mark.asyncio
+async def test_add_usages(rate_limiter, now):
+    await rate_limiter.add_usages(
+        [
+            Usage(
+                context_id="1",
+                user_id=str(user_id),
+                time=now,
+                reference_id=None,
+                response_id=None,
+            )
+            for user_id in range(3)
+        ]
+    )
+
+    offending_usages = await rate_limiter.get_offending_usages_many(
+        keys=[(1, 0), (1, 1), (1, 2), (1, 3)],
+        at_time=now,
+    )
+
+    assert [usage is not None for usage in offending_usages.values()] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_denials_are_cached(rate_limiter, repo, earlier_today, now, tomorrow):
+    await rate_limiter.add_usage(context_id=1, user_id=2, time=earlier_today)
+    for _ in range(3):
+        assert await rate_limiter.get_offending_usage(
+            context_id=1,
+            user_id=2,
+            at_time=now,
+        )
+        assert await rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now)
+
+    assert repo.reads == 1
+
+    assert (
+        await rate_limiter.get_offending_usage(
+            context_id=1,
+            user_id=2,
+            at_time=tomorrow,
+        )
+        is None
+    )
+    assert repo.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_denial_cache_can_be_disabled(repo, timezone, earlier_today, now):
+    rate_limiter = RateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=1),
+        repo=repo,
+        timezone=timezone,
+        denial_cache_size=0,
+    )
+    await rate_limiter.add_usage(context_id=1, user_id=2, time=earlier_today)
+    for _ in range(3):
+        assert await rate_limiter.get_offending_usage(
+            context_id=1,
+            user_id=2,
+            at_time=now,
+        )
+
+    assert repo.reads == 3
+
+
+@pytest.mark.asyncio
+async def test_multi_use_limit(repo, timezone, now):
+    rate_limiter = RateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=3),
+        repo=repo,
+        timezone=timezone,
+    )
+
+    for _ in range(3):
+        assert (
+            await rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now) is None
+        )
+
+    assert await rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now)
+
+
+@pytest.mark.asyncio
+async def test_offending_usage_is_in_timezone(rate_limiter, timezone, now):
+    await rate_limiter.add_usage(context_id=1, user_id=2, time=now)
+
+    offending_usage = await rate_limiter.get_offending_usage(
+        context_id=1,
+        user_id=2,
+        at_time=now,
+    )
+
+    assert offending_usage is not None
+    assert offending_usage.time.tzinfo is timezone
+
+
+@pytest.mark.asyncio
+async def test_uses_daily_counts(sqlite_db_file, timezone, earlier_today, now):
+    repo = await SqliteRateLimitingRepo.connect(
+        sqlite_db_file,
+        daily_count_timezone=timezone,
+    )
+    rate_limiter = RateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=2),
+        repo=repo,
+        timezone=timezone,
+        denial_cache_size=0,
+    )
+
+    try:
+        await rate_limiter.add_usage(context_id=1, user_id=2, time=earlier_today)
+        assert not await rate_limiter.get_offending_usage(
+            context_id=1,
+            user_id=2,
+            at_time=now,
+        )
+        await repo._run_write(
+            lambda: repo._connection.execute("DELETE FROM usages").connection.commit()
+        )
+        await rate_limiter.add_usage(context_id=1, user_id=2, time=earlier_today)
+
+        # The usages table is empty, so this can only come from the counts
+        offending_usage = await rate_limiter.get_offending_usage(
+            context_id=1,
+            user_id=2,
+            at_time=now,
+        )
+        assert offending_usage is not None
+    finally:
+        await rate_limiter.close()
+
+
+def test_stateful_policy_needs_state_support(timezone):
+    policy = GcraRateLimitingPolicy(limit=100, period=timedelta(hours=1))
+    with pytest.raises(ValueError):
+        RateLimiter(
+            policy=policy,
+            repo=CompactInMemoryRateLimitingRepo(),
+            timezone=timezone,
+        )
+    with pytest.raises(ValueError):
+        RateLimiter(
+            policy=policy,
+            repo=CachingRateLimitingRepo(CompactInMemoryRateLimitingRepo()),
+            timezone=timezone,
+        )
+
+    # Wrappers forward the capability of the repo they wrap
+    RateLimiter(
+        policy=policy,
+        repo=CachingRateLimitingRepo(InMemoryRateLimitingRepo()),
+        timezone=timezone,
+    )
+
+
+@pytest.mark.asyncio
+async def test_gcra(repo, timezone, now):
+    rate_limiter = RateLimiter(
+        policy=GcraRateLimitingPolicy(
+            limit=100,
+            period=timedelta(hours=1),
+            burst=10,
+        ),
+        repo=repo,
+        timezone=timezone,
+    )
+
+    results = await asyncio.gather(
+        *[
+            rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now)
+            for _ in range(15)
+        ]
+    )
+    assert sum(result is None for result in results) == 10
+    # Only the state is kept, not the history
+    assert repo.reads == 0
+
+    later = now + timedelta(seconds=36)
+    assert (
+        await rate_limiter.try_acquire(context_id=1, user_id=2, at_time=later) is None
+    )
+    assert (
+        await rate_limiter.try_acquire(context_id=1, user_id=2, at_time=later)
+        is not None
+    )
+
+
+@pytest.mark.asyncio
+async def test_sliding_window(sqlite_db_file, timezone, now):
+    repo = await SqliteRateLimitingRepo.connect(sqlite_db_file)
+    rate_limiter = RateLimiter(
+        policy=SlidingWindowRateLimitingPolicy(limit=2, window=timedelta(minutes=1)),
+        repo=repo,
+        timezone=timezone,
+        denial_cache_size=0,
+    )
+    try:
+        start = now.replace(microsecond=0)
+        for seconds in (0, 30):
+            assert (
+                await rate_limiter.try_acquire(
+                    context_id=1,
+                    user_id=2,
+                    at_time=start + timedelta(seconds=seconds),
+                )
+                is None
+            )
+
+        offending_usage = await rate_limiter.try_acquire(
+            context_id=1,
+            user_id=2,
+            at_time=start + timedelta(seconds=59),
+        )
+        assert offending_usage is not None
+        assert offending_usage.time == start
+
+        assert (
+            await rate_limiter.get_offending_usage(
+                context_id=1,
+                user_id=2,
+                at_time=start + timedelta(seconds=60),
+            )
+            is None
+        )
+    finally:
+        await repo.close()
+
+
+@pytest.mark.asyncio
+async def test_composite_policy_reads_once(timezone, now):
+    # The weekly policy needs the last 200 usages
+    repo = _CountingRepo(max_history=200)
+    rate_limiter = RateLimiter(
+        policy=CompositeRateLimitingPolicy(
+            policies=[
+                SlidingWindowRateLimitingPolicy(limit=1, window=timedelta(minutes=1)),
+                SlidingWindowRateLimitingPolicy(limit=20, window=timedelta(days=1)),
+                SlidingWindowRateLimitingPolicy(limit=200, window=timedelta(weeks=1)),
+            ]
+        ),
+        repo=repo,
+        timezone=timezone,
+    )
+
+    assert await rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now) is None
+    assert repo.reads == 1
+
+    offending_usage = await rate_limiter.try_acquire(
+        context_id=1,
+        user_id=2,
+        at_time=now + timedelta(seconds=30),
+    )
+    assert offending_usage is not None
+    assert repo.reads == 2
+    # The denial is cached until the minute is over
+    assert (
+        await rate_limiter.get_offending_usage(
+            context_id=1,
+            user_id=2,
+            at_time=now + timedelta(seconds=59),
+        )
+        == offending_usage
+    )
+    assert repo.reads == 2
+    assert (
+        await rate_limiter.try_acquire(
+            context_id=1,
+            user_id=2,
+            at_time=now + timedelta(minutes=1),
+        )
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_housekeeping_in_chunks(repo, timezone, now):
+    rate_limiter = RateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=1),
+        repo=repo,
+        timezone=timezone,
+        retention_time=timedelta(days=1),
+    )
+    await rate_limiter.add_usages(
+        Usage(
+            context_id="context",
+            user_id=f"user{i}",
+            time=now - timedelta(days=2),
+            reference_id=None,
+            response_id=None,
+        )
+        for i in range(5)
+    )
+
+    assert await rate_limiter.do_housekeeping(chunk_size=2) == 5
+    assert await rate_limiter.do_housekeeping(chunk_size=2) == 0
+
+
+@pytest.mark.asyncio
+async def test_background_housekeeping(repo, timezone, now):
+    rate_limiter = RateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=1),
+        repo=repo,
+        timezone=timezone,
+        retention_time=timedelta(days=1),
+    )
+    await rate_limiter.add_usages(
+        [
+            Usage(
+                context_id="context",
+                user_id="user",
+                time=now - timedelta(days=2),
+                reference_id=None,
+                response_id=None,
+            )
+        ]
+    )
+
+    rate_limiter.start_housekeeping(interval=timedelta(hours=1), chunk_size=10)
+    with pytest.raises(ValueError):
+        rate_limiter.start_housekeeping()
+    await asyncio.sleep(0.01)
+    assert repo._usages == {}
+
+    await rate_limiter.close()
+    assert rate_limiter._housekeeping is None
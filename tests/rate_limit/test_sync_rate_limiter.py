@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+from rate_limiter import RateLimitingPolicy, SyncRateLimiter, Usage
+from rate_limiter.policy import (
+    CompositeRateLimitingPolicy,
+    DailyLimitRateLimitingPolicy,
+    GcraRateLimitingPolicy,
+    SlidingWindowRateLimitingPolicy,
+)
+from rate_limiter.repo import SyncInMemoryRateLimitingRepo, SyncSqliteRateLimitingRepo
+
+
+@pytest.fixture(params=["in_memory", "sqlite"])
+def repo(request, sqlite_db_file):
+    if request.param == "in_memory":
+        repo = SyncInMemoryRateLimitingRepo()
+    else:
+        repo = SyncSqliteRateLimitingRepo.connect(sqlite_db_file)
+    try:
+        yield repo
+    finally:
+        repo.close()
+
+
+def test_try_acquire(repo, timezone, now, yesterday):
+    rate_limiter = SyncRateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=1),
+        repo=repo,
+        timezone=timezone,
+    )
+
+    assert rate_limiter.try_acquire(context_id=1, user_id=2, at_time=yesterday) is None
+    assert rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now) is None
+
+    offending_usage = rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now)
+    assert offending_usage is not None
+    assert offending_usage.time.tzinfo == timezone
+    assert (
+        rate_limiter.get_offending_usage(context_id=1, user_id=2, at_time=now)
+        == offending_usage
+    )
+    assert rate_limiter.get_offending_usages_many(
+        keys=[(1, 2), (1, 3)],
+        at_time=now,
+    ) == {("1", "2"): offending_usage, ("1", "3"): None}
+
+
+def test_try_acquire_from_threads(repo, timezone, now):
+    rate_limiter = SyncRateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=3),
+        repo=repo,
+        timezone=timezone,
+        denial_cache_size=0,
+    )
+    # Usage times must be unique, but all on the same day
+    start = now.replace(hour=12, minute=0, second=0, microsecond=0)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(
+                lambda seconds: rate_limiter.try_acquire(
+                    context_id=1,
+                    user_id=2,
+                    at_time=start + timedelta(seconds=seconds),
+                ),
+                range(20),
+            )
+        )
+
+    assert sum(result is None for result in results) == 3
+
+
+def test_gcra(timezone, now):
+    repo = SyncInMemoryRateLimitingRepo()
+    rate_limiter = SyncRateLimiter(
+        policy=GcraRateLimitingPolicy(limit=60, period=timedelta(hours=1), burst=2),
+        repo=repo,
+        timezone=timezone,
+    )
+
+    results = [
+        rate_limiter.try_acquire(context_id=1, user_id=2, at_time=now) for _ in range(3)
+    ]
+    assert [result is None for result in results] == [True, True, False]
+    assert repo.get_usages(context_id="1", user_id="2") == []
+
+
+class _StatelessRepo(SyncInMemoryRateLimitingRepo):
+    @property
+    def supports_states(self) -> bool:
+        return False
+
+
+def test_stateful_policy_needs_state_support(timezone):
+    with pytest.raises(ValueError):
+        SyncRateLimiter(
+            policy=GcraRateLimitingPolicy(limit=60, period=timedelta(hours=1)),
+            repo=_StatelessRepo(),
+            timezone=timezone,
+        )
+
+
+class _AsyncOnlyPolicy(SlidingWindowRateLimitingPolicy):
+    async def get_offending_usage(
+        self,
+        *,
+        at_time: datetime,
+        last_usages: list[Usage],
+    ) -> Usage | None:
+        return None
+
+    get_offending_usage_sync = RateLimitingPolicy.get_offending_usage_sync
+
+
+@pytest.mark.parametrize("composite", [False, True])
+def test_policy_needs_sync_support(repo, timezone, composite):
+    policy = _AsyncOnlyPolicy(limit=1, window=timedelta(minutes=1))
+    if composite:
+        policy = CompositeRateLimitingPolicy(
+            policies=[DailyLimitRateLimitingPolicy(limit=5), policy]
+        )
+
+    with pytest.raises(ValueError):
+        SyncRateLimiter(policy=policy, repo=repo, timezone=timezone)
+
+
+def test_composite(repo, timezone, now):
+    rate_limiter = SyncRateLimiter(
+        policy=CompositeRateLimitingPolicy(
+            policies=[
+                SlidingWindowRateLimitingPolicy(limit=1, window=timedelta(minutes=1)),
+                DailyLimitRateLimitingPolicy(limit=5),
+            ]
+        ),
+        repo=repo,
+        timezone=timezone,
+    )
+    start = now.replace(microsecond=0)
+
+    rate_limiter.add_usage(context_id=1, user_id=2, time=start)
+    assert (
+        rate_limiter.get_offending_usage(
+            context_id=1,
+            user_id=2,
+            at_time=start + timedelta(seconds=30),
+        )
+        is not None
+    )
+
+
+def test_uses_daily_counts(sqlite_db_file, timezone, earlier_today, now):
+    repo = SyncSqliteRateLimitingRepo.connect(
+        sqlite_db_file,
+        daily_count_timezone=timezone,
+    )
+    rate_limiter = SyncRateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=1),
+        repo=repo,
+        timezone=timezone,
+    )
+
+    try:
+        rate_limiter.add_usage(context_id=1, user_id=2, time=earlier_today)
+        with repo._cursor() as cursor:
+            cursor.execute("DELETE FROM usages")
+
+        # The usages table is empty, so this can only come from the counts
+        assert (
+            rate_limiter.get_offending_usage(context_id=1, user_id=2, at_time=now)
+            is not None
+        )
+    finally:
+        rate_limiter.close()
+
+
+def test_housekeeping(repo, timezone, now):
+    rate_limiter = SyncRateLimiter(
+        policy=DailyLimitRateLimitingPolicy(limit=1),
+        repo=repo,
+        timezone=timezone,
+        retention_time=timedelta(days=1),
+    )
+    rate_limiter.add_usages(
+        Usage(
+            context_id="context",
+            user_id=f"user{i}",
+            time=now - timedelta(days=2),
+            reference_id=None,
+            response_id=None,
+        )
+        for i in range(3)
+    )
+
+    assert rate_limiter.do_housekeeping(chunk_size=2) == 3
+    assert rate_limiter.do_housekeeping() == 0